@@ -0,0 +1,101 @@
+from collections import namedtuple
+
+from bytecode_compiler import (
+    INDEXED_PURE_ARITY, SYM_CALL_FUNCTION_BY_REF, SYM_FEED_DEFUZZER_FAST,
+    SYM_FEED_DEFUZZER_FAST_POP, SYM_GET_INPUT_BY_INDEX, SYM_MAX, SYM_MIN,
+    SYM_POP, Expression, split_expressions,
+)
+
+# A rule of the program: an `Expression` of memberships, %min and %max, and
+# the (output index, x2) of every defuzzer it feeds
+Rule = namedtuple('Rule', ('condition', 'feeds'))
+
+def split_rules(bytecode):
+    """Return the `Rule`s of a program after `Constants.eliminate_map_lookup`
+    and before common subexpression elimination, which would make the
+    rules depend on each other. Rules that feed nothing are left out.
+    """
+    statements = split_expressions(bytecode, INDEXED_PURE_ARITY)
+    rules = []
+    idx = 0
+    while idx < len(statements):
+        condition = statements[idx]
+        if not isinstance(condition, Expression):
+            raise RuntimeError('Expected a condition, got {}'.format(
+                condition.car))
+        feeds = []
+        idx += 1
+        while True:
+            if idx == len(statements) or isinstance(
+                    statements[idx], Expression):
+                raise RuntimeError('Rule without %pop')
+            instruction = statements[idx]
+            idx += 1
+            head = instruction.car
+            if (head is SYM_FEED_DEFUZZER_FAST
+                    or head is SYM_FEED_DEFUZZER_FAST_POP):
+                feeds.append((instruction.cdr.car, instruction.cdr.cdr.car))
+            elif head is not SYM_POP:
+                raise RuntimeError('Unexpected instruction {}'.format(head))
+            if head is SYM_POP or head is SYM_FEED_DEFUZZER_FAST_POP:
+                break
+        if feeds:
+            rules.append(Rule(condition, tuple(feeds)))
+    return rules
+
+
+class RuleIndex:
+    """An inverted index from each membership (a slot of `member_functions`)
+    to the rules that can fire when it is nonzero.
+
+    Memberships are never negative, so %min is nonzero only if all of its
+    operands are, and %max only if one of them is. The trigger of a rule
+    is a set of memberships of which at least one is nonzero whenever the
+    condition is: the trigger of one operand of a %min (the smallest), or
+    the union of the triggers of the operands of a %max. A rule is indexed
+    under every membership of its trigger.
+    """
+    def __init__(self, bytecode, member_functions):
+        self.slots = {id(f): i for i, f in enumerate(member_functions)}
+        self.rules = split_rules(bytecode)
+        # slot: input index, for every membership in the conditions
+        self.inputs = {}
+        # slot: [(rule, slots of the trigger that come before it)], so that
+        # a rule is evaluated under the first nonzero one only
+        self.triggers = {}
+        for rule in self.rules:
+            trigger = sorted(self._trigger(rule.condition))
+            for k, slot in enumerate(trigger):
+                self.triggers.setdefault(slot, []).append(
+                    (rule, tuple(trigger[:k])))
+
+    def membership_slot(self, expression):
+        operand = expression.operands[0] if expression.operands else None
+        if (operand is None
+                or operand.instruction.car is not SYM_GET_INPUT_BY_INDEX):
+            raise RuntimeError('Membership of something else than an input')
+        slot = self.slots[id(expression.instruction.cdr.car)]
+        self.inputs[slot] = operand.instruction.cdr.car
+        return slot
+
+    def _trigger(self, expression):
+        head = expression.instruction.car
+        if head is SYM_CALL_FUNCTION_BY_REF:
+            return frozenset((self.membership_slot(expression),))
+        triggers = [self._trigger(e) for e in expression.operands]
+        if head is SYM_MIN:
+            return min(triggers, key=len)
+        if head is SYM_MAX:
+            return frozenset().union(*triggers)
+        raise RuntimeError('Unexpected instruction {}'.format(head))
+
+    def candidates(self, active):
+        """The number of rules evaluated when the memberships in `active`
+        are nonzero
+        """
+        count = 0
+        for slot in active:
+            for _, earlier in self.triggers.get(slot, ()):
+                if not any(s in active for s in earlier):
+                    count += 1
+        return count
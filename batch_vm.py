@@ -0,0 +1,122 @@
+from functools import reduce
+
+import numpy as np
+
+import fuzzy
+import vm
+
+def membership(function, x):
+    """`fuzzy.TriangleFunction.__call__` for an array of integers"""
+    rising = function.M * (x - function.x1) // function.k1_denominator
+    falling = function.M * (x - function.x3) // function.k2_denominator
+    result = np.where(x <= function.x2, rising, falling)
+    result[(x <= function.x1) | (x >= function.x3)] = 0
+    return result
+
+class BatchVM:
+    """Runs the program of a `vm.VM` on many input vectors at once.
+
+        machine = BatchVM(inputs, outputs, 'rule.scm')
+        result = machine.run({'dir-x': xs, 'dir-y': ys, 'dist': ds})
+        result['dx']  # one output for each (xs[i], ys[i], ds[i])
+
+    Memberships, min/max and the defuzzers work on NumPy integer arrays,
+    with the same integer arithmetic (floor division) as `fuzzy`, so the
+    results are exactly those of `VM.run` on each input vector.
+    """
+    def __init__(self, inputs, outputs, rule_path, **kwargs):
+        self.machine = vm.VM(inputs, outputs, rule_path, **kwargs)
+
+    def _values(self, inputs):
+        values = [None] * len(self.machine.input_to_index)
+        shape = None
+        for key, index in self.machine.input_to_index.items():
+            array = np.asarray(inputs[key])
+            if not np.issubdtype(array.dtype, np.integer):
+                raise ValueError(
+                    'Input {} is not an integer array'.format(key))
+            array = array.astype(np.int64)
+            if shape is not None and array.shape != shape:
+                raise ValueError('Inputs have different shapes')
+            shape = array.shape
+            values[index] = array
+        return values, shape
+
+    def run(self, inputs):
+        """`inputs` maps input names to arrays of the same shape.
+        Returns a dictionary from output names to arrays of that shape.
+        """
+        values, shape = self._values(inputs)
+        sums = [np.zeros(shape, np.int64)
+                for _ in range(len(self.machine.levels))]
+        temporaries = {}
+        stack = []
+
+        bcbuf = self.machine.bcbuf
+        idx = 0
+        while idx < len(bcbuf):
+            ins = bcbuf[idx]
+            if ins == vm.POP:
+                stack.pop()
+            elif ins == vm.MIN:
+                stack.append(np.minimum(stack.pop(), stack.pop()))
+            elif ins == vm.MAX:
+                stack.append(np.maximum(stack.pop(), stack.pop()))
+            elif ins == vm.GET_INPUT_BY_INDEX:
+                stack.append(values[bcbuf[idx + 1]])
+            elif ins == vm.CALL_FUNCTION_BY_REF:
+                function = self.machine.member_functions[bcbuf[idx + 1]]
+                stack.append(membership(function, stack.pop()))
+            elif ins == vm.MEMBERSHIP_OF_INPUT:
+                function = self.machine.member_functions[bcbuf[idx + 2]]
+                stack.append(membership(function, values[bcbuf[idx + 1]]))
+            elif (ins == vm.FEED_DEFUZZER_FAST
+                  or ins == vm.FEED_DEFUZZER_FAST_POP):
+                sums[bcbuf[idx + 1]] += stack[-1]
+                if ins == vm.FEED_DEFUZZER_FAST_POP:
+                    stack.pop()
+            elif ins == vm.STORE:
+                temporaries[bcbuf[idx + 1]] = stack[-1]
+            elif ins == vm.LOAD:
+                stack.append(temporaries[bcbuf[idx + 1]])
+            elif ins == vm.MIN_N or ins == vm.MAX_N:
+                n = bcbuf[idx + 1]
+                operands = stack[len(stack) - n:]
+                del stack[len(stack) - n:]
+                function = np.minimum if ins == vm.MIN_N else np.maximum
+                stack.append(reduce(function, operands))
+            else:
+                raise RuntimeError('Unknown instruction {}'.format(ins))
+            idx += vm.LENGTHS[ins]
+
+        return {
+            key: self._defuzz(index, sums, shape)
+            for key, index in self.machine.output_to_index.items()
+        }
+
+    def _defuzz(self, output, sums, shape):
+        """`fuzzy.DefuzzerBank.defuzz` for arrays of sums"""
+        bank = self.machine.bank
+        levels = bank.outputs[output]
+        numerator = np.zeros(shape, np.int64)
+        denominator = np.zeros(shape, np.int64)
+        if bank.method == 'weighted-average':
+            for k, x2 in levels:
+                numerator += x2 * sums[k]
+                denominator += sums[k]
+            return numerator // np.maximum(1, denominator)
+
+        heights = [np.minimum(sums[k], fuzzy.TriangleFunction.M)
+                   for k, _ in levels]
+        if bank.method == 'centroid':
+            for height, (_, (area, moment, _, _)) in zip(heights, levels):
+                numerator += np.asarray(moment)[height]
+                denominator += np.asarray(area)[height]
+            return numerator // np.maximum(1, denominator)
+
+        height = reduce(np.maximum, heights, np.zeros(shape, np.int64))
+        for level_height, (_, (_, _, count, total)) in zip(heights, levels):
+            top = (level_height == height) & (height > 0)
+            numerator += np.where(top, np.asarray(total)[level_height], 0)
+            denominator += np.where(top, np.asarray(count)[level_height], 0)
+        return numerator // np.maximum(1, denominator)
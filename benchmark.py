@@ -0,0 +1,791 @@
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bytecode_cache
+import bytecode_compiler
+import control_surface
+import dsl_parser
+import fuzzy
+import incremental
+import optimizer
+import tracing
+import transform
+import vm
+
+INPUT_LEVELS = {
+    'dir-x': ('NM', 'NS', 'Z', 'PS', 'PM'),
+    'dir-y': ('NM', 'NS', 'Z', 'PS', 'PM'),
+    'dist': ('Z', 'PS', 'PM'),
+}
+OUTPUT_LEVELS = {
+    'dx': ('NM', 'NS', 'Z', 'PS', 'PM'),
+    'dy': ('NM', 'NS', 'Z', 'PS', 'PM'),
+    'rot': ('NM', 'Z', 'PM'),
+}
+
+
+def membership_functions(domain=None):
+    """The (inputs, outputs) of the camera in game.py"""
+    direction = ((-1500, -500), (-600, -10), (-100, 100), (10, 600),
+                 (500, 1500))
+    speed = ((-30, -15), (-20, -5), (-9, 9), (5, 20), (15, 30))
+    inputs = {
+        'dir-x': fuzzy.FiveLevels(*direction, domain=domain),
+        'dir-y': fuzzy.FiveLevels(*direction, domain=domain),
+        'dist': fuzzy.ThreeLevelsPositive((-10, 300), (250, 700),
+                                          (600, 1500), domain=domain),
+    }
+    outputs = {
+        'dx': fuzzy.FiveLevels(*speed),
+        'dy': fuzzy.FiveLevels(*speed),
+        'rot': fuzzy.ThreeLevels((-100, -50), (-50, 50), (50, 100)),
+    }
+    return inputs, outputs
+
+
+def recorded_inputs(count=200, seed=0):
+    rng = random.Random(seed)
+    return [(rng.randint(-1500, 1500), rng.randint(-1500, 1500),
+             rng.randint(0, 1500))
+            for _ in range(count)]
+
+
+def run_vm(machine, samples):
+    """Run `machine` on every (dir-x, dir-y, dist) sample and return the
+    outputs
+    """
+    result = []
+    for x, y, dist in samples:
+        machine.input('dir-x', x)
+        machine.input('dir-y', y)
+        machine.input('dist', dist)
+        machine.run()
+        result.append((machine.get_output('dx'), machine.get_output('dy'),
+                       machine.get_output('rot')))
+    return result
+
+
+def _random_is(rng):
+    name = rng.choice(sorted(INPUT_LEVELS))
+    return '(is %s %s)' % (name, rng.choice(INPUT_LEVELS[name]))
+
+
+def _random_condition(rng, depth=0):
+    if depth >= 2 or rng.random() < 0.5:
+        return _random_is(rng)
+    operands = [_random_condition(rng, depth + 1)
+                for _ in range(rng.randint(2, 3))]
+    return '(%s %s)' % (rng.choice(('and', 'or')), ' '.join(operands))
+
+
+def _random_action(rng):
+    actions = []
+    for _ in range(rng.randint(1, 3)):
+        name = rng.choice(sorted(OUTPUT_LEVELS))
+        level = rng.choice(OUTPUT_LEVELS[name])
+        actions.append('(set! %s %s)' % (name, level))
+    return '(begin %s)' % ' '.join(actions)
+
+
+def generate_rules(count, seed=0):
+    """Return the source of a synthetic rule base with `count` top-level
+    forms, written in the same dialect as rule.scm.
+    """
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        lines.append(';; generated rule %d' % i)
+        if rng.random() < 0.3:
+            nested = ' '.join(
+                '(if %s %s)' % (_random_condition(rng), _random_action(rng))
+                for _ in range(rng.randint(1, 3))
+            )
+            lines.append('(if %s (begin %s))' % (_random_is(rng), nested))
+        else:
+            lines.append('(if %s %s)'
+                         % (_random_condition(rng), _random_action(rng)))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def timeit(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_tokenizer(count=20000):
+    source = generate_rules(count)
+    modes = dsl_parser.Tokenizer.Mode
+
+    def tokens(mode):
+        result = []
+        tokenizer = dsl_parser.Tokenizer(
+            result.append,
+            lambda: result.append('('),
+            lambda: result.append(')'),
+            mode
+        )
+        tokenizer.tokenize(io.BytesIO(source))
+        return result
+
+    if tokens(modes.per_character) != tokens(modes.bulk):
+        raise RuntimeError('Tokenizer modes disagree')
+
+    print('tokenizer: %d forms, %d bytes' % (count, len(source)))
+    for mode in modes:
+        elapsed = timeit(lambda: tokens(mode))
+        print('  %-14s %8.3f s' % (mode.name, elapsed))
+
+
+def count_match_attempts(func):
+    """Run `func`, counting the calls of `Transform._try_transform`.
+    Returns (result, attempts, successes).
+    """
+    original = transform.Transform._try_transform
+    counter = [0, 0]
+
+    def counting(self, sexp):
+        counter[0] += 1
+        result = original(self, sexp)
+        if result is not transform.UNCHANGED:
+            counter[1] += 1
+        return result
+
+    transform.Transform._try_transform = counting
+    try:
+        result = func()
+    finally:
+        transform.Transform._try_transform = original
+    return result, counter[0], counter[1]
+
+
+def bench_rule_index(count=2000):
+    source = generate_rules(count)
+    sexp = dsl_parser.SchemeParser().parse(io.BytesIO(source))
+    passes = (('sequential', bytecode_compiler.sequential_pass),
+              ('indexed', bytecode_compiler.indexed_pass))
+
+    print('rule index: compile %d forms' % count)
+    results = []
+    for name, run_pass in passes:
+        def compile_program():
+            return bytecode_compiler.compile_to_bytecode(sexp, run_pass)
+
+        bytecode, attempts, _ = count_match_attempts(compile_program)
+        results.append(bytecode)
+        print('  %-10s %8.3f s %10d match attempts' % (
+            name, timeit(compile_program, 1), attempts))
+
+    if dsl_parser.to_tuple(results[0]) != dsl_parser.to_tuple(results[1]):
+        raise RuntimeError('Indexed and sequential passes disagree')
+
+
+def generate_nested_rules(count, width, seed=0):
+    """Return the source of `count` top-level forms, each one an `if` whose
+    body holds `width` nested `if` forms, which is the worst case for the
+    if-lifting pass
+    """
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        nested = ' '.join(
+            '(if %s %s)' % (_random_condition(rng), _random_action(rng))
+            for _ in range(width)
+        )
+        lines.append('(if %s (begin %s))' % (_random_is(rng), nested))
+    return '\n'.join(lines).encode('utf-8')
+
+
+def bench_normalizer(count=2000, nested_count=10, width=200):
+    passes = (('sequential', bytecode_compiler.sequential_pass),
+              ('indexed', bytecode_compiler.indexed_pass),
+              ('normalizing', bytecode_compiler.normalizing_pass))
+    inputs = (
+        ('%d generated forms' % count, generate_rules(count)),
+        ('%d forms with %d nested ifs' % (nested_count, width),
+         generate_nested_rules(nested_count, width)),
+    )
+
+    for title, source in inputs:
+        sexp = dsl_parser.SchemeParser().parse(io.BytesIO(source))
+        print('normalizer: %s' % title)
+        results = []
+        for name, run_pass in passes:
+            def compile_program():
+                return bytecode_compiler.compile_to_bytecode(sexp, run_pass)
+
+            results.append(dsl_parser.to_tuple(compile_program()))
+            print('  %-12s %8.3f s' % (name, timeit(compile_program, 1)))
+        if any(result != results[0] for result in results):
+            raise RuntimeError('Rewriting strategies disagree')
+
+
+def bench_compiled_patterns(count=2000):
+    source = generate_rules(count)
+    sexp = dsl_parser.SchemeParser().parse(io.BytesIO(source))
+
+    print('compiled patterns: compile %d forms' % count)
+    try:
+        for name, compiled in (('interpreted', False), ('compiled', True)):
+            bytecode_compiler.load_transforms(
+                bytecode_compiler.TRANSFORM_PATH, compiled)
+            elapsed = timeit(
+                lambda: bytecode_compiler.compile_to_bytecode(sexp))
+            print('  %-12s %8.3f s %10.0f forms/s' % (
+                name, elapsed, count / elapsed))
+    finally:
+        bytecode_compiler.init()
+
+
+def bench_parallel(count=4000, processes=(1, 2, 4)):
+    source = generate_rules(count)
+    sexp = dsl_parser.SchemeParser().parse(io.BytesIO(source))
+
+    print('parallel: compile %d forms' % count)
+    expected = dsl_parser.to_tuple(bytecode_compiler.compile_to_bytecode(sexp))
+    elapsed = timeit(lambda: bytecode_compiler.compile_to_bytecode(sexp), 1)
+    print('  %-12s %8.3f s' % ('serial', elapsed))
+    for n in processes:
+        def compile_program():
+            return bytecode_compiler.compile_to_bytecode(sexp, processes=n)
+
+        if dsl_parser.to_tuple(compile_program()) != expected:
+            raise RuntimeError('Parallel and serial compilation disagree')
+        elapsed = timeit(compile_program, 1)
+        print('  %-12s %8.3f s' % ('%d processes' % n, elapsed))
+
+
+def bench_allocations(counts=(500, 1000, 2000), widths=(50, 100, 200)):
+    passes = (('sequential', bytecode_compiler.sequential_pass),
+              ('normalizing', bytecode_compiler.normalizing_pass))
+    inputs = [('%d generated forms' % count, generate_rules(count))
+              for count in counts]
+    inputs += [('10 forms with %d nested ifs' % width,
+                generate_nested_rules(10, width))
+               for width in widths]
+
+    print('allocations: Cons cells allocated by compile_to_bytecode')
+    for title, source in inputs:
+        with dsl_parser.AllocationCounter() as counter:
+            sexp = dsl_parser.SchemeParser().parse(io.BytesIO(source))
+        print('  %s (%d cells parsed)' % (title, counter.count))
+
+        for name, run_pass in passes:
+            with dsl_parser.AllocationCounter() as counter:
+                _, _, rewrites = count_match_attempts(
+                    lambda: bytecode_compiler.compile_to_bytecode(
+                        sexp, run_pass))
+            print('    %-12s %9d cells %7d rewrites %6.1f cells/rewrite' % (
+                name, counter.count, rewrites, counter.count / rewrites))
+
+
+def bench_bytecode_cache(count=2000):
+    source = generate_rules(count)
+
+    print('bytecode cache: load %d forms' % count)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        rule_path = os.path.join(cache_dir, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(source)
+
+        start = time.perf_counter()
+        bytecode = bytecode_cache.load_or_compile(rule_path, cache_dir)
+        cold = time.perf_counter() - start
+        warm = timeit(
+            lambda: bytecode_cache.load_or_compile(rule_path, cache_dir))
+        cached = bytecode_cache.load_or_compile(rule_path, cache_dir)
+        if dsl_parser.to_tuple(cached) != dsl_parser.to_tuple(bytecode):
+            raise RuntimeError('Cached bytecode differs')
+
+        size = sum(os.path.getsize(os.path.join(cache_dir, name))
+                   for name in os.listdir(cache_dir)
+                   if name.endswith('.fzbc'))
+        print('  %-6s %8.3f s' % ('cold', cold))
+        print('  %-6s %8.3f s (%d bytes cached)' % ('warm', warm, size))
+
+
+def count_instructions(bytecode, symbol):
+    result = 0
+    while bytecode is not None:
+        if bytecode.car.car is symbol:
+            result += 1
+        bytecode = bytecode.cdr
+    return result
+
+
+def bench_cse(counts=(2000, 10000), samples=50):
+    inputs = [('rule.scm', None)]
+    inputs += [('%d generated forms' % count, generate_rules(count))
+               for count in counts]
+    recorded = recorded_inputs(samples)
+
+    print('cse: common subexpression elimination')
+    with tempfile.TemporaryDirectory() as directory:
+        for title, source in inputs:
+            rule_path = 'rule.scm'
+            if source is not None:
+                rule_path = os.path.join(directory, 'rules.scm')
+                with open(rule_path, 'wb') as fd:
+                    fd.write(source)
+
+            print('  %s' % title)
+            results = []
+            for name, optimizations in (('plain', ()), ('cse', ('cse',))):
+                machine = vm.VM(*membership_functions(), rule_path,
+                                cache_dir=directory,
+                                optimizations=optimizations)
+                results.append(run_vm(machine, recorded))
+                calls = count_instructions(
+                    machine.bytecode,
+                    bytecode_compiler.SYM_CALL_FUNCTION_BY_REF)
+                elapsed = timeit(lambda: run_vm(machine, recorded))
+                print('    %-6s %7d instructions %8d words %7d calls/run '
+                      '%9.1f us/run' % (
+                          name, len(machine.bytecode), len(machine.bcbuf),
+                          calls, elapsed / samples * 1e6))
+            if results[0] != results[1]:
+                raise RuntimeError('CSE changed the outputs')
+
+
+def bench_optimizer(count=2000, samples=50):
+    recorded = [{'dir-x': x, 'dir-y': y, 'dist': dist}
+                for x, y, dist in recorded_inputs(samples)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        rule_path = os.path.join(directory, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(generate_rules(count))
+
+        for title, path in (('rule.scm', 'rule.scm'),
+                            ('%d generated forms' % count, rule_path)):
+            vm.check_outputs(*membership_functions(), path, recorded,
+                             optimizer.DEFAULT_PIPELINE)
+            machine = vm.VM(*membership_functions(), path,
+                            cache_dir=directory)
+            print('optimizer: %s (outputs identical)' % title)
+            for stats in machine.optimizer_stats:
+                print('  %-15s %7d -> %7d instructions %8d -> %8d words '
+                      '%8.3f s' % (
+                          stats.name, stats.instructions_before,
+                          stats.instructions_after, stats.words_before,
+                          stats.words_after, stats.seconds))
+
+
+def bench_hot_reload(count=2000):
+    source = generate_rules(count)
+
+    print('hot reload: %d forms, one form edited' % count)
+    with tempfile.TemporaryDirectory() as directory:
+        rule_path = os.path.join(directory, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(source)
+
+        start = time.perf_counter()
+        machine = vm.VM(*membership_functions(), rule_path, watch=True,
+                        poll_interval=0)
+        print('  %-8s %8.3f s' % ('initial', time.perf_counter() - start))
+
+        with open(rule_path, 'ab') as fd:
+            fd.write(b'\n(if (is dist Z) (set! rot PM))')
+        st = os.stat(rule_path)
+        os.utime(rule_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+        cache = machine.form_cache
+        hits, misses = cache.hits, cache.misses
+        start = time.perf_counter()
+        run_vm(machine, recorded_inputs(1))
+        if machine.reload_error is not None:
+            raise machine.reload_error
+        print('  %-8s %8.3f s (%d forms reused, %d compiled)' % (
+            'reload', time.perf_counter() - start,
+            cache.hits - hits, cache.misses - misses))
+
+
+def bench_engines(count=2000, samples=200):
+    recorded = recorded_inputs(samples)
+
+    with tempfile.TemporaryDirectory() as directory:
+        rule_path = os.path.join(directory, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(generate_rules(count))
+
+        for title, path in (('rule.scm', 'rule.scm'),
+                            ('%d generated forms' % count, rule_path)):
+            print('engines: %s' % title)
+            results = []
+            for engine in vm.ENGINES:
+                start = time.perf_counter()
+                machine = vm.VM(*membership_functions(), path,
+                                cache_dir=directory, engine=engine)
+                setup = time.perf_counter() - start
+                results.append(run_vm(machine, recorded))
+                elapsed = timeit(lambda: run_vm(machine, recorded))
+                print('  %-12s %9.1f us/run %8.3f s to load' % (
+                    engine, elapsed / samples * 1e6, setup))
+            if any(result != results[0] for result in results):
+                raise RuntimeError('Engines disagree')
+
+
+def bench_batch(count=10000):
+    try:
+        import numpy as np
+        import batch_vm
+    except ImportError:
+        print('batch: skipped, NumPy is not installed')
+        return
+
+    samples = recorded_inputs(count)
+    columns = [np.array(column) for column in zip(*samples)]
+    machine = vm.VM(*membership_functions(), 'rule.scm', engine='codegen')
+    batch = batch_vm.BatchVM(*membership_functions(), 'rule.scm')
+
+    def run_batch():
+        return batch.run(dict(zip(('dir-x', 'dir-y', 'dist'), columns)))
+
+    result = run_batch()
+    outputs = list(zip(*(result[key].tolist() for key in ('dx', 'dy', 'rot'))))
+    if outputs != run_vm(machine, samples):
+        raise RuntimeError('BatchVM and VM disagree')
+
+    print('batch: rule.scm on %d input vectors' % count)
+    print('  %-12s %8.3f s' % ('VM codegen', timeit(
+        lambda: run_vm(machine, samples))))
+    print('  %-12s %8.3f s' % ('BatchVM', timeit(run_batch)))
+
+
+def bench_lookup_tables(samples=2000, domain=(-1024, 1024)):
+    rng = random.Random(0)
+    recorded = [(rng.randint(*domain), rng.randint(*domain),
+                 rng.randint(0, domain[1]))
+                for _ in range(samples)]
+
+    print('lookup tables: rule.scm, inputs in %s' % (domain,))
+    results = []
+    for engine in vm.ENGINES:
+        for name, tables in (('arithmetic', None), ('tables', domain)):
+            machine = vm.VM(*membership_functions(tables), 'rule.scm',
+                            engine=engine)
+            results.append(run_vm(machine, recorded))
+            elapsed = timeit(lambda: run_vm(machine, recorded))
+            print('  %-12s %-11s %8.1f us/run' % (
+                engine, name, elapsed / samples * 1e6))
+    if any(result != results[0] for result in results):
+        raise RuntimeError('Lookup tables changed the outputs')
+
+
+def bench_instances(count=10000, vm_count=10, samples=200):
+    recorded = recorded_inputs(samples)
+
+    print('instances: rule.scm')
+    for engine in vm.ENGINES:
+        def spawn_vms():
+            return [vm.VM(*membership_functions(), 'rule.scm', engine=engine)
+                    for _ in range(vm_count)]
+
+        def spawn_instances():
+            program = vm.Program(*membership_functions(), 'rule.scm',
+                                 engine=engine)
+            return program, [program.instance() for _ in range(count)]
+
+        for title, spawn, spawned in (('VM', spawn_vms, vm_count),
+                                      ('VMInstance', spawn_instances, count)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = spawn()
+            elapsed = time.perf_counter() - start
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print('  %-12s %-10s x%-6d %8.1f us %8d bytes each' % (
+                engine, title, spawned, elapsed / spawned * 1e6,
+                size // spawned))
+
+        machine = vm.VM(*membership_functions(), 'rule.scm', engine=engine)
+        instance = result[1][0]
+        expected = run_vm(machine, recorded)
+        if run_vm(instance, recorded) != expected:
+            raise RuntimeError('VMInstance disagrees with VM')
+        for title, runner in (('VM', machine), ('VMInstance', instance)):
+            elapsed = timeit(lambda: run_vm(runner, recorded))
+            print('  %-12s %-10s %17.1f us/run' % (
+                engine, title, elapsed / samples * 1e6))
+
+
+def generate_deep_rule(depth, seed=0):
+    """Return the source of one `if` whose condition is `depth` nested
+    `and` forms, (and m1 (and m2 ...)), which needs a stack of `depth`
+    values
+    """
+    rng = random.Random(seed)
+    condition = _random_is(rng)
+    for _ in range(depth):
+        condition = '(and %s %s)' % (_random_is(rng), condition)
+    return ('(if %s %s)' % (condition, _random_action(rng))).encode('utf-8')
+
+
+def bench_superinstructions(count=2000, depth=40, samples=200):
+    """The default encoding against the same program without
+    %membership-of-input, encoded in a list
+    """
+    recorded = recorded_inputs(samples)
+    unfused = tuple(name for name in optimizer.DEFAULT_PIPELINE
+                    if name != 'fuse-membership')
+
+    with tempfile.TemporaryDirectory() as directory:
+        rule_path = os.path.join(directory, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(generate_rules(count))
+        deep_path = os.path.join(directory, 'deep.scm')
+        with open(deep_path, 'wb') as fd:
+            fd.write(generate_deep_rule(depth))
+
+        for title, path in (('rule.scm', 'rule.scm'),
+                            ('%d generated forms' % count, rule_path),
+                            ('%d nested ands' % depth, deep_path)):
+            print('superinstructions: %s' % title)
+            for engine in vm.ENGINES:
+                results = []
+                for name, optimizations in (('list', unfused),
+                                            ('array', None)):
+                    if optimizations is None:
+                        machine = vm.VM(*membership_functions(), path,
+                                        cache_dir=directory, engine=engine)
+                    else:
+                        machine = vm.VM(*membership_functions(), path,
+                                        cache_dir=directory, engine=engine,
+                                        optimizations=optimizations)
+                        machine.bcbuf = list(machine.bcbuf)
+                    results.append(run_vm(machine, recorded))
+                    elapsed = timeit(lambda: run_vm(machine, recorded))
+                    print('  %-12s %-6s %7d instructions %7d bytes '
+                          'stack %3d %9.1f us/run' % (
+                              engine, name, len(machine.bytecode),
+                              sys.getsizeof(machine.bcbuf),
+                              len(machine.stack), elapsed / samples * 1e6))
+                if results[0] != results[1]:
+                    raise RuntimeError('Superinstructions changed the '
+                                       'outputs')
+
+
+def bench_tracing(samples=200):
+    recorded = recorded_inputs(samples)
+
+    print('tracing: rule.scm')
+    machine = vm.VM(*membership_functions(), 'rule.scm')
+    traced = tracing.TracingVM(*membership_functions(), 'rule.scm')
+    if run_vm(traced, recorded) != run_vm(machine, recorded):
+        raise RuntimeError('TracingVM disagrees with VM')
+    for title, runner in (('VM', machine), ('TracingVM', traced)):
+        elapsed = timeit(lambda: run_vm(runner, recorded))
+        print('  %-12s %8.1f us/run' % (title, elapsed / samples * 1e6))
+
+
+def bench_active_rules(counts=(500, 2000, 8000), samples=200):
+    recorded = recorded_inputs(samples)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts:
+            rule_path = os.path.join(directory, 'rules%d.scm' % count)
+            with open(rule_path, 'wb') as fd:
+                fd.write(generate_rules(count))
+
+            results = []
+            for engine in ('codegen', 'active'):
+                machine = vm.VM(*membership_functions(), rule_path,
+                                cache_dir=directory, engine=engine)
+                results.append(run_vm(machine, recorded))
+                elapsed = timeit(lambda: run_vm(machine, recorded))
+                print('active rules: %5d forms %-8s %9.1f us/run' % (
+                    count, engine, elapsed / samples * 1e6))
+            if results[0] != results[1]:
+                raise RuntimeError('The active rule index changed the '
+                                   'outputs')
+
+            index = machine.rule_index
+            evaluated = 0
+            for sample in recorded:
+                values = [None] * len(sample)
+                for name, value in zip(('dir-x', 'dir-y', 'dist'), sample):
+                    values[machine.input_to_index[name]] = value
+                active = [slot for slot, i in index.inputs.items()
+                          if machine.member_functions[slot](values[i])]
+                evaluated += index.candidates(active)
+            print('  %d rules, %.1f evaluated per run' % (
+                len(index.rules), evaluated / samples))
+
+
+def bench_incremental(count=2000, samples=200):
+    rng = random.Random(0)
+    x, y, dist = recorded_inputs(1)[0]
+    scenarios = (
+        ('still', [(x, y, dist)] * samples),
+        ('dist changes', [(x, y, rng.randint(0, 1500))
+                          for _ in range(samples)]),
+        ('all change', recorded_inputs(samples)),
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        rule_path = os.path.join(directory, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(generate_rules(count))
+
+        for title, path in (('rule.scm', 'rule.scm'),
+                            ('%d generated forms' % count, rule_path)):
+            print('incremental: %s' % title)
+            machines = (
+                ('codegen', vm.VM(*membership_functions(), path,
+                                  cache_dir=directory, engine='codegen')),
+                ('incremental', incremental.IncrementalVM(
+                    *membership_functions(), path)),
+                ('full', incremental.IncrementalVM(
+                    *membership_functions(), path, full=True)),
+            )
+            for name, recorded in scenarios:
+                results = []
+                for engine, machine in machines:
+                    results.append(run_vm(machine, recorded))
+                    elapsed = timeit(lambda: run_vm(machine, recorded))
+                    print('  %-13s %-12s %9.1f us/run' % (
+                        name, engine, elapsed / samples * 1e6))
+                if any(result != results[0] for result in results):
+                    raise RuntimeError('Incremental evaluation changed the '
+                                       'outputs')
+
+
+def bench_defuzzers(count=2000, samples=200):
+    with tempfile.TemporaryDirectory() as directory:
+        rule_path = os.path.join(directory, 'rules.scm')
+        with open(rule_path, 'wb') as fd:
+            fd.write(generate_rules(count))
+
+        recorded = recorded_inputs(samples)
+        for title, path in (('rule.scm', 'rule.scm'),
+                            ('%d generated forms' % count, rule_path)):
+            print('defuzzers: %s' % title)
+            for method in fuzzy.DEFUZZIFICATIONS:
+                for engine in vm.ENGINES:
+                    machine = vm.VM(*membership_functions(), path,
+                                    cache_dir=directory, engine=engine,
+                                    defuzzification=method)
+                    elapsed = timeit(lambda: run_vm(machine, recorded))
+                    print('  %-16s %-11s %9.1f us/run' % (
+                        method, engine, elapsed / samples * 1e6))
+
+
+def bench_control_surface(steps=(64, 32), samples=5000,
+                          domain=(-1024, 1024)):
+    rng = random.Random(0)
+    recorded = [(rng.randint(*domain), rng.randint(*domain),
+                 rng.randint(0, domain[1]))
+                for _ in range(samples)]
+    inputs, outputs = membership_functions(domain)
+    program = vm.Program(inputs, outputs, 'rule.scm', engine='codegen')
+    machine = program.instance()
+
+    for step in steps:
+        for probes in (1, 2):
+            axes = (
+                control_surface.axis('dir-x', domain[0], domain[1], step),
+                control_surface.axis('dir-y', domain[0], domain[1], step),
+                control_surface.axis('dist', 0, domain[1], step),
+            )
+            start = time.perf_counter()
+            surface = control_surface.ControlSurface.build(
+                machine, axes, tuple(outputs), probes=probes)
+            elapsed = time.perf_counter() - start
+            size = len(surface.encode())
+            for max_sampled_error in (None, 2):
+                surface.max_sampled_error = max_sampled_error
+                print('control surface: rule.scm, step %d, probes/cell %d, '
+                      'max sampled error %s (%d KB, built in %.1f s)' % (
+                          step, probes ** 3, max_sampled_error, size // 1024,
+                          elapsed))
+                for line in control_surface.report(
+                        surface, machine, recorded).splitlines():
+                    print('  ' + line)
+
+
+IMPORT_TIME_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import vm
+imported = time.perf_counter()
+vm.bytecode_compiler.CODE_CACHE_PATH = sys.argv[1]
+vm.bytecode_compiler.ensure_transforms()
+print(imported - start, time.perf_counter() - imported)
+'''
+
+
+def bench_import_time(repeat=5):
+    """Import `vm` in fresh interpreters, then load transform.scm with and
+    without the saved code of its patterns. The code is saved to a
+    temporary file, not to `bytecode_compiler.CODE_CACHE_PATH`.
+    """
+    def measure(path, code_cache):
+        best = None
+        for _ in range(repeat):
+            if not code_cache and os.path.exists(path):
+                os.remove(path)
+            output = subprocess.run(
+                [sys.executable, '-c', IMPORT_TIME_SCRIPT, path],
+                cwd=bytecode_compiler.PACKAGE_DIR, check=True,
+                capture_output=True, text=True
+            ).stdout
+            times = tuple(float(t) for t in output.split())
+            if best is None or times < best:
+                best = times
+        return best
+
+    print('import time: import vm, then load transform.scm')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'transform.marshal')
+        for title, code_cache in (('no code cache', False),
+                                  ('code cache', True)):
+            import_time, load_time = measure(path, code_cache)
+            print('  %-14s %8.1f ms import %8.1f ms load' % (
+                title, import_time * 1000, load_time * 1000))
+
+
+BENCHMARKS = {
+    'tokenizer': bench_tokenizer,
+    'rule-index': bench_rule_index,
+    'normalizer': bench_normalizer,
+    'compiled-patterns': bench_compiled_patterns,
+    'parallel': bench_parallel,
+    'allocations': bench_allocations,
+    'bytecode-cache': bench_bytecode_cache,
+    'cse': bench_cse,
+    'optimizer': bench_optimizer,
+    'hot-reload': bench_hot_reload,
+    'import-time': bench_import_time,
+    'engines': bench_engines,
+    'batch': bench_batch,
+    'lookup-tables': bench_lookup_tables,
+    'instances': bench_instances,
+    'superinstructions': bench_superinstructions,
+    'tracing': bench_tracing,
+    'active-rules': bench_active_rules,
+    'incremental': bench_incremental,
+    'defuzzers': bench_defuzzers,
+    'control-surface': bench_control_surface,
+}
+
+
+def main(argv):
+    names = argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
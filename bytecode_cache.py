@@ -0,0 +1,185 @@
+"""On-disk cache of compiled rule files.
+
+The output of `bytecode_compiler.compile_to_bytecode` is stored as a
+header, a table of symbols, a table of (variable, level) references for
+%call-member-function / %feed, and an array of opcodes and operands.
+Cache files are named after a hash of the rule file and transform.scm,
+so editing either one misses the cache.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import bytecode_compiler
+from dsl_parser import Accumulator, Cons, SchemeParser, intern
+
+MAGIC = b'FZBC'
+VERSION = 1
+HEADER = struct.Struct('<4sHIII')
+SYMBOL_LENGTH = struct.Struct('<H')
+
+# opcode: (symbol, operand)
+# operand is None, 'symbol' (index into symbols) or 'ref' (index into refs)
+POP = 1
+MIN = 2
+MAX = 3
+GET_INPUT = 4
+CALL_MEMBER_FUNCTION = 5
+FEED = 6
+
+OPCODES = {
+    POP: (bytecode_compiler.SYM_POP, None),
+    MIN: (bytecode_compiler.SYM_MIN, None),
+    MAX: (bytecode_compiler.SYM_MAX, None),
+    GET_INPUT: (bytecode_compiler.SYM_GET_INPUT, 'symbol'),
+    CALL_MEMBER_FUNCTION: (bytecode_compiler.SYM_CALL_MEMBER_FUNCTION, 'ref'),
+    FEED: (bytecode_compiler.SYM_FEED, 'ref'),
+}
+OPCODE_OF_SYMBOL = {symbol: opcode
+                    for opcode, (symbol, _) in OPCODES.items()}
+
+
+def _little_endian(words):
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+
+def encode(bytecode):
+    """Encode a list of symbolic instructions to bytes"""
+    symbols = {}
+    refs = {}
+    code = array('i')
+
+    def symbol_index(name):
+        return symbols.setdefault(name, len(symbols))
+
+    while bytecode is not None:
+        instruction = bytecode.car
+        opcode = OPCODE_OF_SYMBOL.get(instruction.car)
+        if opcode is None:
+            raise ValueError('Cannot encode {}'.format(instruction.car))
+        code.append(opcode)
+        operand = OPCODES[opcode][1]
+        if operand == 'symbol':
+            code.append(symbol_index(instruction.cdr.car))
+        elif operand == 'ref':
+            key = (symbol_index(instruction.cdr.car),
+                   symbol_index(instruction.cdr.cdr.car))
+            code.append(refs.setdefault(key, len(refs)))
+        bytecode = bytecode.cdr
+
+    parts = [HEADER.pack(MAGIC, VERSION, len(symbols), len(refs), len(code))]
+    for name in symbols:
+        data = name.encode('utf-8')
+        parts.append(SYMBOL_LENGTH.pack(len(data)))
+        parts.append(data)
+    ref_words = array('i')
+    for variable, level in refs:
+        ref_words.append(variable)
+        ref_words.append(level)
+    parts.append(_little_endian(ref_words).tobytes())
+    parts.append(_little_endian(code).tobytes())
+    return b''.join(parts)
+
+
+def decode(buffer):
+    """Decode bytes (or any buffer, e.g. an mmap) produced by `encode`.
+    Raises ValueError if `buffer` is not a whole cache file.
+    """
+    size = len(buffer)
+    if size < HEADER.size:
+        raise ValueError('Truncated compiled rule file')
+    magic, version, n_symbols, n_refs, n_code = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a compiled rule file')
+    offset = HEADER.size
+
+    symbols = []
+    for _ in range(n_symbols):
+        if offset + SYMBOL_LENGTH.size > size:
+            raise ValueError('Truncated compiled rule file')
+        (length,) = SYMBOL_LENGTH.unpack_from(buffer, offset)
+        offset += SYMBOL_LENGTH.size
+        if offset + length > size:
+            raise ValueError('Truncated compiled rule file')
+        data = bytes(buffer[offset:offset + length])
+        symbols.append(intern(data.decode('utf-8')))
+        offset += length
+
+    if offset + 4 * (2 * n_refs + n_code) != size:
+        raise ValueError('Truncated compiled rule file')
+    words = array('i')
+    words.frombytes(buffer[offset:size])
+    _little_endian(words)
+    if any(not 0 <= word < n_symbols for word in words[:2 * n_refs]):
+        raise ValueError('Bad symbol in compiled rule file')
+    refs = [(symbols[words[2 * i]], symbols[words[2 * i + 1]])
+            for i in range(n_refs)]
+
+    acc = Accumulator()
+    idx = 2 * n_refs
+    end = idx + n_code
+    while idx < end:
+        symbol, operand = OPCODES.get(words[idx], (None, None))
+        if symbol is None:
+            raise ValueError('Bad opcode in compiled rule file')
+        if operand is None:
+            acc.append(Cons(symbol, None))
+            idx += 1
+            continue
+        table = symbols if operand == 'symbol' else refs
+        if idx + 1 == end or not 0 <= words[idx + 1] < len(table):
+            raise ValueError('Bad operand in compiled rule file')
+        if operand == 'symbol':
+            acc.append(Cons(symbol, Cons(symbols[words[idx + 1]], None)))
+        else:
+            variable, level = refs[words[idx + 1]]
+            acc.append(Cons(symbol, Cons(variable, Cons(level, None))))
+        idx += 2
+    return acc.to_list()
+
+
+def cache_key(rule_path):
+    # imported here, as importing it takes longer than this whole module
+    import hashlib
+
+    digest = hashlib.sha256()
+    digest.update(b'%d\0' % VERSION)
+    for path in (rule_path, bytecode_compiler.TRANSFORM_PATH):
+        with open(path, 'rb') as fd:
+            digest.update(hashlib.sha256(fd.read()).digest())
+    return digest.hexdigest()
+
+
+def load(path):
+    with open(path, 'rb') as fd:
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return decode(buffer)
+
+
+def store(path, bytecode):
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as fd:
+        fd.write(encode(bytecode))
+    os.replace(temp_path, path)
+
+
+def load_or_compile(rule_path, cache_dir):
+    """Return the bytecode of `rule_path`, from `cache_dir` if it has been
+    compiled before
+    """
+    path = os.path.join(cache_dir, cache_key(rule_path) + '.fzbc')
+    try:
+        return load(path)
+    except (OSError, ValueError):
+        pass
+
+    with open(rule_path, 'rb') as fd:
+        forms = SchemeParser().iter_parse(fd)
+        bytecode = bytecode_compiler.compile_stream_to_bytecode(forms)
+    os.makedirs(cache_dir, exist_ok=True)
+    store(path, bytecode)
+    return bytecode
@@ -1,28 +1,103 @@
-from dsl_parser import SchemeParser, Accumulator, Cons
+import marshal
+import os
+import sys
+from collections import namedtuple
+
+from dsl_parser import SchemeParser, Accumulator, Cons, intern
+from dsl_parser import to_tuple, from_tuple
+import profiler
 import transform
 
+SYM_IF = intern('if')
+SYM_POP = intern('%pop')
+SYM_MIN = intern('%min')
+SYM_MAX = intern('%max')
+SYM_GET_INPUT = intern('%get-input')
+SYM_CALL_MEMBER_FUNCTION = intern('%call-member-function')
+SYM_FEED = intern('%feed')
+SYM_GET_INPUT_BY_INDEX = intern('%get-input-by-index')
+SYM_CALL_FUNCTION_BY_REF = intern('%call-function-by-ref')
+SYM_FEED_DEFUZZER_FAST = intern('%feed-defuzzer-fast')
+SYM_STORE = intern('%store')
+SYM_LOAD = intern('%load')
+SYM_MIN_N = intern('%min-n')
+SYM_MAX_N = intern('%max-n')
+SYM_FEED_DEFUZZER_FAST_POP = intern('%feed-defuzzer-fast-pop')
+SYM_MEMBERSHIP_OF_INPUT = intern('%membership-of-input')
+
+def instruction_length(instruction):
+    """The number of words of an instruction in `vm.VM.bcbuf`"""
+    length = len(instruction)
+    if length == 4 and (instruction.car is SYM_FEED_DEFUZZER_FAST
+                        or instruction.car is SYM_FEED_DEFUZZER_FAST_POP):
+        # the tag of a feed is not encoded (see `Constants.tag_feeds`)
+        return 3
+    return length
+
 def compute_buffer_length(bytecode_list):
     result = 0
     while bytecode_list is not None:
-        result += len(bytecode_list.car)
+        result += instruction_length(bytecode_list.car)
         bytecode_list = bytecode_list.cdr
     return result
 
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRANSFORM_PATH = os.path.join(PACKAGE_DIR, 'transform.scm')
+# the generated code of the patterns in transform.scm
+CODE_CACHE_PATH = os.path.join(
+    PACKAGE_DIR, '__pycache__',
+    'transform.%s.marshal' % sys.implementation.cache_tag
+)
 RULES = {}
+RULE_INDEX = transform.RuleIndex()
+
+def _read_code_cache(path):
+    try:
+        with open(path, 'rb') as fd:
+            codes = marshal.load(fd)
+    except (OSError, EOFError, ValueError, TypeError):
+        return {}
+    return codes if isinstance(codes, dict) else {}
+
+def _write_code_cache(path, codes):
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as fd:
+            marshal.dump(codes, fd)
+        os.replace(temp_path, path)
+    except OSError:
+        pass  # e.g. a read-only installation
+
+def load_transforms(path, compiled=True, code_cache_path=None):
+    """Load the transforms defined in `path` into `RULES`. With `compiled`,
+    their patterns are compiled to Python functions, otherwise they are
+    interpreted. With `code_cache_path`, the code of those functions is
+    read from and saved to that file.
+    """
+    code_cache = None
+    if compiled and code_cache_path is not None:
+        code_cache = transform.CodeCache(_read_code_cache(code_cache_path))
 
-def load_transforms(path):
-    sexp = None
     with open(path, 'rb') as fd:
-        parser = SchemeParser()
-        sexp = parser.parse(fd)
-    while sexp is not None:
-        rule = transform.Transform(sexp.car)
-        RULES[rule.name] = rule
-        sexp = sexp.cdr
+        for form in SchemeParser().iter_parse(fd):
+            rule = transform.Transform(form, compiled, code_cache)
+            RULES[rule.name] = rule
+            RULE_INDEX.add(rule)
+
+    if code_cache is not None and (code_cache.misses
+                                   or code_cache.used != code_cache.codes):
+        _write_code_cache(code_cache_path, code_cache.used)
+
+def ensure_transforms():
+    """Load transform.scm, unless transforms have been loaded already"""
+    if not RULES:
+        init()
 
 def transform_repeatedly_cb(callback, sexp):
     changed = True
     while changed:
+        profiler.count_iteration()
         result = callback(sexp)
         if result is None:
             return None
@@ -33,6 +108,8 @@ def transform_repeatedly_cb(callback, sexp):
     return sexp
 
 def transform_repeatedly(name, original_sexp):
+    ensure_transforms()
+
     def callback(sexp):
         return RULES[name].recursively_transform(sexp)
 
@@ -54,28 +131,6 @@ def apply_multiple_transforms(rules, apply_transform, current):
     else:
         return transform.UNCHANGED
 
-def expand_AND_OR(sexp):
-    rules = (RULES['expand-and'], RULES['expand-and/cleanup'],
-             RULES['expand-or'], RULES['expand-or/cleanup'])
-    return apply_multiple_transforms(
-        rules,
-        lambda rule, current: rule.recursively_transform(current),
-        sexp
-    )
-
-def expand_compute_input_AND_OR(sexp):
-    return apply_multiple_transforms(
-        (RULES['defuzzer-input/and'], RULES['defuzzer-input/or']),
-        lambda rule, current: rule.recursively_transform(current),
-        sexp
-    )
-
-def expand_if_statement(sexp):
-    if sexp.car != 'if':
-        return sexp
-    else:
-        return transform_repeatedly_cb(expand_AND_OR, sexp)
-
 def sexp_map(func, sexp):
     acc = Accumulator()
     while sexp is not None:
@@ -83,33 +138,328 @@ def sexp_map(func, sexp):
         sexp = sexp.cdr
     return acc.to_list()
 
-def compile_to_bytecode(sexp):
+# A pass rewrites the program with a group of rules until nothing changes.
+# Passes with `if_forms_only` set only rewrite the top-level `if` forms.
+Pass = namedtuple('Pass', ('name', 'rules', 'if_forms_only'))
+
+PASSES = (
     # lift all nested if statements
-    sexp = transform_repeatedly('if-lifting', sexp)
-    sexp = transform_repeatedly('delete-empty-then', sexp)
+    Pass('if-lifting', ('if-lifting',), False),
+    Pass('delete-empty-then', ('delete-empty-then',), False),
     # expand all conditions in the if statements
-    sexp = sexp_map(expand_if_statement, sexp)
-
+    Pass('expand-and-or',
+         ('expand-and', 'expand-and/cleanup',
+          'expand-or', 'expand-or/cleanup'), True),
     # expand if statements
-    sexp = transform_repeatedly('compile-if-statement', sexp)
+    Pass('compile-if-statement', ('compile-if-statement',), False),
     # expand %compute-defuzzer-input
-    sexp = transform_repeatedly_cb(expand_compute_input_AND_OR, sexp)
-    sexp = transform_repeatedly('defuzzer-input/is', sexp)
+    Pass('defuzzer-input/and-or',
+         ('defuzzer-input/and', 'defuzzer-input/or'), False),
+    Pass('defuzzer-input/is', ('defuzzer-input/is',), False),
     # expand %compute-defuzzer-output
-    sexp = transform_repeatedly('defuzzer-output/begin', sexp)
-    sexp = transform_repeatedly('defuzzer-output/empty-begin', sexp)
-    sexp = transform_repeatedly('defuzzer-output/set!', sexp)
+    Pass('defuzzer-output/begin', ('defuzzer-output/begin',), False),
+    Pass('defuzzer-output/empty-begin',
+         ('defuzzer-output/empty-begin',), False),
+    Pass('defuzzer-output/set!', ('defuzzer-output/set!',), False),
+)
+
+def indexed_pass(rule_names, sexp):
+    """Rewrite with one traversal per iteration, matching each node only
+    against the rules in `RULE_INDEX` that can match it
+    """
+    index = RULE_INDEX.restrict(rule_names)
+    return transform_repeatedly_cb(index.recursively_transform, sexp)
+
+def normalizing_pass(rule_names, sexp):
+    """Rewrite to normal form in a single bottom-up traversal, revisiting
+    only the nodes built by the rules that fired
+    """
+    index = RULE_INDEX.restrict(rule_names)
+    profiler.count_iteration()
+    return transform.Normalizer(index).normalize(sexp)
+
+def sequential_pass(rule_names, sexp):
+    """Rewrite with one traversal per rule per iteration, trying every rule
+    at every node
+    """
+    rules = [RULES[name] for name in rule_names]
+    return transform_repeatedly_cb(
+        lambda current: apply_multiple_transforms(
+            rules,
+            lambda rule, current: rule.recursively_transform(current),
+            current
+        ),
+        sexp
+    )
+
+def is_if_statement(sexp):
+    return isinstance(sexp, Cons) and sexp.car is SYM_IF
+
+def compile_to_bytecode(sexp, run_pass=normalizing_pass, processes=None,
+                        profile=None):
+    """Compile the program `sexp` to a list of instructions.
+    With `processes`, the top-level forms are compiled by a pool of that
+    many worker processes (see `compile_in_parallel`).
+    With `profile` (a `profiler.CompileProfile`), every pass is measured.
+    """
+    if processes is not None:
+        if profile is not None:
+            raise ValueError('Cannot profile a parallel compilation')
+        return compile_in_parallel(sexp, processes, run_pass)
+
+    ensure_transforms()
+    for p in PASSES:
+        if profile is not None:
+            with profile.measure(p.name):
+                sexp = _run_pass(p, run_pass, sexp)
+        else:
+            sexp = _run_pass(p, run_pass, sexp)
 
     return sexp
 
+def _run_pass(p, run_pass, sexp):
+    if p.if_forms_only:
+        return sexp_map(
+            lambda form: (run_pass(p.rules, form)
+                          if is_if_statement(form) else form),
+            sexp
+        )
+    else:
+        return run_pass(p.rules, sexp)
 
-def main():
-    load_transforms('transform.scm')
-    sexp = SchemeParser().parse(open('rule.scm', 'rb'))
-    return compile_to_bytecode(sexp)
+def compile_forms(forms):
+    """Compile an iterable of top-level forms lazily.
+    Yields the bytecode of each form (possibly None) in order.
+
+    None of the passes in `compile_to_bytecode` looks across top-level
+    forms, so compiling the forms one by one gives the same bytecode as
+    compiling the whole program at once.
+    """
+    for form in forms:
+        yield compile_to_bytecode(Cons(form, None))
+
+def compile_stream_to_bytecode(forms):
+    acc = Accumulator()
+    for bytecode in compile_forms(forms):
+        acc.extend(bytecode)
+    return acc.to_list()
+
+def _compile_chunk(args):
+    """Runs in a worker process. Forms and bytecode cross the process
+    boundary as nested tuples.
+    """
+    forms, run_pass = args
+    result = []
+    for form in forms:
+        bytecode = compile_to_bytecode(from_tuple((form,)), run_pass)
+        result.append(to_tuple(bytecode))
+    return result
+
+def compile_in_parallel(sexp, processes, run_pass=normalizing_pass,
+                        chunks_per_process=4):
+    """Compile the top-level forms of `sexp` in a process pool and
+    concatenate their bytecode in order. This is correct because every
+    pass rewrites each top-level form on its own.
+    """
+    # imported here, as it takes longer to import than this module
+    import multiprocessing
+
+    forms = []
+    while sexp is not None:
+        forms.append(to_tuple(Cons(sexp.car, None))[0])
+        sexp = sexp.cdr
+
+    chunk_size = max(1, -(-len(forms) // (processes * chunks_per_process)))
+    chunks = [(forms[i:i + chunk_size], run_pass)
+              for i in range(0, len(forms), chunk_size)]
+
+    acc = Accumulator()
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap(_compile_chunk, chunks):
+            for bytecode in result:
+                acc.extend(from_tuple(bytecode))
+    return acc.to_list()
+
+
+# Common subexpression elimination
+
+# Instructions without side effects that pop this many values and push one
+PURE_ARITY = {
+    SYM_GET_INPUT: 0,
+    SYM_CALL_MEMBER_FUNCTION: 1,
+    SYM_MIN: 2,
+    SYM_MAX: 2,
+}
+# The same after `Constants.eliminate_map_lookup`
+INDEXED_PURE_ARITY = {
+    SYM_GET_INPUT_BY_INDEX: 0,
+    SYM_CALL_FUNCTION_BY_REF: 1,
+    SYM_MIN: 2,
+    SYM_MAX: 2,
+    SYM_LOAD: 0,
+    SYM_MEMBERSHIP_OF_INPUT: 0,
+}
+
+# `key` identifies the value of the expression: two expressions with the
+# same key compute the same value in the same run
+Expression = namedtuple('Expression', ('key', 'instruction', 'operands'))
+
+def split_expressions(bytecode, arity=PURE_ARITY):
+    """Return the instructions of `bytecode` as a list in which every run of
+    pure instructions (see `arity`) is replaced by the expression trees it
+    pushes
+    """
+    statements = []
+    pending = []  # expressions on top of the stack that are not emitted yet
+
+    while bytecode is not None:
+        instruction = bytecode.car
+        n = arity.get(instruction.car)
+        if n is not None and n <= len(pending):
+            operands = tuple(pending[len(pending) - n:])
+            del pending[len(pending) - n:]
+            key = (to_tuple(instruction),) + tuple(e.key for e in operands)
+            pending.append(Expression(key, instruction, operands))
+        else:
+            statements.extend(pending)
+            pending.clear()
+            statements.append(instruction)
+        bytecode = bytecode.cdr
+
+    statements.extend(pending)
+    return statements
+
+def eliminate_common_subexpressions(bytecode, arity=PURE_ARITY):
+    """Evaluate every repeated expression (e.g. a membership of the same
+    input and level, or a shared `and`) once, keep it in a temporary with
+    %store and push it again with %load
+    """
+    return eliminate_common_subexpressions_in_statements(
+        split_expressions(bytecode, arity))
+
+def eliminate_common_subexpressions_in_statements(statements):
+    """`eliminate_common_subexpressions` of the program that `statements`
+    (see `split_expressions`) is made of
+    """
+    # the number of times each expression is evaluated after elimination
+    counts = {}
+    def count(expression):
+        counts[expression.key] = counts.get(expression.key, 0) + 1
+        if counts[expression.key] == 1:
+            for operand in expression.operands:
+                count(operand)
+
+    for statement in statements:
+        if isinstance(statement, Expression):
+            count(statement)
+
+    acc = Accumulator()
+    slots = {}
+    def emit(expression):
+        slot = slots.get(expression.key)
+        if slot is not None:
+            acc.append(Cons(SYM_LOAD, Cons(slot, None)))
+            return
+        for operand in expression.operands:
+            emit(operand)
+        acc.append(expression.instruction)
+        if expression.operands and counts[expression.key] > 1:
+            slot = len(slots)
+            slots[expression.key] = slot
+            acc.append(Cons(SYM_STORE, Cons(slot, None)))
+
+    for statement in statements:
+        if isinstance(statement, Expression):
+            emit(statement)
+        else:
+            acc.append(statement)
+    return acc.to_list()
+
+def count_temporaries(bytecode):
+    result = 0
+    while bytecode is not None:
+        instruction = bytecode.car
+        if instruction.car is SYM_STORE:
+            result = max(result, instruction.cdr.car + 1)
+        bytecode = bytecode.cdr
+    return result
+
+# how many values each indexed instruction pushes (or pops, if negative)
+STACK_EFFECT = {
+    SYM_POP: -1,
+    SYM_MIN: -1,
+    SYM_MAX: -1,
+    SYM_GET_INPUT_BY_INDEX: 1,
+    SYM_CALL_FUNCTION_BY_REF: 0,
+    SYM_FEED_DEFUZZER_FAST: 0,
+    SYM_STORE: 0,
+    SYM_LOAD: 1,
+    SYM_FEED_DEFUZZER_FAST_POP: -1,
+    SYM_MEMBERSHIP_OF_INPUT: 1,
+}
+
+def max_stack_depth(bytecode):
+    """The largest number of values on the stack while running `bytecode`"""
+    depth = result = 0
+    while bytecode is not None:
+        instruction = bytecode.car
+        if instruction.car is SYM_MIN_N or instruction.car is SYM_MAX_N:
+            depth -= instruction.cdr.car - 1
+        else:
+            depth += STACK_EFFECT[instruction.car]
+        result = max(result, depth)
+        bytecode = bytecode.cdr
+    return result
+
+PASS_RUNNERS = {
+    'normalizing': normalizing_pass,
+    'indexed': indexed_pass,
+    'sequential': sequential_pass,
+}
+
+def main(argv=None):
+    """Compile a rule file. Run `python bytecode_compiler.py --help` for the
+    options.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Compile a rule file to bytecode')
+    parser.add_argument('rule_path', nargs='?', default='rule.scm')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time, iterations, match attempts '
+                             'and allocations of every pass')
+    parser.add_argument('--passes', choices=sorted(PASS_RUNNERS),
+                        default='normalizing',
+                        help='how each pass rewrites the program')
+    parser.add_argument('--print', action='store_true', dest='print_bytecode',
+                        help='print the bytecode')
+    args = parser.parse_args([] if argv is None else argv)
+
+    ensure_transforms()
+    with open(args.rule_path, 'rb') as fd:
+        sexp = SchemeParser().parse(fd)
+    profile = profiler.CompileProfile() if args.profile else None
+    bytecode = compile_to_bytecode(sexp, PASS_RUNNERS[args.passes],
+                                   profile=profile)
+
+    if args.print_bytecode:
+        current = bytecode
+        while current is not None:
+            print(to_tuple(current.car))
+            current = current.cdr
+    if profile is not None:
+        print(profile.format())
+    return bytecode
 
 
 class Constants:
+    # With `tag_feeds`, `_indexify` gives every feed the %feed instruction it
+    # comes from as a last operand, the tag of the feed:
+    #     (%feed-defuzzer-fast <defuzzer-index> <x2> <%feed instruction>)
+    # The passes of `optimizer` keep it, and `vm.encode` leaves it out.
+    tag_feeds = False
+
     @staticmethod
     def assign_number(dictionary):
         return dict(zip(dictionary.keys(), range(len(dictionary))))
@@ -140,13 +490,33 @@ class Constants:
         self.member_function_to_index = self.assign_number(mf)
         self.member_functions = self.flatten(mf, self.member_function_to_index)
 
+        # a slot of `fuzzy.DefuzzerBank` for every (output index, x2) that
+        # %feed-defuzzer-fast refers to
+        self.level_slots = {}
+        self.levels = []
+        for key in self.extract_member_function_calls(bytecode):
+            if key[2] == 'out':
+                self.add_level(self.output_to_index[key[0]],
+                               mf[(key[0], key[1])])
+
+    def add_level(self, output, function):
+        slot = self.level_slots.get((output, function.x2))
+        if slot is None:
+            self.level_slots[(output, function.x2)] = len(self.levels)
+            self.levels.append((output, [function]))
+            return
+        functions = self.levels[slot][1]
+        if all((f.x1, f.x3) != (function.x1, function.x3)
+               for f in functions):
+            functions.append(function)
+
     @staticmethod
     def extract_member_function_calls(bytecode):
         while bytecode is not None:
             instruction = bytecode.car
-            if instruction.car == '%call-member-function':
+            if instruction.car is SYM_CALL_MEMBER_FUNCTION:
                 yield (instruction.cdr.car, instruction.cdr.cdr.car, 'in')
-            elif instruction.car == '%feed':
+            elif instruction.car is SYM_FEED:
                 yield (instruction.cdr.car, instruction.cdr.cdr.car, 'out')
             bytecode = bytecode.cdr
 
@@ -159,26 +529,28 @@ class Constants:
         return self.member_functions[idx]
 
     def _indexify(self, instruction):
-        if instruction.car == '%get-input':
+        if instruction.car is SYM_GET_INPUT:
             # (%get-input <name>)
             # => (%get-input-by-index <index>)
             idx = self.input_to_index[instruction.cdr.car]
-            return Cons('%get-input-by-index', Cons(idx, None))
-        elif instruction.car == '%call-member-function':
+            return Cons(SYM_GET_INPUT_BY_INDEX, Cons(idx, None))
+        elif instruction.car is SYM_CALL_MEMBER_FUNCTION:
             # (%call-member-function <input> <level>)
             # => (%call-function-by-ref <triangle-function-ref>)
             ref = self.get_member_function(instruction.cdr)
-            return Cons('%call-function-by-ref', Cons(ref, None))
-        elif instruction.car == '%feed':
+            return Cons(SYM_CALL_FUNCTION_BY_REF, Cons(ref, None))
+        elif instruction.car is SYM_FEED:
             # (%feed <output> <level>)
             # => (%feed-defuzzer-fast <defuzzer-index> <x2>)
             idx = self.output_to_index[instruction.cdr.car]
             mf = self.get_member_function(instruction.cdr)
-            return Cons('%feed-defuzzer-fast', Cons(idx, Cons(mf.x2, None)))
+            tag = Cons(instruction, None) if self.tag_feeds else None
+            return Cons(SYM_FEED_DEFUZZER_FAST, Cons(idx, Cons(mf.x2, tag)))
         else:
             return instruction
 
 def init():
-    load_transforms('transform.scm')
+    load_transforms(TRANSFORM_PATH, code_cache_path=CODE_CACHE_PATH)
 
-init()
+if __name__ == '__main__':
+    main(sys.argv[1:])
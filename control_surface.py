@@ -0,0 +1,412 @@
+"""Control surfaces: the outputs of a rule program sampled on a grid of its
+three inputs, then looked up with trilinear interpolation instead of
+running the program.
+
+A surface file has a header, the three axes, the names of the outputs and
+two arrays of 16-bit integers: the outputs at every grid point (the
+outputs of one point next to each other) and the error of every cell. The
+arrays are used in place when the file is memory-mapped.
+"""
+import itertools
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+import bytecode_cache
+
+MAGIC = b'FZCS'
+VERSION = 1
+HEADER = struct.Struct('<4sH32sH')
+AXIS = struct.Struct('<iiI')
+NAME_LENGTH = struct.Struct('<H')
+# the range of the 'h' arrays
+VALUE_RANGE = (-32768, 32767)
+ERROR_LIMIT = 65535
+
+# The grid points of an input are low, low + step, ... up to
+# low + step * (count - 1)
+Axis = namedtuple('Axis', ('name', 'low', 'step', 'count'))
+
+def axis(name, low, high, step):
+    """The `Axis` with the fewest points from `low` that covers `high`"""
+    if step <= 0 or high < low:
+        raise ValueError('Empty axis {}'.format(name))
+    return Axis(name, low, step, max(2, -(-(high - low) // step) + 1))
+
+
+def _little_endian(words):
+    if sys.byteorder != 'little':
+        words.byteswap()
+    return words
+
+
+def _run(machine, names, point):
+    for name, value in zip(names, point):
+        machine.input(name, value)
+    machine.run()
+
+
+class ControlSurface:
+    """The outputs of a program at the points of a 3D grid:
+
+        surface = ControlSurface.build(machine, (
+            axis('dir-x', -1024, 1024, 32),
+            axis('dir-y', -1024, 1024, 32),
+            axis('dist', 0, 1024, 32),
+        ), ('dx', 'dy', 'rot'))
+        dx, dy, rot = surface.lookup(x, y, dist)
+
+    Between the grid points, the outputs are interpolated linearly along
+    each axis and rounded to the nearest integer. Inputs outside of the
+    grid are moved to its border.
+
+    `errors` holds, for every cell of the grid, the largest difference
+    between the interpolated and the exact outputs at the points of the
+    cell probed by `build`. This is a sampled estimate: the error between
+    the probes can be larger, so it is not a bound. `lookup(x, y, z,
+    machine)` runs `machine` instead in the cells where the estimate is
+    more than `max_sampled_error` (None disables it). `lookup` is
+    generated for the axes of the surface (see `_compile`).
+    """
+    def __init__(self, axes, output_names, values, errors, key=b'',
+                 max_sampled_error=None, buffer=None):
+        if len(axes) != 3:
+            raise ValueError('A control surface has three inputs')
+        self.axes = tuple(axes)
+        self.output_names = tuple(output_names)
+        self.values = values
+        self.errors = errors
+        self.key = key
+        self.max_sampled_error = max_sampled_error
+        # the mmap of `values` and `errors`, if any
+        self.buffer = buffer
+
+        x, y, z = self.axes
+        # (low, step, index of the last cell) of each axis
+        self.ranges = tuple((a.low, a.step, a.count - 2) for a in self.axes)
+        self.scale = x.step * y.step * z.step
+        width = len(self.output_names)
+        # distance between neighbours in `values` along each axis
+        self.strides = (y.count * z.count * width, z.count * width, width)
+        self.cell_strides = ((y.count - 1) * (z.count - 1), z.count - 1)
+        if len(values) != x.count * self.strides[0]:
+            raise ValueError('Wrong number of values')
+        if len(errors) != (x.count - 1) * self.cell_strides[0]:
+            raise ValueError('Wrong number of cell errors')
+        self.lookup = self._compile()
+
+    @classmethod
+    def build(cls, machine, axes, output_names, key=b'',
+              max_sampled_error=None, probes=1):
+        """Sample `machine` (a `vm.VM` or `vm.VMInstance`) at every grid
+        point. The error of a cell is measured at `probes` points along
+        each axis, evenly spaced in the cell (the center with 1).
+        """
+        names = [a.name for a in axes]
+        values = array('h')
+        for point in _points(axes):
+            _run(machine, names, point)
+            for name in output_names:
+                value = machine.get_output(name)
+                if not VALUE_RANGE[0] <= value <= VALUE_RANGE[1]:
+                    raise ValueError(
+                        'Output {} = {} does not fit in 16 bits'.format(
+                            name, value))
+                values.append(value)
+
+        surface = cls(axes, output_names, values,
+                      array('H', [0]) * _cell_count(axes), key,
+                      max_sampled_error)
+        errors = surface.errors
+        shifts = [[a.step * (k + 1) // (probes + 1) for k in range(probes)]
+                  for a in axes]
+        for shift in itertools.product(*shifts):
+            # the probes at `shift` from the first corner of every cell
+            cells = [Axis(a.name, a.low + d, a.step, a.count - 1)
+                     for a, d in zip(axes, shift)]
+            for cell, point in enumerate(_points(cells)):
+                _run(machine, names, point)
+                error = max(
+                    abs(machine.get_output(name) - value)
+                    for name, value in zip(output_names,
+                                           surface.lookup(*point)))
+                if error > errors[cell]:
+                    errors[cell] = min(error, ERROR_LIMIT)
+        return surface
+
+    def _locate(self, value, axis):
+        """The index of the cell along `axis` and the offset in the cell"""
+        offset = value - axis.low
+        if offset <= 0:
+            return 0, 0
+        index = offset // axis.step
+        if index >= axis.count - 1:
+            return axis.count - 2, axis.step
+        return index, offset - index * axis.step
+
+    def cell_error(self, x, y, z):
+        """The sampled error of the cell of (x, y, z), see `errors`"""
+        ax, ay, az = self.axes
+        cx, cy = self.cell_strides
+        return self.errors[self._locate(x, ax)[0] * cx
+                           + self._locate(y, ay)[0] * cy
+                           + self._locate(z, az)[0]]
+
+    def _compile(self):
+        """Generate `lookup` with the axes and strides of this surface as
+        constants:
+
+            def lookup(x, y, z, machine=None):
+                fx = x + 1024
+                ...
+                i = ix * 12675 + iy * 99 + iz * 3
+                j = i + 12675
+                return ((v[i] * w00 + ... + v[j + 102] * w31 + 16384)
+                        // 32768, ...)
+        """
+        lines = ['def lookup(x, y, z, machine=None):']
+
+        def emit(line):
+            lines.append('    ' + line)
+
+        for name, (low, step, last) in zip('xyz', self.ranges):
+            emit('f%s = %s %s %d' % (name, name, '-' if low >= 0 else '+',
+                                     abs(low)))
+            emit('if f%s <= 0:' % name)
+            emit('    i%s = f%s = 0' % (name, name))
+            emit('else:')
+            emit('    i%s = f%s // %d' % (name, name, step))
+            emit('    if i%s > %d:' % (name, last))
+            emit('        i%s = %d' % (name, last))
+            emit('        f%s = %d' % (name, step))
+            emit('    else:')
+            emit('        f%s -= i%s * %d' % (name, name, step))
+            emit('g%s = %d - f%s' % (name, step, name))
+
+        cx, cy = self.cell_strides
+        emit('limit = surface.max_sampled_error')
+        emit('if machine is not None and limit is not None:')
+        emit('    if errors[ix * %d + iy * %d + iz] > limit:' % (cx, cy))
+        emit('        return surface.run(machine, x, y, z)')
+
+        # the weights of the 8 corners
+        emit('w0 = gx * gy')
+        emit('w1 = gx * fy')
+        emit('w2 = fx * gy')
+        emit('w3 = fx * fy')
+        for k, w in enumerate(('w0', 'w1', 'w2', 'w3')):
+            emit('w%d0 = %s * gz' % (k, w))
+            emit('w%d1 = %s * fz' % (k, w))
+        sx, sy, sz = self.strides
+        emit('i = ix * %d + iy * %d + iz * %d' % (sx, sy, sz))
+        emit('j = i + %d' % sx)
+        outputs = []
+        for o in range(sz):
+            corners = []
+            for k, (base, offset) in enumerate(
+                    (('i', 0), ('i', sy), ('j', 0), ('j', sy))):
+                for m, extra in enumerate((0, sz)):
+                    index = offset + extra + o
+                    corners.append('v[%s] * w%d%d' % (
+                        '%s + %d' % (base, index) if index else base, k, m))
+            outputs.append('(%s + %d) // %d' % (
+                ' + '.join(corners), self.scale // 2, self.scale))
+        emit('return (%s,)' % ', '.join(outputs))
+
+        self.source = '\n'.join(lines) + '\n'
+        namespace = {'surface': self, 'v': self.values,
+                     'errors': self.errors}
+        exec(compile(self.source, '<surface>', 'exec'), namespace)
+        return namespace['lookup']
+
+    def run(self, machine, x, y, z):
+        """The outputs of `machine` at (x, y, z)"""
+        _run(machine, [a.name for a in self.axes], (x, y, z))
+        return tuple(machine.get_output(name) for name in self.output_names)
+
+    def encode(self):
+        parts = [HEADER.pack(MAGIC, VERSION, self.key,
+                             len(self.output_names))]
+        for a in self.axes:
+            parts.append(AXIS.pack(a.low, a.step, a.count))
+        for name in [a.name for a in self.axes] + list(self.output_names):
+            data = name.encode('utf-8')
+            parts.append(NAME_LENGTH.pack(len(data)))
+            parts.append(data)
+        parts.append(_little_endian(array('h', self.values)).tobytes())
+        parts.append(_little_endian(array('H', self.errors)).tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, buffer, max_sampled_error=None, copy=True):
+        """Decode bytes (or any buffer, e.g. an mmap) produced by `encode`.
+        Without `copy`, the arrays are views of `buffer`. Raises ValueError
+        if `buffer` is not a whole surface file.
+        """
+        size = len(buffer)
+        if size < HEADER.size + 3 * AXIS.size:
+            raise ValueError('Truncated control surface')
+        magic, version, key, n_outputs = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a control surface')
+        offset = HEADER.size
+        ranges = []
+        for _ in range(3):
+            low, step, count = AXIS.unpack_from(buffer, offset)
+            if step <= 0 or count < 2:
+                raise ValueError('Bad axis in control surface')
+            ranges.append((low, step, count))
+            offset += AXIS.size
+        names = []
+        for _ in range(3 + n_outputs):
+            if offset + NAME_LENGTH.size > size:
+                raise ValueError('Truncated control surface')
+            (length,) = NAME_LENGTH.unpack_from(buffer, offset)
+            offset += NAME_LENGTH.size
+            if offset + length > size:
+                raise ValueError('Truncated control surface')
+            names.append(bytes(buffer[offset:offset + length]).decode(
+                'utf-8'))
+            offset += length
+        axes = [Axis(name, *r) for name, r in zip(names, ranges)]
+
+        sizes = (axes[0].count * axes[1].count * axes[2].count * n_outputs,
+                 _cell_count(axes))
+        if offset + 2 * sum(sizes) != size:
+            raise ValueError('Truncated control surface')
+        arrays = []
+        for typecode, count in zip('hH', sizes):
+            data = memoryview(buffer)[offset:offset + 2 * count]
+            if copy or sys.byteorder != 'little':
+                words = array(typecode)
+                words.frombytes(data)
+                arrays.append(_little_endian(words))
+            else:
+                arrays.append(data.cast(typecode))
+            offset += 2 * count
+        return cls(axes, names[3:], arrays[0], arrays[1], key,
+                   max_sampled_error, None if copy else buffer)
+
+    def close(self):
+        if self.buffer is not None:
+            self.values.release()
+            self.errors.release()
+            self.buffer.close()
+            self.buffer = None
+
+
+def _points(axes):
+    x, y, z = axes
+    for i in range(x.count):
+        for j in range(y.count):
+            for k in range(z.count):
+                yield (x.low + i * x.step, y.low + j * y.step,
+                       z.low + k * z.step)
+
+
+def _cell_count(axes):
+    count = 1
+    for a in axes:
+        count *= a.count - 1
+    return count
+
+
+def surface_key(rule_path, inputs, outputs, axes, defuzzification, probes):
+    """A digest of everything the tables of a surface depend on"""
+    import hashlib
+
+    digest = hashlib.sha256()
+    digest.update(b'%d\0' % VERSION)
+    digest.update(bytecode_cache.cache_key(rule_path).encode('ascii'))
+    for functions in (inputs, outputs):
+        for name in sorted(functions):
+            for level, function in zip(functions[name]._fields,
+                                       functions[name]):
+                digest.update(repr((name, level, function.x1,
+                                    function.x3)).encode('utf-8'))
+    digest.update(repr((tuple(outputs), tuple(axes), defuzzification,
+                        probes)).encode('utf-8'))
+    return digest.digest()
+
+
+def load(path, max_sampled_error=None, memory_map=True):
+    with open(path, 'rb') as fd:
+        if not memory_map:
+            return ControlSurface.decode(fd.read(), max_sampled_error)
+        buffer = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return ControlSurface.decode(buffer, max_sampled_error, copy=False)
+    except ValueError:
+        buffer.close()
+        raise
+
+
+def store(path, surface):
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as fd:
+        fd.write(surface.encode())
+    os.replace(temp_path, path)
+
+
+def load_or_build(program, rule_path, inputs, outputs, axes, cache_dir,
+                  max_sampled_error=None, probes=1, memory_map=True):
+    """Return the surface of `program` (a `vm.Program` of `rule_path` with
+    the member functions `inputs` and `outputs`, in the order of
+    `outputs`), from `cache_dir` if it has been built before
+    """
+    key = surface_key(rule_path, inputs, outputs, axes, program.bank.method,
+                      probes)
+    path = os.path.join(cache_dir, key.hex() + '.fzcs')
+    try:
+        surface = load(path, max_sampled_error, memory_map)
+        if surface.key == key:
+            return surface
+        surface.close()
+    except (OSError, ValueError):
+        pass
+
+    surface = ControlSurface.build(program.instance(), axes, tuple(outputs),
+                                   key, max_sampled_error, probes)
+    os.makedirs(cache_dir, exist_ok=True)
+    store(path, surface)
+    return surface
+
+
+def report(surface, machine, samples):
+    """Compare the surface with `machine` on a list of input points: the
+    maximum and mean difference of each output, the lookups that ran
+    `machine` and the time per lookup
+    """
+    names = [a.name for a in surface.axes]
+    exact = []
+    start = time.perf_counter()
+    for point in samples:
+        _run(machine, names, point)
+        exact.append([machine.get_output(name)
+                      for name in surface.output_names])
+    exact_seconds = time.perf_counter() - start
+
+    fallbacks = 0
+    if surface.max_sampled_error is not None:
+        fallbacks = sum(surface.cell_error(*point) > surface.max_sampled_error
+                        for point in samples)
+    start = time.perf_counter()
+    approximate = [surface.lookup(*point, machine) for point in samples]
+    surface_seconds = time.perf_counter() - start
+
+    lines = ['%-8s %10s %10s' % ('output', 'max error', 'mean error')]
+    for i, name in enumerate(surface.output_names):
+        errors = [abs(a[i] - e[i]) for a, e in zip(approximate, exact)]
+        lines.append('%-8s %10d %10.3f' % (
+            name, max(errors), sum(errors) / len(errors)))
+    lines.append('fallbacks to the program: %d of %d' % (
+        fallbacks, len(samples)))
+    lines.append('program %.2f us/tick, surface %.2f us/tick, %.1fx' % (
+        exact_seconds / len(samples) * 1e6,
+        surface_seconds / len(samples) * 1e6,
+        exact_seconds / max(surface_seconds, 1e-9)))
+    return '\n'.join(lines)
@@ -1,5 +1,7 @@
 import enum
+import re
 import string
+import sys
 import collections
 
 class Tokenizer:
@@ -41,9 +43,9 @@ class Tokenizer:
             return result
 
         def _read_until(self, chs, discard=False):
-            # ???
             ending_idx = self.idx
-            while self.has_next() and self.data[ending_idx] not in chs:
+            while (ending_idx < self.actual_length
+                   and self.data[ending_idx] not in chs):
                 ending_idx += 1
             result = None
             if not discard:
@@ -61,9 +63,22 @@ class Tokenizer:
         reading_non_comments = 0,
         reading_comments = 1,
 
-    def __init__(self, on_symbol, on_list_open, on_list_close):
+    class Mode(enum.IntEnum):
+        per_character = 0,
+        bulk = 1,
+
+    # groups: 1 = '(', 2 = ')', 3 = symbol; a comment matches no group
+    token_pattern = re.compile(rb'(\()|(\))|([^\s();]+)|;[^\n]*')
+    symbol_rest_pattern = re.compile(rb'[^\s();]*')
+
+    def __init__(self, on_symbol, on_list_open, on_list_close,
+                 mode=Mode.per_character):
         self.state = self.State.reading_non_comments
-        self.b = self.Buffer(4096)
+        self.mode = mode
+        if mode == self.Mode.bulk:
+            self.b = self.Buffer(65536)
+        else:
+            self.b = self.Buffer(4096)
         self.symbol_acc = []
         # Handlers
         self.on_symbol = on_symbol
@@ -71,12 +86,25 @@ class Tokenizer:
         self.on_list_close = on_list_close
 
     def tokenize(self, fd):
+        for _ in self.tokenize_iter(fd):
+            pass
+
+    def tokenize_iter(self, fd):
+        """Like `tokenize`, but yields each time a buffer has been
+        processed, so that the caller can consume what the handlers have
+        produced so far.
+        """
+        if self.mode == self.Mode.bulk:
+            yield from self.tokenize_bulk(fd)
+            return
         bytes_read = self.b.refill(fd)
         while bytes_read > 0:
             self.process_buffer()
+            yield
             bytes_read = self.b.refill(fd)
         self.b.eof()
         self.process_buffer()
+        yield
 
     def _yield_symbol(self):
         result = ''.join(self.symbol_acc)
@@ -123,6 +151,61 @@ class Tokenizer:
             else:
                 self.state = self.state_comments()
 
+    def tokenize_bulk(self, fd):
+        """Scan whole buffers with a regex instead of one character at a
+        time. Only the bytes of each symbol are copied out of the buffer.
+        """
+        while self.b.refill(fd) > 0:
+            self.process_buffer_bulk()
+            yield
+        # a symbol may end exactly at the end of the file
+        if self.symbol_acc:
+            self._yield_pending_symbol()
+        yield
+
+    def _yield_pending_symbol(self):
+        self.on_symbol(str(b''.join(self.symbol_acc), encoding='utf-8'))
+        self.symbol_acc = []
+
+    def process_buffer_bulk(self):
+        data = self.b.data
+        end = self.b.actual_length
+        pos = 0
+
+        if self.state == self.State.reading_comments:
+            # the comment started in a previous buffer
+            pos = data.find(b'\n', 0, end)
+            if pos < 0:
+                return
+            self.state = self.State.reading_non_comments
+
+        if self.symbol_acc:
+            # the symbol started in a previous buffer
+            pos = self.symbol_rest_pattern.match(data, pos, end).end()
+            self.symbol_acc.append(bytes(data[0:pos]))
+            if pos == end:
+                return
+            self._yield_pending_symbol()
+
+        on_symbol = self.on_symbol
+        on_list_open = self.on_list_open
+        on_list_close = self.on_list_close
+        for m in self.token_pattern.finditer(data, pos, end):
+            kind = m.lastindex
+            if kind == 3:
+                if m.end() == end:
+                    # might continue in the next buffer
+                    self.symbol_acc.append(m[3])
+                    return
+                on_symbol(str(m[3], encoding='utf-8'))
+            elif kind == 1:
+                on_list_open()
+            elif kind == 2:
+                on_list_close()
+            elif m.end() == end:
+                # the linefeed ending this comment is not in this buffer
+                self.state = self.State.reading_comments
+
 
 def main():
     def on_list_open():
@@ -142,6 +225,17 @@ def main():
     print('\n====')
 
 
+def intern(name):
+    """Return the one shared `str` object of the symbol `name`, so that
+    interned symbols can be compared with `is`
+    """
+    return sys.intern(name)
+
+def is_placeholder(symbol):
+    """Whether `symbol` is a placeholder of a transform pattern, <name>"""
+    return symbol.startswith('<') and symbol.endswith('>')
+
+
 class Cons:
     __slots__ = ('car', 'cdr')
     def __init__(self, car, cdr):
@@ -170,6 +264,31 @@ class Cons:
             curr = curr.cdr
         return length
 
+def to_tuple(sexp):
+    """Convert a list to nested tuples, e.g. to pickle it without
+    recursing along the `cdr` chain
+    """
+    result = []
+    while sexp is not None:
+        if sexp.car is None or isinstance(sexp.car, Cons):
+            result.append(to_tuple(sexp.car))
+        else:
+            result.append(sexp.car)
+        sexp = sexp.cdr
+    return tuple(result)
+
+def from_tuple(elements):
+    """Inverse of `to_tuple`. Symbols are interned again."""
+    acc = Accumulator()
+    for element in elements:
+        if isinstance(element, tuple):
+            acc.append(from_tuple(element))
+        elif isinstance(element, str):
+            acc.append(intern(element))
+        else:
+            acc.append(element)
+    return acc.to_list()
+
 class Accumulator:
     def __init__(self, element=None):
         if element is None:
@@ -193,12 +312,52 @@ class Accumulator:
             self.append(linked_list.car)
             linked_list = linked_list.cdr
 
+    def share_tail(self, linked_list):
+        """Make `linked_list` the rest of the accumulated list without
+        copying it. Nothing may be appended afterwards, since that would
+        modify `linked_list`.
+        """
+        if self.head is None:
+            self.head = linked_list
+        else:
+            self.tail.cdr = linked_list
+        self.tail = None
+
     def to_list(self):
         return self.head
 
 
-class SchemeParser:
+class AllocationCounter:
+    """Counts the `Cons` cells allocated while it is active:
+
+        with AllocationCounter() as counter:
+            ...
+        print(counter.count)
+
+    It patches `Cons.__init__` on entry and restores it on exit, so it
+    costs nothing when not in use.
+    """
     def __init__(self):
+        self.count = 0
+        self.original_init = None
+
+    def __enter__(self):
+        original_init = Cons.__init__
+
+        def counting_init(cell, car, cdr):
+            self.count += 1
+            original_init(cell, car, cdr)
+
+        self.original_init = original_init
+        Cons.__init__ = counting_init
+        return self
+
+    def __exit__(self, *exc_info):
+        Cons.__init__ = self.original_init
+
+
+class SchemeParser:
+    def __init__(self, mode=Tokenizer.Mode.bulk):
         def on_symbol(symbol):
             self.on_symbol(symbol)
 
@@ -208,13 +367,14 @@ class SchemeParser:
         def on_list_close():
             self.on_list_close()
 
-        self.tokenizer = Tokenizer(on_symbol, on_list_open, on_list_close)
+        self.tokenizer = Tokenizer(on_symbol, on_list_open, on_list_close,
+                                   mode)
         self.root = Accumulator()
         self.stack = collections.deque()
         self.stack.appendleft(self.root)
 
     def on_symbol(self, symbol):
-        self.stack[0].append(symbol)
+        self.stack[0].append(intern(symbol))
 
     def on_list_open(self):
         self.stack.appendleft(Accumulator())
@@ -228,3 +388,22 @@ class SchemeParser:
         if len(self.stack) != 1:
             raise ValueError('Unbalanced parenthesis')
         return self.root.to_list()
+
+    def _take_forms(self):
+        forms = self.root.to_list()
+        self.root.head = None
+        self.root.tail = None
+        return forms
+
+    def iter_parse(self, binary_fd):
+        """Yield the top-level forms one by one. Forms are handed out after
+        every buffer the tokenizer reads, so only the forms of one buffer
+        (plus the one still being read) are held in memory at a time.
+        """
+        for _ in self.tokenizer.tokenize_iter(binary_fd):
+            forms = self._take_forms()
+            while forms is not None:
+                yield forms.car
+                forms = forms.cdr
+        if len(self.stack) != 1:
+            raise ValueError('Unbalanced parenthesis')
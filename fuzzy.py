@@ -1,3 +1,4 @@
+from array import array
 from collections import namedtuple
 
 class TriangleFunction:
@@ -22,44 +23,205 @@ class TriangleFunction:
         else:
             return self.M * (x - self.x3) // self.k2_denominator
 
+# lookup tables, shared by the functions with the same x1, x3 and domain.
+# At most TABLE_CACHE_SIZE are kept, the oldest are dropped first (the
+# functions that use them keep them).
+_TABLES = {}
+TABLE_CACHE_SIZE = 256
+
+class TableTriangleFunction(TriangleFunction):
+    """A `TriangleFunction` that looks up the integers of `domain`, a closed
+    interval (low, high), in a precomputed table. Other inputs are computed.
+    """
+    def __init__(self, x1, x3, domain):
+        super().__init__(x1, x3)
+        self.low, high = domain
+        key = (self.x1, self.x3, self.low, high)
+        table = _TABLES.get(key)
+        if table is None:
+            compute = super().__call__
+            table = array('h', (compute(x) for x in range(self.low, high + 1)))
+            if len(_TABLES) >= TABLE_CACHE_SIZE:
+                del _TABLES[next(iter(_TABLES))]
+            _TABLES[key] = table
+        self.table = table
+        self.size = len(table)
+
+    def __call__(self, x):
+        idx = x - self.low
+        if 0 <= idx < self.size:
+            return self.table[idx]
+        return TriangleFunction.__call__(self, x)
+
+def _triangle(points, domain):
+    if domain is None:
+        return TriangleFunction(*points)
+    return TableTriangleFunction(*points, domain)
+
 _5Levels = namedtuple('FiveLevels', ('NM', 'NS', 'Z', 'PS', 'PM'))
 _3Levels = namedtuple('ThreeLevels', ('NM', 'Z', 'PM'))
 _3LevelsPositive = namedtuple('ThreeLevelsPositive', ('Z', 'PS', 'PM'))
 
-def FiveLevels(NM, NS, Z, PS, PM):
+def FiveLevels(NM, NS, Z, PS, PM, domain=None):
+    """With `domain` (low, high), the functions use lookup tables for the
+    integers from low to high
+    """
     return _5Levels(
-        TriangleFunction(*NM),
-        TriangleFunction(*NS),
-        TriangleFunction(*Z),
-        TriangleFunction(*PS),
-        TriangleFunction(*PM)
+        _triangle(NM, domain),
+        _triangle(NS, domain),
+        _triangle(Z, domain),
+        _triangle(PS, domain),
+        _triangle(PM, domain)
     )
 
-def ThreeLevels(NM, Z, PM):
+def ThreeLevels(NM, Z, PM, domain=None):
     return _3Levels(
-        TriangleFunction(*NM),
-        TriangleFunction(*Z),
-        TriangleFunction(*PM)
+        _triangle(NM, domain),
+        _triangle(Z, domain),
+        _triangle(PM, domain)
     )
 
-def ThreeLevelsPositive(Z, PS, PM):
+def ThreeLevelsPositive(Z, PS, PM, domain=None):
     return _3LevelsPositive(
-        TriangleFunction(*Z),
-        TriangleFunction(*PS),
-        TriangleFunction(*PM)
+        _triangle(Z, domain),
+        _triangle(PS, domain),
+        _triangle(PM, domain)
     )
 
-class Defuzzer:
-    def __init__(self):
-        self.numerator = 0
-        self.denominator = 0
+DEFUZZIFICATIONS = ('weighted-average', 'mean-of-maxima', 'centroid')
+
+def _shape_tables(function):
+    """For every height h from 0 to M: the area and the moment (sum of y
+    times the value) of min(h, function(y)) over the integers y of the
+    support, and the number and the sum of the y where function(y) >= h
+    """
+    points = sorted((function(y), y)
+                    for y in range(function.x1 + 1, function.x3))
+    area = []
+    moment = []
+    count = []
+    total = []
+    # sums over the points whose value is below h
+    below_area = below_moment = 0
+    above_count = len(points)
+    above_total = sum(y for _, y in points)
+    i = 0
+    for h in range(function.M + 1):
+        while i < len(points) and points[i][0] < h:
+            value, y = points[i]
+            below_area += value
+            below_moment += value * y
+            above_count -= 1
+            above_total -= y
+            i += 1
+        area.append(below_area + h * above_count)
+        moment.append(below_moment + h * above_total)
+        count.append(above_count)
+        total.append(above_total)
+    return area, moment, count, total
+
+class DefuzzerBank:
+    """The defuzzers of all the outputs of a program in one array. Slot k of
+    `sums` adds up the strengths of the rules that set `levels[k]`, an
+    (output index, functions) pair, so feeding a rule is one addition and
+    `reset` clears every output at once.
+
+    `method` computes the value of an output from the sums of its levels:
+
+    - 'weighted-average': the peaks (x2) of the levels weighted by their
+      sums, the original defuzzer
+    - 'mean-of-maxima': the mean of the integers where the level with the
+      largest height reaches that height
+    - 'centroid': the centroid of the levels cut at their heights, added
+      up, over the integers of their supports
 
-    def feed(self, y2, output):
-        self.numerator += y2 * output
-        self.denominator += output
+    The height of a level is its sum, at most `TriangleFunction.M`. The
+    shapes of the levels are tabulated for every height when the bank is
+    created, and the code of each output is generated, so every method
+    looks up a few values per level of the output.
+    """
+    def __init__(self, output_count, levels, method='weighted-average'):
+        if method not in DEFUZZIFICATIONS:
+            raise ValueError('Unknown defuzzification {}'.format(method))
+        self.levels = levels
+        self.method = method
+        self.zeros = array('q', [0]) * len(levels)
+        self.sums = array('q', self.zeros)
 
-    def defuzz(self):
-        return self.numerator // max(1, self.denominator)
+        # for each output, the (slot, x2) or (slot, tables) of its levels
+        self.outputs = [[] for _ in range(output_count)]
+        for k, (output, functions) in enumerate(levels):
+            if method == 'weighted-average':
+                self.outputs[output].append((k, functions[0].x2))
+                continue
+            if len(functions) > 1:
+                raise ValueError('Levels of output {} have different shapes '
+                                 'and the same peak'.format(output))
+            self.outputs[output].append((k, _shape_tables(functions[0])))
+
+        self.lines = []
+        self.namespace = {}
+        generate = {
+            'weighted-average': self._weighted_average,
+            'mean-of-maxima': self._mean_of_maxima,
+            'centroid': self._centroid,
+        }[method]
+        for output, output_levels in enumerate(self.outputs):
+            self.lines.append('def defuzz%d(sums):' % output)
+            if output_levels:
+                generate(output_levels)
+            else:
+                self._emit('return 0')
+        self.source = '\n'.join(self.lines) + '\n'
+        exec(compile(self.source, '<defuzzers>', 'exec'), self.namespace)
+        self.functions = [self.namespace['defuzz%d' % output]
+                          for output in range(output_count)]
+
+    def _emit(self, line):
+        self.lines.append('    ' + line)
+
+    def _table(self, name, k, table):
+        self.namespace['%s%d' % (name, k)] = table
+        return '%s%d' % (name, k)
+
+    def _heights(self, levels):
+        for k, _ in levels:
+            self._emit('h%d = sums[%d]' % (k, k))
+            self._emit('if h%d > %d: h%d = %d' % (
+                k, TriangleFunction.M, k, TriangleFunction.M))
+
+    def _weighted_average(self, levels):
+        self._emit('return (%s) // max(1, %s)' % (
+            ' + '.join('%d * sums[%d]' % (x2, k) for k, x2 in levels),
+            ' + '.join('sums[%d]' % k for k, _ in levels)))
+
+    def _mean_of_maxima(self, levels):
+        self._heights(levels)
+        self._emit('h = max(0, %s)' % ', '.join('h%d' % k for k, _ in levels))
+        self._emit('if h <= 0:')
+        self._emit('    return 0')
+        self._emit('n = d = 0')
+        for k, (_, _, count, total) in levels:
+            self._emit('if h%d == h:' % k)
+            self._emit('    n += %s[h]' % self._table('t', k, total))
+            self._emit('    d += %s[h]' % self._table('c', k, count))
+        self._emit('return n // max(1, d)')
+
+    def _centroid(self, levels):
+        self._heights(levels)
+        self._emit('return (%s) // max(1, %s)' % (
+            ' + '.join('%s[h%d]' % (self._table('m', k, moment), k)
+                       for k, (_, moment, _, _) in levels),
+            ' + '.join('%s[h%d]' % (self._table('a', k, area), k)
+                       for k, (area, _, _, _) in levels)))
 
     def reset(self):
-        self.__init__()
+        self.sums[:] = self.zeros
+
+    def defuzz(self, output, sums=None):
+        """The value of `output` (an index) from `sums`, by default the sums
+        of this bank
+        """
+        if sums is None:
+            sums = self.sums
+        return self.functions[output](sums)
@@ -1,4 +1,5 @@
 import pygame
+import control_surface
 import fuzzy
 import vm
 
@@ -6,6 +7,16 @@ WIDTH, HEIGHT = 1920, 1080
 BG_COLOR = pygame.Color('black')
 FG_COLOR = pygame.Color('white')
 NO_COLOR = pygame.Color(0, 0, 0, 0)
+# reload rule.scm while the game is running when it is edited
+WATCH_RULES = False
+# look the outputs of rule.scm up in a control surface sampled every
+# SURFACE_STEP (see control_surface.py) instead of running the rules, or
+# None to run them on every tick. The outputs are only checked at a few
+# points of each cell, so a surface can be further off than this elsewhere.
+SURFACE_STEP = None
+# run the rules in the cells of the surface whose error measured at those
+# points is more than this
+SURFACE_MAX_SAMPLED_ERROR = 2
 
 class Ball:
     RADIUS = 30
@@ -87,6 +98,12 @@ class Camera:
     VECTOR_LENGTH = 300
     ACCELERATION = 3
     DECELERATION = -6
+    # the range of Input.normalize
+    INPUT_DOMAIN = (-1024, 1024)
+    # the `vm.Program` of rule.scm, compiled for the first camera
+    program = None
+    # its `control_surface.ControlSurface`, with SURFACE_STEP
+    surface = None
 
     class Rotation:
         def __init__(self, dx):
@@ -141,11 +158,42 @@ class Camera:
 
         self.ai_input = self.Input(self)
         self.allocate_member_functions()
-        self.fuzzy_machine = vm.VM(
-            {'dir-x': self.fdirx, 'dir-y': self.fdiry, 'dist': self.fdist},
-            {'dx': self.fdx, 'dy': self.fdy, 'rot': self.frot},
-            'rule.scm'
-        )
+        inputs = {'dir-x': self.fdirx, 'dir-y': self.fdiry,
+                  'dist': self.fdist}
+        outputs = {'dx': self.fdx, 'dy': self.fdy, 'rot': self.frot}
+        if WATCH_RULES:
+            self.fuzzy_machine = vm.VM(
+                inputs,
+                outputs,
+                'rule.scm',
+                watch=True,
+                engine='codegen'
+            )
+        else:
+            # all cameras share one compiled program
+            if Camera.program is None:
+                Camera.program = vm.Program(
+                    inputs,
+                    outputs,
+                    'rule.scm',
+                    cache_dir='__rulecache__',
+                    engine='codegen'
+                )
+            self.fuzzy_machine = Camera.program.instance(
+                Camera.program.bind(inputs))
+            if SURFACE_STEP is not None and Camera.surface is None:
+                low, high = self.INPUT_DOMAIN
+                Camera.surface = control_surface.load_or_build(
+                    Camera.program,
+                    'rule.scm',
+                    inputs,
+                    outputs,
+                    (control_surface.axis('dir-x', low, high, SURFACE_STEP),
+                     control_surface.axis('dir-y', low, high, SURFACE_STEP),
+                     control_surface.axis('dist', 0, high, SURFACE_STEP)),
+                    '__rulecache__',
+                    max_sampled_error=SURFACE_MAX_SAMPLED_ERROR
+                )
 
     def draw(self, color):
         # Convert coordinate from Cartesian system to column-row system
@@ -274,20 +322,23 @@ class Camera:
             (-600, -10),
             (-100, 100),
             (10, 600),
-            (500, 1500)
+            (500, 1500),
+            domain=self.INPUT_DOMAIN
         )
         self.fdiry = fuzzy.FiveLevels(
             (-1500, -500),
             (-600, -10),
             (-100, 100),
             (10, 600),
-            (500, 1500)
+            (500, 1500),
+            domain=self.INPUT_DOMAIN
         )
         # Z, PS, PM
         self.fdist = fuzzy.ThreeLevelsPositive(
             (-10, 300),
             (250, 700),
-            (600, 1500)
+            (600, 1500),
+            domain=self.INPUT_DOMAIN
         )
         # NM, NS, Z, PS, PM
         self.fdx = fuzzy.FiveLevels(
@@ -313,13 +364,24 @@ class Camera:
 
     def fancy_ai(self, ball):
         self.ai_input.compute(ball)
-        self.ai_input.put_into(self.fuzzy_machine)
-        self.fuzzy_machine.run()
+        if self.surface is not None:
+            dx, dy, rot = self.surface.lookup(
+                self.ai_input.direction_vector[0],
+                self.ai_input.direction_vector[1],
+                self.ai_input.how_far_from_object,
+                self.fuzzy_machine
+            )
+        else:
+            self.ai_input.put_into(self.fuzzy_machine)
+            self.fuzzy_machine.run()
+            dx = self.fuzzy_machine.get_output('dx')
+            dy = self.fuzzy_machine.get_output('dy')
+            rot = self.fuzzy_machine.get_output('rot')
 
         return (
-            min(50, max(-50, self.fuzzy_machine.get_output('dx'))),
-            min(50, max(-50, self.fuzzy_machine.get_output('dy'))),
-            self.fuzzy_machine.get_output('rot')
+            min(50, max(-50, dx)),
+            min(50, max(-50, dy)),
+            rot
         )
 
 
@@ -0,0 +1,120 @@
+import io
+import os
+import time
+from collections import namedtuple
+
+import bytecode_compiler
+from dsl_parser import Accumulator, Cons, SchemeParser, Tokenizer, to_tuple
+
+# One top-level form of a rule file: its text, its structure as nested
+# tuples, the parsed form and its bytecode
+Form = namedtuple('Form', ('source', 'key', 'sexp', 'bytecode'))
+
+def split_forms(source):
+    """Split the text of a rule file into the text of each top-level form,
+    leaving out the comments and blanks between them
+    """
+    forms = []
+    depth = 0
+    start = 0
+    for match in Tokenizer.token_pattern.finditer(source):
+        group = match.lastindex
+        if group == 1:
+            if depth == 0:
+                start = match.start()
+            depth += 1
+        elif group == 2:
+            depth -= 1
+            if depth == 0:
+                forms.append(source[start:match.end()])
+            elif depth < 0:
+                raise ValueError('Unbalanced parenthesis')
+        elif group == 3 and depth == 0:
+            forms.append(match.group())
+    if depth != 0:
+        raise ValueError('Unbalanced parenthesis')
+    return forms
+
+
+class FormCache:
+    """The bytecode of each top-level form, so that a form is only parsed
+    and compiled again when it changes. Forms are looked up by their text,
+    and a form whose text changed but not its structure (e.g. only its
+    comments) is parsed but not compiled again.
+    """
+    def __init__(self):
+        # text of a form: its `Form`
+        self.entries = {}
+        # structure of a form: its bytecode
+        self.segments = {}
+        # the `Form`s of the last program, in order
+        self.forms = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(form):
+        # nested tuples hash and compare by structure
+        return to_tuple(Cons(form, None))[0]
+
+    def _form(self, source):
+        sexp = SchemeParser().parse(io.BytesIO(source)).car
+        key = self.key(sexp)
+        segment = self.segments.get(key)
+        if segment is None:
+            segment = bytecode_compiler.compile_to_bytecode(Cons(sexp, None))
+            self.segments[key] = segment
+            self.misses += 1
+        else:
+            self.hits += 1
+        return Form(source, key, sexp, segment)
+
+    def compile(self, source):
+        """Return the bytecode of the rule file whose text is `source`.
+        Forms that are no longer in the file are dropped from the cache.
+        """
+        entries = {}
+        forms = []
+        acc = Accumulator()
+        for text in split_forms(source):
+            form = entries.get(text) or self.entries.get(text)
+            if form is None:
+                form = self._form(text)
+            else:
+                self.hits += 1
+            entries[text] = form
+            forms.append(form)
+            acc.extend(form.bytecode)
+        self.entries = entries
+        self.segments = {form.key: form.bytecode for form in forms}
+        self.forms = forms
+        return acc.to_list()
+
+
+class RuleWatcher:
+    """Polls the modification time and size of a file"""
+    def __init__(self, path, poll_interval=1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.next_poll = time.monotonic() + poll_interval
+        self.signature = self._stat()
+
+    def _stat(self):
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def changed(self):
+        now = time.monotonic()
+        if now < self.next_poll:
+            return False
+        self.next_poll = now + self.poll_interval
+
+        try:
+            signature = self._stat()
+        except OSError:
+            # the editor may be replacing the file
+            return False
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
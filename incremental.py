@@ -0,0 +1,132 @@
+import active_rules
+import bytecode_compiler
+import optimizer
+import vm
+
+class IncrementalGenerator(vm.ActiveRuleGenerator):
+    """Generates a function that brings the cached state of an
+    `IncrementalVM` up to date with new inputs:
+
+        def update(inputs, last, memberships, strengths, sums): ...
+
+    `last` holds the inputs of the previous update, `memberships` the value
+    of every membership and `strengths` the value of every rule condition.
+    Only the memberships of the inputs that changed are computed again,
+    and only the rules that depend on them. The difference between the new
+    and the old strength of a rule is added to the levels it feeds (the
+    slots of a `fuzzy.DefuzzerBank`).
+    """
+    def __init__(self, rule_index, input_count, level_slots,
+                 member_functions):
+        super().__init__(rule_index, level_slots, member_functions)
+        self.input_count = input_count
+
+    def _slots(self, expression, result):
+        head = expression.instruction.car
+        if head is bytecode_compiler.SYM_CALL_FUNCTION_BY_REF:
+            result.add(self.rule_index.membership_slot(expression))
+        for operand in expression.operands:
+            self._slots(operand, result)
+        return result
+
+    def _emit_indented(self, emit, *args):
+        lines, self.lines = self.lines, []
+        emit(*args)
+        lines.extend('    ' + line for line in self.lines)
+        self.lines = lines
+
+    def _emit_update(self, number, rule):
+        self._emit('s = ' + self._condition(rule.condition))
+        self._emit('t = s - strengths[%d]' % number)
+        self._emit('if t:')
+        self._emit('    strengths[%d] = s' % number)
+        for feed in rule.feeds:
+            self._emit('    l%d += t' % self.level_slots[feed])
+
+    def compile(self):
+        index = self.rule_index
+        self.lines.append(
+            'def update(inputs, last, memberships, strengths, sums):')
+        changed = ['c%d' % i for i in range(self.input_count)]
+        for i in range(self.input_count):
+            self._emit('i%d = inputs[%d]' % (i, i))
+            self._emit('c%d = i%d != last[%d]' % (i, i, i))
+            self._emit('last[%d] = i%d' % (i, i))
+        self._emit('if not (%s):' % ' or '.join(changed))
+        self._emit('    return')
+
+        for i in range(self.input_count):
+            slots = sorted(slot for slot, j in index.inputs.items() if j == i)
+            if not slots:
+                continue
+            self._emit('if c%d:' % i)
+            for slot in slots:
+                self._emit_indented(self._emit_call, 'v%d' % slot, slot,
+                                    'i%d' % i)
+                self._emit('    memberships[%d] = v%d' % (slot, slot))
+            self._emit('else:')
+            for slot in slots:
+                self._emit('    v%d = memberships[%d]' % (slot, slot))
+
+        for k in range(self.level_count):
+            self._emit('l%d = sums[%d]' % (k, k))
+
+        # rules grouped by the inputs they depend on
+        groups = {}
+        for number, rule in enumerate(index.rules):
+            inputs = frozenset(index.inputs[slot] for slot in self._slots(
+                rule.condition, set()))
+            groups.setdefault(tuple(sorted(inputs)), []).append(
+                (number, rule))
+        for inputs, rules in sorted(groups.items()):
+            self._emit('if %s:' % ' or '.join('c%d' % i for i in inputs))
+            for number, rule in rules:
+                self._emit_indented(self._emit_update, number, rule)
+
+        for k in range(self.level_count):
+            self._emit('sums[%d] = l%d' % (k, k))
+
+        self.source = '\n'.join(self.lines) + '\n'
+        code = compile(self.source, '<rules>', 'exec')
+        exec(code, self.namespace)
+        return self.namespace['update']
+
+
+class IncrementalVM(vm.VM):
+    """A `vm.VM` that keeps the memberships and rule strengths of the last
+    `run` and only computes again what depends on the inputs that changed
+    since then (see `IncrementalGenerator`).
+
+    With `full` (which may be changed at any time), every `run` starts from
+    an empty state and computes everything, like `vm.VM`, to check that
+    the incremental results are the same.
+    """
+    def __init__(self, inputs, outputs, rule_path, full=False, **kwargs):
+        self.full = full
+        super().__init__(inputs, outputs, rule_path, **kwargs)
+
+    def _load(self, bytecode):
+        super()._load(bytecode)
+        self.rule_index = active_rules.RuleIndex(
+            optimizer.optimize_rules(self.indexed, self.optimizations),
+            self.member_functions)
+        self.update = IncrementalGenerator(
+            self.rule_index, len(self.input_to_index), self.level_slots,
+            self.member_functions
+        ).compile()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the state, so that the next `run` computes everything"""
+        self.last = [None] * len(self.input_to_index)
+        self.memberships = [0] * len(self.member_functions)
+        self.strengths = [0] * len(self.rule_index.rules)
+        self.bank.reset()
+
+    def run(self):
+        if self.watcher is not None and self.watcher.changed():
+            self.reload()
+        if self.full:
+            self.invalidate()
+        self.update(self.inputs, self.last, self.memberships,
+                    self.strengths, self.bank.sums)
@@ -0,0 +1,275 @@
+import time
+from collections import namedtuple
+
+from dsl_parser import Accumulator, Cons
+from bytecode_compiler import (
+    INDEXED_PURE_ARITY, SYM_CALL_FUNCTION_BY_REF, SYM_FEED_DEFUZZER_FAST,
+    SYM_FEED_DEFUZZER_FAST_POP, SYM_GET_INPUT_BY_INDEX, SYM_MAX, SYM_MAX_N,
+    SYM_MEMBERSHIP_OF_INPUT, SYM_MIN, SYM_MIN_N, SYM_POP, Expression,
+    compute_buffer_length, eliminate_common_subexpressions,
+    eliminate_common_subexpressions_in_statements, instruction_length,
+    split_expressions,
+)
+
+# The passes below rewrite the bytecode produced by
+# `Constants.eliminate_map_lookup`. None of them changes the outputs.
+
+Stats = namedtuple('Stats', ('name', 'instructions_before',
+                             'instructions_after', 'words_before',
+                             'words_after', 'seconds'))
+
+# An expression whose value is always 0
+ZERO = Expression(('%zero',), None, ())
+
+def _emit(acc, expression):
+    for operand in expression.operands:
+        _emit(acc, operand)
+    acc.append(expression.instruction)
+
+def _instructions(statement):
+    """The instructions of a statement of `split_expressions`"""
+    if not isinstance(statement, Expression):
+        yield statement
+        return
+    for operand in statement.operands:
+        yield from _instructions(operand)
+    yield statement.instruction
+
+def _emit_statements(statements):
+    acc = Accumulator()
+    for statement in statements:
+        if isinstance(statement, Expression):
+            _emit(acc, statement)
+        else:
+            acc.append(statement)
+    return acc.to_list()
+
+def _rule_end(statements, idx):
+    """If `statements[idx]` is followed by any number of feeds and a pop,
+    return the index of the pop
+    """
+    idx += 1
+    while (idx < len(statements)
+           and not isinstance(statements[idx], Expression)
+           and statements[idx].car is SYM_FEED_DEFUZZER_FAST):
+        idx += 1
+    if (idx < len(statements)
+            and not isinstance(statements[idx], Expression)
+            and statements[idx].car is SYM_POP):
+        return idx
+    return None
+
+def remove_dead_rules(bytecode):
+    """Delete the expressions that are popped without being fed to any
+    defuzzer
+    """
+    statements = split_expressions(bytecode, INDEXED_PURE_ARITY)
+    result = []
+    idx = 0
+    while idx < len(statements):
+        statement = statements[idx]
+        if (isinstance(statement, Expression)
+                and _rule_end(statements, idx) == idx + 1):
+            idx += 2
+            continue
+        result.append(statement)
+        idx += 1
+    return _emit_statements(result)
+
+def _is_membership(expression):
+    # memberships and their minimum and maximum are never negative
+    if expression.instruction is None:
+        return True
+    head = expression.instruction.car
+    if head is SYM_CALL_FUNCTION_BY_REF or head is SYM_MEMBERSHIP_OF_INPUT:
+        return True
+    if head is SYM_MIN or head is SYM_MAX:
+        return all(_is_membership(e) for e in expression.operands)
+    return False
+
+def _fold(expression):
+    head = expression.instruction.car
+    if head is SYM_CALL_FUNCTION_BY_REF or head is SYM_MEMBERSHIP_OF_INPUT:
+        function = expression.instruction.cdr.car
+        if head is SYM_MEMBERSHIP_OF_INPUT:
+            function = expression.instruction.cdr.cdr.car
+        if function.x1 == function.x3:
+            return ZERO
+        return expression
+    if head is not SYM_MIN and head is not SYM_MAX:
+        return expression
+
+    operands = tuple(_fold(e) for e in expression.operands)
+    if any(e is ZERO for e in operands):
+        if not all(_is_membership(e) for e in operands):
+            return expression
+        if head is SYM_MIN:
+            # min(0, x) = 0
+            return ZERO
+        # max(0, x) = x
+        others = [e for e in operands if e is not ZERO]
+        return others[0] if others else ZERO
+    if operands == expression.operands:
+        return expression
+    key = (expression.key[0],) + tuple(e.key for e in operands)
+    return Expression(key, expression.instruction, operands)
+
+def fold_never_firing_rules(bytecode):
+    """Delete the rules whose condition is always 0 because it needs a level
+    with an empty support (x1 == x3). Feeding 0 does not change a defuzzer.
+    """
+    statements = split_expressions(bytecode, INDEXED_PURE_ARITY)
+    result = []
+    idx = 0
+    while idx < len(statements):
+        statement = statements[idx]
+        if isinstance(statement, Expression):
+            end = _rule_end(statements, idx)
+            if end is not None:
+                folded = _fold(statement)
+                if folded is ZERO:
+                    idx = end + 1
+                    continue
+                statement = folded
+        result.append(statement)
+        idx += 1
+    return _emit_statements(result)
+
+def flatten_min_max(bytecode):
+    """Replace k consecutive %min (or %max) by one (%min-n k+1), which
+    reduces the k+1 values on top of the stack
+    """
+    acc = Accumulator()
+    while bytecode is not None:
+        instruction = bytecode.car
+        head = instruction.car
+        if head is SYM_MIN or head is SYM_MAX:
+            count = 1
+            while bytecode.cdr is not None and bytecode.cdr.car.car is head:
+                count += 1
+                bytecode = bytecode.cdr
+            if count > 1:
+                nary = SYM_MIN_N if head is SYM_MIN else SYM_MAX_N
+                instruction = Cons(nary, Cons(count + 1, None))
+        acc.append(instruction)
+        bytecode = bytecode.cdr
+    return acc.to_list()
+
+def fuse_feed_pop(bytecode):
+    """Replace a %feed-defuzzer-fast followed by %pop with
+    %feed-defuzzer-fast-pop
+    """
+    acc = Accumulator()
+    while bytecode is not None:
+        instruction = bytecode.car
+        if (instruction.car is SYM_FEED_DEFUZZER_FAST
+                and bytecode.cdr is not None
+                and bytecode.cdr.car.car is SYM_POP):
+            instruction = Cons(SYM_FEED_DEFUZZER_FAST_POP, instruction.cdr)
+            bytecode = bytecode.cdr
+        acc.append(instruction)
+        bytecode = bytecode.cdr
+    return acc.to_list()
+
+def fuse_membership_of_input(bytecode):
+    """Replace a %get-input-by-index followed by %call-function-by-ref with
+    (%membership-of-input <input index> <function>)
+    """
+    acc = Accumulator()
+    while bytecode is not None:
+        instruction = bytecode.car
+        if (instruction.car is SYM_GET_INPUT_BY_INDEX
+                and bytecode.cdr is not None
+                and bytecode.cdr.car.car is SYM_CALL_FUNCTION_BY_REF):
+            instruction = Cons(SYM_MEMBERSHIP_OF_INPUT, Cons(
+                instruction.cdr.car, bytecode.cdr.car.cdr))
+            bytecode = bytecode.cdr
+        acc.append(instruction)
+        bytecode = bytecode.cdr
+    return acc.to_list()
+
+def eliminate_common_subexpressions_indexed(bytecode):
+    return eliminate_common_subexpressions(bytecode, INDEXED_PURE_ARITY)
+
+OPTIMIZATIONS = {
+    'never-fire': fold_never_firing_rules,
+    'dead-rules': remove_dead_rules,
+    'cse': eliminate_common_subexpressions_indexed,
+    'nary-min-max': flatten_min_max,
+    'fuse-feed-pop': fuse_feed_pop,
+    'fuse-membership': fuse_membership_of_input,
+}
+DEFAULT_PIPELINE = ('never-fire', 'dead-rules', 'cse', 'nary-min-max',
+                    'fuse-feed-pop', 'fuse-membership')
+# The passes after which every rule is still a condition followed by its
+# feeds, as `active_rules.split_rules` reads them. The others only change
+# how the rules are encoded.
+RULE_PASSES = ('never-fire', 'dead-rules')
+# The passes whose result depends on the member functions of the program,
+# not only on the bytecode
+FUNCTION_PASSES = ('never-fire',)
+# The passes that only look inside a rule. A program is the concatenation
+# of its rules, so they may run on each part of a program that holds whole
+# rules (e.g. each top-level form) instead of the whole program.
+LOCAL_PASSES = ('never-fire', 'dead-rules', 'nary-min-max', 'fuse-feed-pop',
+                'fuse-membership')
+
+def optimize(bytecode, pipeline=DEFAULT_PIPELINE, stats=None):
+    """Run the passes named in `pipeline` in order. With `stats`, append
+    the `Stats` of each pass to it.
+    """
+    for name in pipeline:
+        optimization = OPTIMIZATIONS[name]
+        if stats is None:
+            bytecode = optimization(bytecode)
+            continue
+
+        instructions = len(bytecode) if bytecode is not None else 0
+        words = compute_buffer_length(bytecode)
+        start = time.perf_counter()
+        bytecode = optimization(bytecode)
+        elapsed = time.perf_counter() - start
+        stats.append(Stats(
+            name, instructions,
+            len(bytecode) if bytecode is not None else 0,
+            words, compute_buffer_length(bytecode), elapsed
+        ))
+    return bytecode
+
+def optimize_rules(bytecode, pipeline=DEFAULT_PIPELINE):
+    """Run the passes of `pipeline` that are in `RULE_PASSES`, for the
+    engines that generate their code from an `active_rules.RuleIndex`
+    """
+    return optimize(bytecode, [name for name in pipeline
+                               if name in RULE_PASSES])
+
+def split_pipeline(pipeline=DEFAULT_PIPELINE):
+    """Split `pipeline` into the `LOCAL_PASSES` at its start and the rest"""
+    pipeline = tuple(pipeline)
+    count = 0
+    while count < len(pipeline) and pipeline[count] in LOCAL_PASSES:
+        count += 1
+    return pipeline[:count], pipeline[count:]
+
+def optimize_statements(statements, pipeline=DEFAULT_PIPELINE, stats=None):
+    """`optimize` the program that `statements` (see `split_expressions`
+    with `INDEXED_PURE_ARITY`) is made of. If `pipeline` starts with 'cse',
+    the statements are not split again for it.
+    """
+    if not pipeline or pipeline[0] != 'cse':
+        return optimize(_emit_statements(statements), pipeline, stats)
+    start = time.perf_counter()
+    bytecode = eliminate_common_subexpressions_in_statements(statements)
+    if stats is not None:
+        instructions = words = 0
+        for statement in statements:
+            for instruction in _instructions(statement):
+                instructions += 1
+                words += instruction_length(instruction)
+        stats.append(Stats(
+            'cse', instructions,
+            len(bytecode) if bytecode is not None else 0,
+            words, compute_buffer_length(bytecode),
+            time.perf_counter() - start
+        ))
+    return optimize(bytecode, pipeline[1:], stats)
@@ -0,0 +1,118 @@
+import time
+
+import transform
+from dsl_parser import AllocationCounter
+
+class PassProfile:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        # traversals of the program until nothing changes, summed over the
+        # forms for passes that run on each top-level form
+        self.iterations = 0
+        self.cons_cells = 0
+        # rule name: [match attempts, successes]
+        self.transforms = {}
+
+    @property
+    def attempts(self):
+        return sum(counts[0] for counts in self.transforms.values())
+
+    @property
+    def successes(self):
+        return sum(counts[1] for counts in self.transforms.values())
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'iterations': self.iterations,
+            'cons_cells': self.cons_cells,
+            'attempts': self.attempts,
+            'successes': self.successes,
+            'transforms': {name: {'attempts': a, 'successes': s}
+                           for name, (a, s) in self.transforms.items()},
+        }
+
+
+class CompileProfile:
+    """Collects a `PassProfile` for every pass of
+    `bytecode_compiler.compile_to_bytecode(sexp, profile=...)`.
+
+    While a pass is measured, `Transform._try_transform` and `Cons.__init__`
+    are patched to count match attempts and allocations, so profiling
+    costs nothing when it is off.
+    """
+    active = None
+
+    def __init__(self):
+        self.passes = {}
+        self.current = None
+
+    def measure(self, name):
+        if name not in self.passes:
+            self.passes[name] = PassProfile(name)
+        return _Measurement(self, self.passes[name])
+
+    def report(self):
+        return [p.as_dict() for p in self.passes.values()]
+
+    def format(self):
+        lines = ['%-28s %9s %6s %9s %9s %10s' % (
+            'pass', 'seconds', 'iters', 'attempts', 'successes', 'cells')]
+        for p in self.passes.values():
+            lines.append('%-28s %9.4f %6d %9d %9d %10d' % (
+                p.name, p.seconds, p.iterations, p.attempts, p.successes,
+                p.cons_cells))
+            for name, (attempts, successes) in p.transforms.items():
+                lines.append('  %-26s %16s %9d %9d' % (
+                    name, '', attempts, successes))
+        total = sum(p.seconds for p in self.passes.values())
+        lines.append('%-28s %9.4f' % ('total', total))
+        return '\n'.join(lines)
+
+
+def count_iteration():
+    """Called by the pass runners once per traversal of the program"""
+    profile = CompileProfile.active
+    if profile is not None:
+        profile.current.iterations += 1
+
+
+class _Measurement:
+    def __init__(self, profile, pass_profile):
+        self.profile = profile
+        self.pass_profile = pass_profile
+        self.allocations = AllocationCounter()
+        self.original_try_transform = None
+        self.start = None
+
+    def __enter__(self):
+        transforms = self.pass_profile.transforms
+        original = transform.Transform._try_transform
+
+        def counting(rule, sexp):
+            counts = transforms.get(rule.name)
+            if counts is None:
+                counts = transforms[rule.name] = [0, 0]
+            counts[0] += 1
+            result = original(rule, sexp)
+            if result is not transform.UNCHANGED:
+                counts[1] += 1
+            return result
+
+        self.original_try_transform = original
+        transform.Transform._try_transform = counting
+        self.profile.current = self.pass_profile
+        CompileProfile.active = self.profile
+        self.allocations.__enter__()
+        self.start = time.perf_counter()
+        return self.pass_profile
+
+    def __exit__(self, *exc_info):
+        self.pass_profile.seconds += time.perf_counter() - self.start
+        self.allocations.__exit__(*exc_info)
+        self.pass_profile.cons_cells += self.allocations.count
+        CompileProfile.active = None
+        self.profile.current = None
+        transform.Transform._try_transform = self.original_try_transform
@@ -0,0 +1,58 @@
+import unittest
+
+import fuzzy
+import vm
+from test_vm import OUTPUTS, RULE_PATH, SAMPLES, member_functions, run
+
+try:
+    import numpy as np
+    import batch_vm
+except ImportError:
+    np = None
+
+# beyond the supports of every member function, on both sides
+OUT_OF_DOMAIN = [(-5000, 0, 400), (5000, -5000, 2000), (300, 5000, -300),
+                 (-1500, 1500, 1500), (0, 0, -10)]
+
+
+@unittest.skipIf(np is None, 'NumPy is not installed')
+class BatchVMTest(unittest.TestCase):
+    def run_batch(self, machine, samples):
+        columns = [np.array(column) for column in zip(*samples)]
+        result = machine.run(dict(zip(('dir-x', 'dir-y', 'dist'), columns)))
+        return list(zip(*(result[key].tolist() for key in OUTPUTS)))
+
+    def test_agrees_with_vm(self):
+        samples = SAMPLES + OUT_OF_DOMAIN
+        for method in fuzzy.DEFUZZIFICATIONS:
+            with self.subTest(method=method):
+                expected = run(vm.VM(*member_functions(), RULE_PATH,
+                                     defuzzification=method), samples)
+                machine = batch_vm.BatchVM(*member_functions(), RULE_PATH,
+                                           defuzzification=method)
+                self.assertEqual(self.run_batch(machine, samples), expected)
+
+    def test_shape(self):
+        machine = batch_vm.BatchVM(*member_functions(), RULE_PATH)
+        expected = run(vm.VM(*member_functions(), RULE_PATH), SAMPLES[:6])
+        columns = [np.array(column).reshape(2, 3)
+                   for column in zip(*SAMPLES[:6])]
+        result = machine.run(dict(zip(('dir-x', 'dir-y', 'dist'), columns)))
+        for i, key in enumerate(OUTPUTS):
+            self.assertEqual(result[key].shape, (2, 3))
+            self.assertEqual(result[key].ravel().tolist(),
+                             [outputs[i] for outputs in expected])
+
+    def test_bad_inputs(self):
+        machine = batch_vm.BatchVM(*member_functions(), RULE_PATH)
+        with self.assertRaises(ValueError):
+            machine.run({'dir-x': np.zeros(3), 'dir-y': np.zeros(3, int),
+                         'dist': np.zeros(3, int)})
+        with self.assertRaises(ValueError):
+            machine.run({'dir-x': np.zeros(3, int),
+                         'dir-y': np.zeros(2, int),
+                         'dist': np.zeros(3, int)})
+
+
+if __name__ == '__main__':
+    unittest.main()
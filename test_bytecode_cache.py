@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+import bytecode_cache
+import bytecode_compiler
+from dsl_parser import SchemeParser, to_tuple
+
+RULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'rule.scm')
+
+
+def compile_rules(path):
+    with open(path, 'rb') as fd:
+        forms = SchemeParser().iter_parse(fd)
+        return bytecode_compiler.compile_stream_to_bytecode(forms)
+
+
+class BytecodeCacheTest(unittest.TestCase):
+    def test_encode_decode(self):
+        bytecode = compile_rules(RULE_PATH)
+        decoded = bytecode_cache.decode(bytecode_cache.encode(bytecode))
+        self.assertEqual(to_tuple(decoded), to_tuple(bytecode))
+
+    def test_load_or_compile(self):
+        expected = to_tuple(compile_rules(RULE_PATH))
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(to_tuple(bytecode_cache.load_or_compile(
+                RULE_PATH, directory)), expected)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            # the second time, from the cache file
+            self.assertEqual(to_tuple(bytecode_cache.load_or_compile(
+                RULE_PATH, directory)), expected)
+
+    def test_not_a_cache_file(self):
+        with self.assertRaises(ValueError):
+            bytecode_cache.decode(b'\0' * bytecode_cache.HEADER.size)
+
+    def test_truncated(self):
+        data = bytecode_cache.encode(compile_rules(RULE_PATH))
+        for size in range(len(data)):
+            with self.subTest(size=size):
+                with self.assertRaises(ValueError):
+                    bytecode_cache.decode(data[:size])
+
+    def test_load_or_compile_truncated(self):
+        expected = to_tuple(compile_rules(RULE_PATH))
+        with tempfile.TemporaryDirectory() as directory:
+            bytecode_cache.load_or_compile(RULE_PATH, directory)
+            (name,) = os.listdir(directory)
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            for size in (0, 5, 20, len(data) - 40, len(data) - 4):
+                with self.subTest(size=size):
+                    with open(path, 'wb') as fd:
+                        fd.write(data[:size])
+                    self.assertEqual(to_tuple(bytecode_cache.load_or_compile(
+                        RULE_PATH, directory)), expected)
+                    # compiled again and stored whole
+                    with open(path, 'rb') as fd:
+                        self.assertEqual(fd.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+import control_surface
+import vm
+from control_surface import ControlSurface, axis
+from test_vm import OUTPUTS, RULE_PATH, member_functions
+
+AXES = (axis('dir-x', -640, 640, 320), axis('dir-y', -640, 640, 320),
+        axis('dist', 0, 640, 320))
+
+
+class TestControlSurface(unittest.TestCase):
+    def setUp(self):
+        self.machine = vm.VM(*member_functions(), RULE_PATH)
+        self.surface = ControlSurface.build(self.machine, AXES, OUTPUTS,
+                                            probes=2)
+
+    def test_grid_points_are_exact(self):
+        for point in control_surface._points(AXES):
+            self.assertEqual(self.surface.lookup(*point),
+                             self.surface.run(self.machine, *point))
+
+    def test_encode_decode(self):
+        surface = ControlSurface.decode(self.surface.encode())
+        self.assertEqual(surface.axes, self.surface.axes)
+        self.assertEqual(surface.output_names, OUTPUTS)
+        self.assertEqual(list(surface.values), list(self.surface.values))
+        self.assertEqual(list(surface.errors), list(self.surface.errors))
+
+    def test_truncated(self):
+        data = self.surface.encode()
+        for size in range(len(data)):
+            for copy in (True, False):
+                with self.subTest(size=size, copy=copy):
+                    with self.assertRaises(ValueError):
+                        ControlSurface.decode(data[:size], copy=copy)
+
+    def test_load_or_build_truncated(self):
+        inputs, outputs = member_functions()
+        program = vm.Program(inputs, outputs, RULE_PATH)
+        expected = ControlSurface.build(program.instance(), AXES, OUTPUTS)
+        with tempfile.TemporaryDirectory() as directory:
+            surface = control_surface.load_or_build(
+                program, RULE_PATH, inputs, outputs, AXES, directory)
+            surface.close()
+            (name,) = os.listdir(directory)
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as fd:
+                data = fd.read()
+            for size in (0, 10, len(data) // 2, len(data) - 1):
+                with self.subTest(size=size):
+                    with open(path, 'wb') as fd:
+                        fd.write(data[:size])
+                    surface = control_surface.load_or_build(
+                        program, RULE_PATH, inputs, outputs, AXES,
+                        directory)
+                    self.assertEqual(list(surface.values),
+                                     list(expected.values))
+                    surface.close()
+                    with open(path, 'rb') as fd:
+                        self.assertEqual(fd.read(), data)
+
+    def test_max_sampled_error(self):
+        self.assertTrue(any(self.surface.errors))
+        self.surface.max_sampled_error = 0
+        # at its probes, a cell is either exact or runs the program
+        for point in ((-534, -427, 106), (-214, -107, 213), (106, 213, 426)):
+            self.assertEqual(self.surface.lookup(*point, self.machine),
+                             self.surface.run(self.machine, *point))
+
+
+if __name__ == '__main__':
+    unittest.main()
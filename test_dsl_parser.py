@@ -0,0 +1,52 @@
+import io
+import unittest
+
+from dsl_parser import SchemeParser, Tokenizer, to_tuple
+
+SOURCE = b'''; a comment that is longer than the smallest buffers
+(if (and (is dir-x PM) (is a-rather-long-symbol-name PS))
+    (feed dx NM)) ; trailing comment
+(define-rule (x y) (+ x y))
+'''
+
+
+def tokens(source, mode, size):
+    result = []
+    tokenizer = Tokenizer(result.append, lambda: result.append('('),
+                          lambda: result.append(')'), mode)
+    tokenizer.b = Tokenizer.Buffer(size)
+    tokenizer.tokenize(io.BytesIO(source))
+    return result
+
+
+class TokenizerTest(unittest.TestCase):
+    def test_buffer_boundaries(self):
+        expected = tokens(SOURCE, Tokenizer.Mode.per_character, 65536)
+        self.assertIn('a-rather-long-symbol-name', expected)
+        for mode in Tokenizer.Mode:
+            for size in range(1, 40):
+                with self.subTest(mode=mode.name, size=size):
+                    self.assertEqual(tokens(SOURCE, mode, size), expected)
+
+    def test_symbol_at_end_of_file(self):
+        for mode in Tokenizer.Mode:
+            for size in (1, 2, 3, 4096):
+                with self.subTest(mode=mode.name, size=size):
+                    self.assertEqual(tokens(b'(a) last', mode, size),
+                                     ['(', 'a', ')', 'last'])
+
+
+class SchemeParserTest(unittest.TestCase):
+    def test_iter_parse_matches_parse(self):
+        forms = to_tuple(SchemeParser().parse(io.BytesIO(SOURCE)))
+        self.assertEqual(len(forms), 2)
+        self.assertEqual(tuple(to_tuple(form) for form in SchemeParser(
+        ).iter_parse(io.BytesIO(SOURCE))), forms)
+
+    def test_unbalanced(self):
+        with self.assertRaises(ValueError):
+            SchemeParser().parse(io.BytesIO(b'(a (b)'))
+
+
+if __name__ == '__main__':
+    unittest.main()
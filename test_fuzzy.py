@@ -0,0 +1,89 @@
+import itertools
+import unittest
+from array import array
+
+import fuzzy
+
+M = fuzzy.TriangleFunction.M
+OUTPUT_LEVELS = (((-30, -15), (-20, -5), (-9, 9)),
+                 ((-100, -50), (-50, 50), (50, 100)))
+
+
+def reference_defuzz(method, levels, sums):
+    """The value of a `fuzzy.DefuzzerBank` output, computed from the
+    definitions of the methods. `levels` holds the (slot, function) of
+    each level of the output.
+    """
+    if method == 'weighted-average':
+        return (sum(f.x2 * sums[k] for k, f in levels)
+                // max(1, sum(sums[k] for k, _ in levels)))
+    heights = [(min(sums[k], M), f) for k, f in levels]
+    if method == 'mean-of-maxima':
+        height = max([0] + [h for h, _ in heights])
+        if height <= 0:
+            return 0
+        ys = [y for h, f in heights if h == height
+              for y in range(f.x1 + 1, f.x3) if f(y) >= height]
+        return sum(ys) // max(1, len(ys))
+    values = [(min(h, f(y)), y) for h, f in heights
+              for y in range(f.x1 + 1, f.x3)]
+    return (sum(v * y for v, y in values)
+            // max(1, sum(v for v, _ in values)))
+
+
+class DefuzzerBankTest(unittest.TestCase):
+    def test_methods(self):
+        levels = []
+        slots = []
+        for output, points in enumerate(OUTPUT_LEVELS):
+            slots.append([])
+            for x1, x3 in points:
+                function = fuzzy.TriangleFunction(x1, x3)
+                slots[output].append((len(levels), function))
+                levels.append((output, [function]))
+
+        strengths = (0, 1, 100, M, M + 50)
+        for method in fuzzy.DEFUZZIFICATIONS:
+            bank = fuzzy.DefuzzerBank(len(OUTPUT_LEVELS), levels, method)
+            for sums in itertools.product(strengths, repeat=3):
+                bank.sums[:] = array('q', sums * 2)
+                for output, output_slots in enumerate(slots):
+                    with self.subTest(method=method, sums=sums,
+                                      output=output):
+                        self.assertEqual(
+                            bank.defuzz(output),
+                            reference_defuzz(method, output_slots,
+                                             bank.sums))
+
+
+
+class TableTriangleFunctionTest(unittest.TestCase):
+    def test_agrees_with_triangle_function(self):
+        domain = (-200, 200)
+        # inside, across the edges and outside of the domain; with even
+        # and odd widths, a zero-width slope and a single point
+        for x1, x3 in ((-100, 100), (-150, 250), (-300, -150), (150, 151),
+                       (-7, 8), (50, 50), (-250, 300)):
+            expected = fuzzy.TriangleFunction(x1, x3)
+            function = fuzzy.TableTriangleFunction(x1, x3, domain)
+            for x in range(-320, 321):
+                with self.subTest(x1=x1, x3=x3, x=x):
+                    self.assertEqual(function(x), expected(x))
+
+    def test_table_cache_is_bounded(self):
+        domain = (0, 10)
+        first = fuzzy.TableTriangleFunction(0, 10, domain)
+        self.assertIs(fuzzy.TableTriangleFunction(0, 10, domain).table,
+                      first.table)
+        for x3 in range(11, 11 + fuzzy.TABLE_CACHE_SIZE):
+            fuzzy.TableTriangleFunction(0, x3, domain)
+        self.assertLessEqual(len(fuzzy._TABLES), fuzzy.TABLE_CACHE_SIZE)
+        # the dropped table is made again and still used by `first`
+        again = fuzzy.TableTriangleFunction(0, 10, domain)
+        self.assertIsNot(again.table, first.table)
+        self.assertEqual(again.table, first.table)
+        self.assertEqual([first(x) for x in range(12)],
+                         [again(x) for x in range(12)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import io
+import os
+import tempfile
+import unittest
+
+import bytecode_compiler
+import hot_reload
+from dsl_parser import SchemeParser, to_tuple
+from test_vm import RULE_PATH
+
+SOURCE = b'''; rules
+(if (is dist Z) (set! dx PM)) ; same structure as the last form
+(if (and (is dir-x PM)
+         (is dir-y PS))
+    (set! rot NM))
+(if (is dist Z)
+    (set! dx PM))
+'''
+
+
+def compile_source(source):
+    return bytecode_compiler.compile_to_bytecode(
+        SchemeParser().parse(io.BytesIO(source)))
+
+
+class FormCacheTest(unittest.TestCase):
+    def test_split_forms(self):
+        self.assertEqual(hot_reload.split_forms(SOURCE), [
+            b'(if (is dist Z) (set! dx PM))',
+            b'(if (and (is dir-x PM)\n         (is dir-y PS))\n'
+            b'    (set! rot NM))',
+            b'(if (is dist Z)\n    (set! dx PM))',
+        ])
+        for source in (b'(if (is dist Z)', b'(is dist Z))'):
+            with self.subTest(source=source):
+                with self.assertRaises(ValueError):
+                    hot_reload.split_forms(source)
+
+    def test_compile(self):
+        with open(RULE_PATH, 'rb') as fd:
+            source = fd.read()
+        cache = hot_reload.FormCache()
+        self.assertEqual(to_tuple(cache.compile(source)),
+                         to_tuple(compile_source(source)))
+        forms = len(hot_reload.split_forms(source))
+        self.assertEqual(len(cache.forms), forms)
+        self.assertEqual(cache.hits + cache.misses, forms)
+
+        misses = cache.misses
+        self.assertEqual(to_tuple(cache.compile(source)),
+                         to_tuple(compile_source(source)))
+        self.assertEqual(cache.misses, misses)
+
+    def test_only_changed_forms_are_compiled(self):
+        cache = hot_reload.FormCache()
+        cache.compile(SOURCE)
+        # the first and the last form only differ by their text
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        self.assertIs(cache.forms[0].bytecode, cache.forms[2].bytecode)
+
+        # a form whose layout changed is parsed but not compiled again
+        edited = SOURCE.replace(b'(set! rot NM))', b'(set! rot  NM))')
+        cache.compile(edited)
+        self.assertEqual((cache.hits, cache.misses), (4, 2))
+
+        edited = edited.replace(b'(set! rot  NM)', b'(set! rot PM)')
+        self.assertEqual(to_tuple(cache.compile(edited)),
+                         to_tuple(compile_source(edited)))
+        self.assertEqual((cache.hits, cache.misses), (6, 3))
+        # the forms that are no longer in the file are dropped
+        self.assertEqual(len(cache.entries), 3)
+        self.assertEqual(len(cache.segments), 2)
+
+
+class RuleWatcherTest(unittest.TestCase):
+    def test_changed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rules.scm')
+            with open(path, 'wb') as fd:
+                fd.write(SOURCE)
+            watcher = hot_reload.RuleWatcher(path, poll_interval=0)
+            self.assertFalse(watcher.changed())
+
+            with open(path, 'ab') as fd:
+                fd.write(b'(if (is dist PM) (set! dx NM))')
+            self.assertTrue(watcher.changed())
+            self.assertFalse(watcher.changed())
+
+            # the same size, only the modification time changed
+            st = os.stat(path)
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertTrue(watcher.changed())
+
+            # while the file is being replaced
+            os.remove(path)
+            self.assertFalse(watcher.changed())
+
+    def test_poll_interval(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rules.scm')
+            with open(path, 'wb') as fd:
+                fd.write(SOURCE)
+            watcher = hot_reload.RuleWatcher(path, poll_interval=3600)
+            with open(path, 'ab') as fd:
+                fd.write(b'(if (is dist PM) (set! dx NM))')
+            self.assertFalse(watcher.changed())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import time
+import unittest
+
+import bytecode_compiler
+import profiler
+import transform
+from dsl_parser import Cons, SchemeParser, to_tuple
+from test_transform import RULE_PATH
+
+
+def parse_rules():
+    with open(RULE_PATH, 'rb') as fd:
+        return SchemeParser().parse(fd)
+
+
+class CompileProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.try_transform = transform.Transform._try_transform
+        self.cons_init = Cons.__init__
+
+    def assertRestored(self):
+        self.assertIs(transform.Transform._try_transform, self.try_transform)
+        self.assertIs(Cons.__init__, self.cons_init)
+        self.assertIsNone(profiler.CompileProfile.active)
+
+    def test_compile(self):
+        expected = bytecode_compiler.compile_to_bytecode(parse_rules())
+        sexp = parse_rules()
+        profile = profiler.CompileProfile()
+        start = time.perf_counter()
+        bytecode = bytecode_compiler.compile_to_bytecode(sexp,
+                                                         profile=profile)
+        seconds = time.perf_counter() - start
+        self.assertRestored()
+        self.assertEqual(to_tuple(bytecode), to_tuple(expected))
+
+        self.assertEqual(list(profile.passes),
+                         [p.name for p in bytecode_compiler.PASSES])
+        for p in profile.passes.values():
+            self.assertGreaterEqual(p.seconds, 0)
+            self.assertGreaterEqual(p.iterations, 1)
+            for name, (attempts, successes) in p.transforms.items():
+                self.assertLessEqual(successes, attempts, name)
+        self.assertLessEqual(
+            sum(p.seconds for p in profile.passes.values()), seconds)
+        self.assertGreater(
+            sum(p.successes for p in profile.passes.values()), 0)
+        self.assertGreater(
+            sum(p.cons_cells for p in profile.passes.values()), 0)
+        report = profile.format()
+        for name in profile.passes:
+            self.assertIn(name, report)
+
+    def test_restored_after_exception(self):
+        profile = profiler.CompileProfile()
+        with self.assertRaises(RuntimeError):
+            with profile.measure('failing'):
+                self.assertIsNot(transform.Transform._try_transform,
+                                 self.try_transform)
+                self.assertIsNot(Cons.__init__, self.cons_init)
+                Cons(None, None)
+                raise RuntimeError('in a pass')
+        self.assertRestored()
+        self.assertEqual(profile.passes['failing'].cons_cells, 1)
+
+        # the next measurement starts from the original methods
+        with profile.measure('failing'):
+            Cons(None, None)
+        self.assertRestored()
+        self.assertEqual(profile.passes['failing'].cons_cells, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
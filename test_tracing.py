@@ -0,0 +1,68 @@
+import unittest
+
+import fuzzy
+import tracing
+from test_vm import RULE_PATH, member_functions
+
+
+class TestTracing(unittest.TestCase):
+    def trace(self, method):
+        machine = tracing.TracingVM(*member_functions(), RULE_PATH,
+                                    defuzzification=method)
+        machine.input('dir-x', 300)
+        machine.input('dir-y', -200)
+        machine.input('dist', 400)
+        machine.run()
+        return machine
+
+    def test_contributions(self):
+        machine = self.trace('weighted-average')
+        contributions = machine.contributions(machine.ticks[-1])
+        self.assertTrue(contributions['rot'])
+        for rule, strength in contributions['rot']:
+            self.assertEqual(rule.output, 'rot')
+            self.assertGreater(strength, 0)
+
+    def test_firings_add_up_to_sums(self):
+        inputs, outputs = member_functions()
+        # a level no input reaches, so that its rules feed 0
+        inputs['dist'] = inputs['dist']._replace(
+            PM=fuzzy.TriangleFunction(600, 600))
+        machine = tracing.TracingVM(inputs, outputs, RULE_PATH)
+        for x, y, dist in ((300, -200, 400), (-500, 100, 50), (0, 0, 0)):
+            machine.input('dir-x', x)
+            machine.input('dir-y', y)
+            machine.input('dist', dist)
+            machine.run()
+            tick = machine.ticks[-1]
+            self.assertEqual(len(tick.firings), len(machine.feed_rules))
+            sums = [0] * len(tick.sums)
+            for rule, strength in tick.firings:
+                slot = machine.level_slots[
+                    (machine.output_to_index[rule.output], rule.y2)]
+                sums[slot] += strength
+            self.assertEqual(sums, list(tick.sums))
+
+    def test_ring_buffer(self):
+        machine = tracing.TracingVM(*member_functions(), RULE_PATH,
+                                    capacity=3)
+        machine.input('dir-x', 300)
+        machine.input('dir-y', -200)
+        for dist in range(5):
+            machine.input('dist', dist * 100)
+            machine.run()
+        self.assertEqual([tick.number for tick in machine.ticks], [2, 3, 4])
+        self.assertEqual(machine.tick_count, 5)
+        self.assertEqual(
+            machine.opcode_totals,
+            {opcode: 5 * count for opcode, count in machine.opcodes.items()})
+
+    def test_numerators_only_for_weighted_average(self):
+        for method in fuzzy.DEFUZZIFICATIONS:
+            report = self.trace(method).format()
+            self.assertEqual('y2*weight' in report,
+                             method == 'weighted-average', method)
+
+
+if __name__ == '__main__':
+    unittest.main()
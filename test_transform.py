@@ -0,0 +1,94 @@
+import io
+import os
+import unittest
+
+import bytecode_compiler
+import transform
+from dsl_parser import SchemeParser, from_tuple, intern, to_tuple
+
+RULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'rule.scm')
+
+
+def parse(source):
+    return SchemeParser().parse(io.BytesIO(source)).car
+
+
+def sexp(*elements):
+    return from_tuple(tuple(intern(e) if isinstance(e, str) else e
+                            for e in elements))
+
+
+class RuleIndexTest(unittest.TestCase):
+    def test_redefinition_moves_the_rule(self):
+        index = transform.RuleIndex([
+            transform.Transform(parse(b'(define-transform r (bar <A>) =>)')),
+            transform.Transform(parse(
+                b'(define-transform other (bar <A> <B>) => <A>)')),
+        ])
+        self.assertEqual(index.max_arity, 3)
+        index.add(transform.Transform(parse(
+            b'(define-transform r (baz <A> <B> <C>) => <C>)')))
+
+        self.assertEqual(index.max_arity, 4)
+        self.assertEqual(index.candidates(sexp('bar', '1')), ())
+        rules = index.candidates(sexp('baz', '1', '2', '3'))
+        self.assertEqual([rule.name for rule in rules], ['r'])
+        self.assertEqual(to_tuple(index._try_transform(
+            sexp('baz', '1', '2', '3'))), ('3',))
+        # the redefined rule keeps its place before `other`
+        self.assertEqual([rule.name for rule in index.rules],
+                         ['r', 'other'])
+
+
+# `if` forms nested in an `if` form, which the if-lifting pass rewrites
+# (the shape of benchmark.generate_nested_rules)
+NESTED = b'''
+(if (is dist Z)
+    (begin
+      (if (or (is dir-x PS) (and (is dir-y NS) (is dir-x Z)))
+          (begin (set! dx NS) (set! rot NM)))
+      (if (and (is dir-y PM) (or (is dist PS) (is dist PM)))
+          (begin (set! dy PS)))
+      (if (is dir-y NS) (begin (set! dy PS) (set! dx PM)))
+      (if (and (is dir-x NM) (is dir-y PM)) (begin))))
+'''
+
+
+def compile_rules(run_pass=bytecode_compiler.normalizing_pass, source=None,
+                  processes=None):
+    if source is None:
+        with open(RULE_PATH, 'rb') as fd:
+            source = fd.read()
+    sexp = SchemeParser().parse(io.BytesIO(source))
+    return to_tuple(bytecode_compiler.compile_to_bytecode(
+        sexp, run_pass, processes))
+
+
+class PassTest(unittest.TestCase):
+    def test_indexed_pass(self):
+        expected = compile_rules(bytecode_compiler.sequential_pass)
+        self.assertTrue(expected)
+        self.assertEqual(compile_rules(bytecode_compiler.indexed_pass),
+                         expected)
+
+    def test_normalizing_pass(self):
+        for source in (None, NESTED):
+            with self.subTest(source=source):
+                expected = compile_rules(bytecode_compiler.sequential_pass,
+                                         source)
+                self.assertTrue(expected)
+                self.assertEqual(compile_rules(
+                    bytecode_compiler.normalizing_pass, source), expected)
+
+
+    def test_parallel(self):
+        for source in (None, NESTED):
+            with self.subTest(source=source):
+                expected = compile_rules(source=source)
+                self.assertEqual(compile_rules(source=source, processes=2),
+                                 expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import itertools
+import os
+import tempfile
+import unittest
+
+import fuzzy
+import incremental
+import optimizer
+import vm
+from dsl_parser import to_tuple
+
+RULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'rule.scm')
+
+SPEED = ((-30, -15), (-20, -5), (-9, 9), (5, 20), (15, 30))
+DIRECTION = ((-1500, -500), (-600, -10), (-100, 100), (10, 600),
+             (500, 1500))
+OUTPUTS = ('dx', 'dy', 'rot')
+
+
+def member_functions():
+    """The (inputs, outputs) of the camera in game.py"""
+    inputs = {
+        'dir-x': fuzzy.FiveLevels(*DIRECTION),
+        'dir-y': fuzzy.FiveLevels(*DIRECTION),
+        'dist': fuzzy.ThreeLevelsPositive((-10, 300), (250, 700),
+                                          (600, 1500)),
+    }
+    outputs = {
+        'dx': fuzzy.FiveLevels(*SPEED),
+        'dy': fuzzy.FiveLevels(*SPEED),
+        'rot': fuzzy.ThreeLevels((-100, -50), (-50, 50), (50, 100)),
+    }
+    return inputs, outputs
+
+
+def run(machine, samples):
+    result = []
+    for x, y, dist in samples:
+        machine.input('dir-x', x)
+        machine.input('dir-y', y)
+        machine.input('dist', dist)
+        machine.run()
+        result.append(tuple(machine.get_output(key) for key in OUTPUTS))
+    return result
+
+
+SAMPLES = list(itertools.product(range(-1100, 1101, 275),
+                                 range(-1100, 1101, 275),
+                                 range(0, 1101, 220)))
+
+
+class EngineTest(unittest.TestCase):
+    def test_engines_agree(self):
+        expected = run(vm.VM(*member_functions(), RULE_PATH), SAMPLES)
+        self.assertTrue(any(any(outputs) for outputs in expected))
+        for engine in vm.ENGINES:
+            for pipeline in ((), optimizer.DEFAULT_PIPELINE):
+                with self.subTest(engine=engine, pipeline=pipeline):
+                    machine = vm.VM(*member_functions(), RULE_PATH,
+                                    engine=engine, optimizations=pipeline)
+                    self.assertEqual(run(machine, SAMPLES), expected)
+
+    def test_defuzzifications_agree(self):
+        for method in fuzzy.DEFUZZIFICATIONS:
+            expected = run(vm.VM(*member_functions(), RULE_PATH,
+                                 defuzzification=method), SAMPLES)
+            self.assertTrue(any(any(outputs) for outputs in expected))
+            for engine in vm.ENGINES:
+                with self.subTest(method=method, engine=engine):
+                    machine = vm.VM(*member_functions(), RULE_PATH,
+                                    engine=engine, defuzzification=method)
+                    self.assertEqual(run(machine, SAMPLES), expected)
+                    program = vm.Program(*member_functions(), RULE_PATH,
+                                         engine=engine,
+                                         defuzzification=method)
+                    self.assertEqual(run(program.instance(), SAMPLES),
+                                     expected)
+
+    def test_program_instances_agree(self):
+        expected = run(vm.VM(*member_functions(), RULE_PATH), SAMPLES)
+        for engine in vm.ENGINES:
+            with self.subTest(engine=engine):
+                program = vm.Program(*member_functions(), RULE_PATH,
+                                     engine=engine)
+                machines = [program.instance() for _ in range(2)]
+                self.assertEqual(run(machines[0], SAMPLES), expected)
+                # the instances do not share their state
+                self.assertEqual(run(machines[1], SAMPLES[::-1]),
+                                 expected[::-1])
+                self.assertEqual(run(machines[0], SAMPLES[-1:]),
+                                 expected[-1:])
+
+    def test_incremental_vm_agrees(self):
+        expected = run(vm.VM(*member_functions(), RULE_PATH), SAMPLES)
+        for kwargs in ({}, {'full': True}, {'watch': True},
+                       {'optimizations': ()}):
+            with self.subTest(**kwargs):
+                machine = incremental.IncrementalVM(
+                    *member_functions(), RULE_PATH, **kwargs)
+                self.assertEqual(run(machine, SAMPLES), expected)
+                # the same inputs again, then in another order
+                self.assertEqual(run(machine, SAMPLES[-1:]), expected[-1:])
+                self.assertEqual(run(machine, SAMPLES[::-1]),
+                                 expected[::-1])
+
+    def test_empty_rule_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for source in (b'', b'; only a comment\n'):
+                path = os.path.join(directory, 'rules.scm')
+                with open(path, 'wb') as fd:
+                    fd.write(source)
+                for engine in vm.ENGINES:
+                    with self.subTest(source=source, engine=engine):
+                        machines = (
+                            vm.VM(*member_functions(), path, engine=engine),
+                            vm.Program(*member_functions(), path,
+                                       engine=engine).instance(),
+                        )
+                        for machine in machines:
+                            self.assertEqual(run(machine, SAMPLES[:3]),
+                                             [(0, 0, 0)] * 3)
+
+    def test_reload_to_empty(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rules.scm')
+            with open(RULE_PATH, 'rb') as fd:
+                source = fd.read()
+            for engine in vm.ENGINES:
+                with self.subTest(engine=engine):
+                    with open(path, 'wb') as fd:
+                        fd.write(source)
+                    machine = vm.VM(*member_functions(), path, engine=engine,
+                                    watch=True, poll_interval=0)
+                    self.assertNotEqual(run(machine, SAMPLES),
+                                        [(0, 0, 0)] * len(SAMPLES))
+                    with open(path, 'wb'):
+                        pass
+                    self.assertEqual(run(machine, SAMPLES[:3]),
+                                     [(0, 0, 0)] * 3)
+
+    def test_reload_optimizes_changed_forms(self):
+        inputs, outputs = member_functions()
+        with open(RULE_PATH, 'rb') as fd:
+            source = fd.read()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rules.scm')
+            with open(path, 'wb') as fd:
+                fd.write(source)
+            machine = vm.VM(inputs, outputs, path, watch=True,
+                            poll_interval=0)
+            prepared = machine.prepared
+
+            with open(path, 'ab') as fd:
+                fd.write(b'\n(if (is dist Z) (set! rot PM))')
+            self.assertTrue(machine.reload())
+            self.assertEqual(len(machine.prepared), len(prepared) + 1)
+            for text, entry in prepared.items():
+                self.assertIs(machine.prepared[text], entry)
+
+            expected = vm.VM(inputs, outputs, path)
+            self.assertEqual(to_tuple(machine.bytecode),
+                             to_tuple(expected.bytecode))
+            self.assertEqual(to_tuple(machine.indexed),
+                             to_tuple(expected.indexed))
+            self.assertEqual(run(machine, SAMPLES), run(expected, SAMPLES))
+
+    def test_active_rules_are_optimized(self):
+        inputs, outputs = member_functions()
+        # a level that never fires
+        inputs['dist'] = inputs['dist']._replace(
+            PM=fuzzy.TriangleFunction(600, 600))
+        expected = run(vm.VM(inputs, outputs, RULE_PATH), SAMPLES)
+        counts = []
+        for pipeline in ((), optimizer.DEFAULT_PIPELINE):
+            machine = vm.VM(inputs, outputs, RULE_PATH, engine='active',
+                            optimizations=pipeline)
+            self.assertEqual(run(machine, SAMPLES), expected)
+            counts.append(len(machine.rule_index.rules))
+            machine = incremental.IncrementalVM(inputs, outputs, RULE_PATH,
+                                                optimizations=pipeline)
+            self.assertEqual(run(machine, SAMPLES), expected)
+            self.assertEqual(len(machine.rule_index.rules), counts[-1])
+        self.assertLess(counts[1], counts[0])
+
+    def test_instances_with_other_functions(self):
+        inputs, outputs = member_functions()
+        # a level that never fires in the program, but does in the instance
+        empty = dict(inputs)
+        empty['dist'] = inputs['dist']._replace(
+            PM=fuzzy.TriangleFunction(600, 600))
+        expected = run(vm.VM(inputs, outputs, RULE_PATH), SAMPLES)
+        for engine in vm.ENGINES:
+            with self.subTest(engine=engine):
+                program = vm.Program(empty, outputs, RULE_PATH,
+                                     engine=engine)
+                machine = program.instance(program.bind(inputs))
+                self.assertEqual(run(machine, SAMPLES), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import collections
+import time
+from collections import namedtuple
+
+import bytecode_compiler
+import vm
+from dsl_parser import to_tuple
+
+OPCODE_NAMES = {
+    getattr(vm, name): name for name in (
+        'POP', 'MIN', 'MAX', 'GET_INPUT_BY_INDEX', 'CALL_FUNCTION_BY_REF',
+        'FEED_DEFUZZER_FAST', 'STORE', 'LOAD', 'MIN_N', 'MAX_N',
+        'FEED_DEFUZZER_FAST_POP', 'MEMBERSHIP_OF_INPUT',
+    )
+}
+
+# One (%feed <output> <level>) of the program. `form` is the index of the
+# top-level form it was compiled from and `source` the text of that form.
+Rule = namedtuple('Rule', ('form', 'output', 'level', 'y2', 'source'))
+
+# One `TracingVM.run`. `opcodes` counts the instructions run by opcode,
+# `firings` holds a (rule, strength) pair for every feed in program order,
+# and `sums` is a copy of the sums of the `fuzzy.DefuzzerBank` afterwards.
+Tick = namedtuple('Tick', ('number', 'seconds', 'opcodes', 'firings',
+                           'sums'))
+
+def format_form(form):
+    def render(element):
+        if isinstance(element, tuple):
+            return '(' + ' '.join(render(e) for e in element) + ')'
+        return str(element)
+    return render(to_tuple(form))
+
+
+class FeedRecorder:
+    """Stands for the sums of a `fuzzy.DefuzzerBank` in `vm.interpret` and
+    keeps what each feed adds to them, in program order
+    """
+    __slots__ = ('sums', 'strengths')
+
+    def __init__(self, sums):
+        self.sums = sums
+        self.strengths = []
+
+    def __getitem__(self, slot):
+        return self.sums[slot]
+
+    def __setitem__(self, slot, value):
+        self.strengths.append(value - self.sums[slot])
+        self.sums[slot] = value
+
+
+class TracingVM(vm.VM):
+    """A `vm.VM` whose `run` records what the program did in a `Tick`.
+    The last `capacity` ticks are kept in `ticks`:
+
+        machine = TracingVM(inputs, outputs, 'rule.scm')
+        machine.run()
+        print(machine.format())
+
+    The program runs in `vm.interpret` with a `FeedRecorder` in place of
+    the sums, so `vm.VM` itself pays nothing for tracing. The program has
+    no jumps, so every run counts the same instructions, which are counted
+    once when it is loaded. The rule file is compiled form by form (the
+    bytecode cache is not used), and every feed is tagged with the %feed it
+    comes from (see `bytecode_compiler.Constants.tag_feeds`) to map it
+    back to its top-level `if` form.
+    """
+    by_form = True
+    tag_feeds = True
+
+    def __init__(self, inputs, outputs, rule_path, capacity=64, **kwargs):
+        self.ticks = collections.deque(maxlen=capacity)
+        self.tick_count = 0
+        self.opcode_totals = collections.Counter()
+        super().__init__(inputs, outputs, rule_path, **kwargs)
+
+    def _load(self, bytecode):
+        super()._load(bytecode)
+
+        # the `Rule`s of each %feed, one for every form it is in (identical
+        # forms share their bytecode)
+        self.rules = []
+        tag_rules = {}
+        for number, form in enumerate(self.form_cache.forms):
+            source = format_form(form.sexp)
+            segment = form.bytecode
+            while segment is not None:
+                instruction = segment.car
+                if instruction.car is bytecode_compiler.SYM_FEED:
+                    rule = Rule(number, instruction.cdr.car,
+                                instruction.cdr.cdr.car,
+                                self.get_member_function(instruction.cdr).x2,
+                                source)
+                    self.rules.append(rule)
+                    tag_rules.setdefault(instruction, []).append(rule)
+                segment = segment.cdr
+
+        # the `Rule` of each feed of `bcbuf`, in order. The optimizer keeps
+        # the order of the feeds, and deletes the same ones in identical
+        # forms.
+        self.feed_rules = []
+        seen = collections.Counter()
+        instructions = self.bytecode
+        while instructions is not None:
+            instruction = instructions.car
+            if (instruction.car is bytecode_compiler.SYM_FEED_DEFUZZER_FAST
+                    or instruction.car
+                    is bytecode_compiler.SYM_FEED_DEFUZZER_FAST_POP):
+                tag = instruction.cdr.cdr.cdr.car
+                self.feed_rules.append(tag_rules[tag][seen[tag]])
+                seen[tag] += 1
+            instructions = instructions.cdr
+
+        self.opcodes = collections.Counter()
+        idx = 0
+        while idx < len(self.bcbuf):
+            self.opcodes[self.bcbuf[idx]] += 1
+            idx += vm.LENGTHS[self.bcbuf[idx]]
+
+    def run(self):
+        if self.watcher is not None and self.watcher.changed():
+            self.reload()
+        start = time.perf_counter()
+        self.bank.reset()
+        recorder = FeedRecorder(self.bank.sums)
+        vm.interpret(self.bcbuf, self.inputs, self.member_functions,
+                     recorder, self.stack, self.temporaries)
+        seconds = time.perf_counter() - start
+
+        self.opcode_totals.update(self.opcodes)
+        self.ticks.append(Tick(
+            self.tick_count, seconds, self.opcodes,
+            list(zip(self.feed_rules, recorder.strengths)),
+            self.bank.sums[:]))
+        self.tick_count += 1
+
+    def contributions(self, tick):
+        """Return a dictionary from output names to the (rule, strength) of
+        each rule fired in `tick`
+        """
+        result = {key: [] for key in self.output_to_index}
+        for rule, strength in tick.firings:
+            if strength:
+                result[rule.output].append((rule, strength))
+        return result
+
+    def format(self, tick=None, width=60):
+        """A report of the opcode counts so far and of the rules fired in
+        `tick` (the last one by default)
+        """
+        lines = ['%-24s %10s' % ('opcode', 'count')]
+        for opcode, count in sorted(self.opcode_totals.items()):
+            lines.append('%-24s %10d' % (OPCODE_NAMES[opcode], count))
+        if tick is None:
+            if not self.ticks:
+                return '\n'.join(lines)
+            tick = self.ticks[-1]
+
+        lines.append('')
+        lines.append('tick %d: %.1f us' % (tick.number, tick.seconds * 1e6))
+        # only the weighted average sums y2 * strength over the rules, the
+        # other methods get no numerator column
+        weighted = self.bank.method == 'weighted-average'
+        for key, index in self.output_to_index.items():
+            lines.append('%s = %d (%s)' % (
+                key, self.bank.defuzz(index, tick.sums), self.bank.method))
+            contributions = self.contributions(tick)[key]
+            if contributions:
+                lines.append('  %-5s %6s' % ('level', 'weight')
+                             + (' %9s' % 'y2*weight' if weighted else ''))
+            for rule, strength in contributions:
+                source = rule.source
+                if len(source) > width:
+                    source = source[:width - 3] + '...'
+                if weighted:
+                    lines.append('  %-5s %6d %9d  form %d: %s' % (
+                        rule.level, strength, rule.y2 * strength,
+                        rule.form, source))
+                else:
+                    lines.append('  %-5s %6d  form %d: %s' % (
+                        rule.level, strength, rule.form, source))
+        return '\n'.join(lines)
@@ -1,26 +1,79 @@
-from dsl_parser import Cons, Accumulator
+from dsl_parser import Cons, Accumulator, intern, is_placeholder
 
 def ASSERT_EQ(str1, str2):
     if str1 != str2:
         raise RuntimeError('should be %s but got %s' % (str2, str1))
 
 UNCHANGED = Cons('<UNCHANGED>', None)
+ELLIPSIS = intern('...')
 
-class Transform:
+def rewrite_elements(sexp, rewrite):
+    """Call `rewrite` on every element of `sexp` that is a list. `rewrite`
+    returns UNCHANGED or a list of S-expressions to splice in its place.
+    Returns (changed, S-expression).
+
+    Only the cells up to the last rewritten element are copied; the rest
+    of `sexp` is shared, and an unchanged `sexp` is returned as is.
+    """
+    acc = None
+    copied_upto = sexp
+    curr = sexp
+
+    while curr is not None:
+        if isinstance(curr.car, Cons):
+            result = rewrite(curr.car)
+            if result is not UNCHANGED:
+                if acc is None:
+                    acc = Accumulator()
+                while copied_upto is not curr:
+                    acc.append(copied_upto.car)
+                    copied_upto = copied_upto.cdr
+                acc.extend(result)
+                copied_upto = curr.cdr
+
+        curr = curr.cdr
+
+    if acc is None:
+        return False, sexp
+    acc.share_tail(copied_upto)
+    return True, acc.to_list()
+
+class Rewriter:
+    """Rewrites an S-expression bottom-up, trying `_try_transform` at every
+    level. Subclasses provide `_try_transform`.
+    """
+    def transform_sexp_non_root(self, sexp):
+        """Transform S-expression at non-root levels.
+        Returns (changed, S-expression)
+        """
+        return rewrite_elements(sexp, self.recursively_transform)
+
+    def recursively_transform(self, sexp):
+        """Returns UNCHANGED or a list of S-expressions"""
+        changed, sexp = self.transform_sexp_non_root(sexp)
+
+        # To return: UNCHANGED or a (possibly empty) list of S-expressions
+        transformed = self._try_transform(sexp)
+        if transformed is not UNCHANGED:
+            return transformed
+        elif changed:
+            # `transformed` is UNCHANGED, but the sexp has changed in deeper
+            # levels
+            return Cons(sexp, None)
+        else:
+            return UNCHANGED
+
+class Transform(Rewriter):
     class Placeholder:
         def __init__(self, name, ellipsis=False):
-            self.sexp = None
             self.name = name
             self.ellipsis = ellipsis
 
-        def put_value(self, sexp):
-            self.sexp = sexp
-
         def __repr__(self):
             ellipsis = '0+' if self.ellipsis else ''
             return '<placeholder%s %s>' % (ellipsis, self.name)
 
-    def __init__(self, sexp):
+    def __init__(self, sexp, compiled=True, code_cache=None):
         self.placeholders = {}
         ASSERT_EQ(sexp.car, 'define-transform')
 
@@ -32,6 +85,10 @@ class Transform:
         sexp = sexp.cdr
         self.src = self._parse_src(sexp.car)
         self.hint = self.src.car
+        self.arity, self.variadic = self._pattern_arity(self.src)
+        self.second = None
+        if self.src.cdr is not None:
+            self.second = self._pattern_key(self.src.cdr.car)
 
         # next element
         sexp = sexp.cdr
@@ -41,13 +98,20 @@ class Transform:
         sexp = sexp.cdr
         self.dst = self._parse_dst(sexp)
 
+        # generated Python functions; None means use the interpreter
+        self.matcher = None
+        self.builder = None
+        if compiled:
+            self.matcher, self.builder = PatternCompiler(
+                self, code_cache).compile()
+
     def _parse_transform(self, sexp, callback):
         while sexp is not None:
             if isinstance(sexp.car, Cons):
                 self._parse_transform(sexp.car, callback)
-            elif sexp.car.startswith('<') and sexp.car.endswith('>'):
+            elif is_placeholder(sexp.car):
                 ellipsis = False
-                if sexp.cdr is not None and sexp.cdr.car == '...':
+                if sexp.cdr is not None and sexp.cdr.car is ELLIPSIS:
                     ellipsis = True
                     if sexp.cdr.cdr is not None:
                         raise RuntimeError('Extra stuff after "..."')
@@ -78,23 +142,51 @@ class Transform:
         self._parse_transform(list_of_sexps, callback)
         return list_of_sexps
 
-    def _match(self, curr, to_match):
+    def _pattern_arity(self, sexp):
+        arity = 0
+        while sexp is not None:
+            if isinstance(sexp.car, self.Placeholder) and sexp.car.ellipsis:
+                return arity, True
+            arity += 1
+            sexp = sexp.cdr
+        return arity, False
+
+    def _pattern_key(self, element):
+        """The `element_key` every S-expression matching `element` has,
+        or None if they can have different keys
+        """
+        if isinstance(element, Cons):
+            if isinstance(element.car, (Cons, self.Placeholder)):
+                return None
+            return element_key(element)
+        elif isinstance(element, self.Placeholder) or element is None:
+            return None
+        else:
+            return element
+
+    def _match(self, curr, to_match, env):
+        """Match `to_match` to the pattern `curr`, storing the value of
+        each placeholder in the dict `env`
+        """
         while curr is not None:
             if isinstance(curr.car, self.Placeholder):
                 if curr.car.ellipsis:
-                    curr.car.put_value(to_match)  # match the entire tail
+                    env[curr.car.name] = to_match  # match the entire tail
                     return True  # bail out
                 elif to_match is None:
                     return False  # expected one non-empty pair
                 else:
-                    curr.car.put_value(to_match.car)
+                    env[curr.car.name] = to_match.car
             elif isinstance(curr.car, Cons):
-                if not isinstance(to_match, Cons):
+                if to_match is None or not isinstance(to_match.car, Cons):
                     return False
-                elif not self._match(curr.car, to_match.car):
+                elif not self._match(curr.car, to_match.car, env):
                     return False
+            elif to_match is None:
+                return False  # `to_match` is shorter than expected
             else:
-                if curr.car != to_match.car:
+                # symbols are interned by the parser
+                if curr.car is not to_match.car:
                     return False
 
             curr = curr.cdr
@@ -106,18 +198,19 @@ class Transform:
 
         return True
 
-    def _generate(self, curr):
+    def _generate(self, curr, env):
         acc = Accumulator()
 
         while curr is not None:
             if isinstance(curr.car, self.Placeholder):
                 if curr.car.ellipsis:
-                    acc.extend(curr.car.sexp)
+                    # always the last element: share the matched tail
+                    acc.share_tail(env[curr.car.name])
                 else:
-                    acc.append(curr.car.sexp)
+                    acc.append(env[curr.car.name])
             elif isinstance(curr.car, Cons):
-                acc.append(self._generate(curr.car))
-            elif curr.car != '...':
+                acc.append(self._generate(curr.car, env))
+            elif curr.car is not ELLIPSIS:
                 acc.append(curr.car)
 
             curr = curr.cdr
@@ -126,47 +219,331 @@ class Transform:
 
     def _try_transform(self, sexp):
         """Returns UNCHANGED or a list of S-expressions"""
-        if not self._match(self.src, sexp):
+        if self.matcher is not None:
+            bindings = self.matcher(sexp)
+            if bindings is None:
+                return UNCHANGED
+            return self.builder(*bindings)
+
+        env = {}
+        if not self._match(self.src, sexp, env):
             return UNCHANGED
         if self.dst is None:
             return None
         else:
-            return self._generate(self.dst)
+            return self._generate(self.dst, env)
 
-    def transform_sexp_non_root(self, sexp, acc):
-        """Transform S-expression at non-root levels.
-        Return an S-expression
-        """
-        changed = False
 
-        while sexp is not None:
-            if isinstance(sexp.car, Cons):
-                result = self.recursively_transform(sexp.car)
-                if result is UNCHANGED:
-                    acc.append(sexp.car)
-                else:
-                    changed = True
-                    acc.extend(result)
+class PatternCompiler:
+    """Generates the Python source of two functions for a `Transform`:
+
+    - match(sexp) returns a tuple with the value of each placeholder, or
+      None if `sexp` does not match the source pattern
+    - build(*values) returns the list of S-expressions of the destination
+
+    They do what `Transform._match` and `Transform._generate` do, but the
+    pattern is unrolled into straight-line code, and the values of the
+    placeholders are kept in local variables.
+    """
+    def __init__(self, rule, code_cache=None):
+        self.rule = rule
+        self.code_cache = code_cache
+        self.lines = []
+        self.namespace = {'Cons': Cons}
+        self.constant_names = {}
+        self.local_names = {}
+        self.temporaries = 0
+
+    def _constant(self, value):
+        if value is None:
+            return 'None'
+        name = self.constant_names.get(id(value))
+        if name is None:
+            name = 'k%d' % len(self.constant_names)
+            self.constant_names[id(value)] = name
+            self.namespace[name] = value
+        return name
+
+    def _local(self, placeholder_name):
+        name = self.local_names.get(placeholder_name)
+        if name is None:
+            name = 'p%d' % len(self.local_names)
+            self.local_names[placeholder_name] = name
+        return name
+
+    def _temporary(self):
+        self.temporaries += 1
+        return 's%d' % self.temporaries
+
+    def _emit(self, line):
+        self.lines.append('    ' + line)
+
+    def _emit_match(self, curr, var):
+        """Emit code matching the list in the variable `var` to `curr`"""
+        while curr is not None:
+            element = curr.car
+            if isinstance(element, Transform.Placeholder):
+                if element.ellipsis:
+                    # match the entire tail
+                    self._emit('%s = %s' % (self._local(element.name), var))
+                    return
+                self._emit('if %s is None: return None' % var)
+                self._emit('%s = %s.car' % (self._local(element.name), var))
+            elif isinstance(element, Cons):
+                self._emit('if %s is None: return None' % var)
+                sub = self._temporary()
+                self._emit('%s = %s.car' % (sub, var))
+                self._emit('if not isinstance(%s, Cons): return None' % sub)
+                self._emit_match(element, sub)
+            else:
+                self._emit('if %s is None or %s.car is not %s: return None'
+                           % (var, var, self._constant(element)))
+            self._emit('%s = %s.cdr' % (var, var))
+            curr = curr.cdr
+
+        # if the list is longer than expected
+        self._emit('if %s is not None: return None' % var)
+
+    def _build_expression(self, curr):
+        """Python expression building the list `curr` of the destination"""
+        elements = []
+        while curr is not None:
+            elements.append(curr.car)
+            curr = curr.cdr
+
+        result = 'None'
+        for element in reversed(elements):
+            if isinstance(element, Transform.Placeholder):
+                if element.ellipsis:
+                    # always the last element: share the matched tail
+                    result = self._local(element.name)
+                    continue
+                item = self._local(element.name)
+            elif isinstance(element, Cons):
+                item = self._build_expression(element)
+            elif element is ELLIPSIS:
+                continue
             else:
-                acc.append(sexp.car)
+                item = self._constant(element)
+            result = 'Cons(%s, %s)' % (item, result)
+        return result
+
+    def compile(self):
+        self.lines.append('def match(s0):')
+        self._emit_match(self.rule.src, 's0')
+        values = [self._local(name) for name in self.rule.placeholders]
+        self._emit('return (%s)' % ''.join(v + ', ' for v in values))
+
+        self.lines.append('def build(%s):' % ', '.join(values))
+        self._emit('return %s' % self._build_expression(self.rule.dst))
+
+        self.source = '\n'.join(self.lines) + '\n'
+        filename = '<transform %s>' % self.rule.name
+        if self.code_cache is not None:
+            code = self.code_cache.compile(self.source, filename)
+        else:
+            code = compile(self.source, filename, 'exec')
+        exec(code, self.namespace)
+        return self.namespace['match'], self.namespace['build']
+
+
+class CodeCache:
+    """Code objects of the functions generated by `PatternCompiler`, keyed by
+    their file name and source. Compiling the source is most of the cost of
+    building a `Transform`, and code objects can be saved with `marshal`.
+    """
+    def __init__(self, codes=None):
+        self.codes = codes if codes is not None else {}
+        self.used = {}
+        self.misses = 0
+
+    def compile(self, source, filename):
+        key = (filename, source)
+        code = self.codes.get(key)
+        if code is None:
+            code = compile(source, filename, 'exec')
+            self.misses += 1
+        self.used[key] = code
+        return code
+
 
+def element_key(element):
+    """Key of one element of a list in the `RuleIndex`: a symbol stands for
+    itself, and a list is keyed by its head symbol
+    """
+    if isinstance(element, Cons):
+        if isinstance(element.car, Cons):
+            return (RuleIndex.LIST, None)
+        return (RuleIndex.LIST, element.car)
+    return element
+
+class RuleIndex(Rewriter):
+    """Indexes transforms by the head symbol, the length and the key of the
+    second element of their source patterns, like a small discrimination
+    net. When rewriting, each node is only matched against the rules that
+    can match it, in the order the rules were added; the first rule that
+    matches wins.
+    """
+    LIST = intern('(')
+
+    def __init__(self, rules=()):
+        self.rules = []
+        self.by_name = {}
+        self.by_head = {}
+        self.any_head = []
+        self.max_arity = 0
+        self.cache = {}
+        self.restricted = {}
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """Add `rule`, replacing any rule with the same name (which keeps
+        its place in the order)
+        """
+        previously = self.by_name.get(rule.name)
+        self.by_name[rule.name] = rule
+        self.cache.clear()
+        self.restricted.clear()
+        if previously is not None:
+            # the head, the arity or the hint may have changed
+            self.rules[self.rules.index(previously)] = rule
+            self.by_head = {}
+            self.any_head = []
+            self.max_arity = 0
+            for rule in self.rules:
+                self._index(rule)
+            return
+        self.rules.append(rule)
+        self._index(rule)
+
+    def _index(self, rule):
+        if isinstance(rule.hint, (Cons, Transform.Placeholder)):
+            self.any_head.append(rule)
+        else:
+            self.by_head.setdefault(rule.hint, []).append(rule)
+        self.max_arity = max(self.max_arity, rule.arity)
+
+    def restrict(self, names):
+        """A `RuleIndex` of the rules called `names`, in that order"""
+        names = tuple(names)
+        result = self.restricted.get(names)
+        if result is None:
+            result = RuleIndex(self.by_name[name] for name in names)
+            self.restricted[names] = result
+        return result
+
+    def _length_upto(self, sexp, limit):
+        length = 0
+        while sexp is not None and length < limit:
+            length += 1
             sexp = sexp.cdr
+        return length
 
-        return changed
+    def candidates(self, sexp):
+        if sexp is None:
+            return ()
+        second = None
+        if sexp.cdr is not None:
+            second = element_key(sexp.cdr.car)
+        length = self._length_upto(sexp, self.max_arity + 1)
+        key = (sexp.car if not isinstance(sexp.car, Cons) else None,
+               second, length)
 
-    def recursively_transform(self, sexp):
+        result = self.cache.get(key)
+        if result is None:
+            rules = self.by_head.get(key[0], [])
+            if self.any_head:
+                order = {id(rule): i for i, rule in enumerate(self.rules)}
+                rules = sorted(rules + self.any_head,
+                               key=lambda rule: order[id(rule)])
+            result = tuple(
+                rule for rule in rules
+                if (length >= rule.arity if rule.variadic
+                    else length == rule.arity)
+                and (rule.second is None or rule.second == second)
+            )
+            self.cache[key] = result
+        return result
+
+    def _try_transform(self, sexp):
         """Returns UNCHANGED or a list of S-expressions"""
+        for rule in self.candidates(sexp):
+            transformed = rule._try_transform(sexp)
+            if transformed is not UNCHANGED:
+                return transformed
+        return UNCHANGED
+
+class Normalizer:
+    """Rewrites an S-expression to normal form with the rules of a
+    `RuleIndex`, bottom-up and in a single traversal.
+
+    Every node is normalized once. When a rule fires, only the nodes the
+    rule built are put on the worklist: the subtrees it reused from its
+    input are already in normal form and are skipped. The result is the
+    same as repeating `recursively_transform` until nothing changes, as
+    long as the rules are confluent (the rules in transform.scm are).
+    """
+    def __init__(self, index):
+        self.index = index
+        self.normal = set()
+        self.rewrites = 0
+
+    def _normalize_element(self, sexp):
+        if sexp in self.normal:
+            return UNCHANGED
+        return self.normalize_node(sexp)
+
+    def normalize_children(self, sexp):
+        """Returns (changed, S-expression). An unchanged S-expression is
+        returned as is, so that it is found in `normal` later.
+        """
+        return rewrite_elements(sexp, self._normalize_element)
+
+    def normalize_node(self, sexp):
+        """Returns UNCHANGED or the list of S-expressions in normal form
+        that `sexp` rewrites to
+        """
         acc = Accumulator()
-        changed = self.transform_sexp_non_root(sexp, acc)
+        changed = False
+        worklist = [sexp]
 
-        # To return: UNCHANGED or a (possibly empty) list of S-expressions
-        sexp = acc.to_list()
-        transformed = self._try_transform(sexp)
-        if transformed is not UNCHANGED:
-            return transformed
-        elif changed:
-            # `transformed` is UNCHANGED, but the sexp has changed in deeper
-            # levels
-            return Cons(sexp, None)
+        while worklist:
+            form = worklist.pop()
+            if not isinstance(form, Cons) or form in self.normal:
+                acc.append(form)
+                continue
+
+            children_changed, form = self.normalize_children(form)
+            transformed = self.index._try_transform(form)
+            if transformed is UNCHANGED:
+                self.normal.add(form)
+                acc.append(form)
+                changed = changed or children_changed
+            else:
+                changed = True
+                self.rewrites += 1
+                forms = []
+                while transformed is not None:
+                    forms.append(transformed.car)
+                    transformed = transformed.cdr
+                worklist.extend(reversed(forms))
+
+        if changed:
+            return acc.to_list()
         else:
             return UNCHANGED
+
+    def normalize(self, sexp):
+        """Like `transform_repeatedly_cb`: returns the rewritten `sexp`, or
+        None if it has been deleted
+        """
+        if sexp is None:
+            return None
+        result = self.normalize_node(sexp)
+        if result is UNCHANGED:
+            return sexp
+        elif result is None:
+            return None
+        else:
+            return result.car
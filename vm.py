@@ -1,6 +1,13 @@
+import copy
+from array import array
+
+import active_rules
+import bytecode_cache
 import bytecode_compiler
 import dsl_parser
 import fuzzy
+import hot_reload
+import optimizer
 
 POP = 1
 MIN = 2
@@ -8,102 +15,657 @@ MAX = 3
 GET_INPUT_BY_INDEX = 4
 CALL_FUNCTION_BY_REF = 5
 FEED_DEFUZZER_FAST = 6
+STORE = 7
+LOAD = 8
+MIN_N = 9
+MAX_N = 10
+FEED_DEFUZZER_FAST_POP = 11
+MEMBERSHIP_OF_INPUT = 12
+
+# the instruction lengths in `bcbuf`
+LENGTHS = {
+    POP: 1, MIN: 1, MAX: 1, GET_INPUT_BY_INDEX: 2, CALL_FUNCTION_BY_REF: 2,
+    FEED_DEFUZZER_FAST: 3, STORE: 2, LOAD: 2, MIN_N: 2, MAX_N: 2,
+    FEED_DEFUZZER_FAST_POP: 3, MEMBERSHIP_OF_INPUT: 3,
+}
+
+ENGINES = ('interpreter', 'codegen', 'active')
+
+def _encode_instruction(bcbuf, idx, ins, slots, level_slots):
+    if ins.car is bytecode_compiler.SYM_POP:
+        bcbuf[idx] = POP
+        return 1
+    if ins.car is bytecode_compiler.SYM_MIN:
+        bcbuf[idx] = MIN
+        return 1
+    if ins.car is bytecode_compiler.SYM_MAX:
+        bcbuf[idx] = MAX
+        return 1
+    if ins.car is bytecode_compiler.SYM_GET_INPUT_BY_INDEX:
+        bcbuf[idx] = GET_INPUT_BY_INDEX
+        bcbuf[idx + 1] = ins.cdr.car
+        return 2
+    if ins.car is bytecode_compiler.SYM_CALL_FUNCTION_BY_REF:
+        bcbuf[idx] = CALL_FUNCTION_BY_REF
+        bcbuf[idx + 1] = slots[id(ins.cdr.car)]
+        return 2
+    if ins.car is bytecode_compiler.SYM_FEED_DEFUZZER_FAST:
+        bcbuf[idx] = FEED_DEFUZZER_FAST
+        bcbuf[idx + 1] = level_slots[(ins.cdr.car, ins.cdr.cdr.car)]
+        bcbuf[idx + 2] = ins.cdr.cdr.car
+        return 3
+    if ins.car is bytecode_compiler.SYM_STORE:
+        bcbuf[idx] = STORE
+        bcbuf[idx + 1] = ins.cdr.car
+        return 2
+    if ins.car is bytecode_compiler.SYM_LOAD:
+        bcbuf[idx] = LOAD
+        bcbuf[idx + 1] = ins.cdr.car
+        return 2
+    if ins.car is bytecode_compiler.SYM_MIN_N:
+        bcbuf[idx] = MIN_N
+        bcbuf[idx + 1] = ins.cdr.car
+        return 2
+    if ins.car is bytecode_compiler.SYM_MAX_N:
+        bcbuf[idx] = MAX_N
+        bcbuf[idx + 1] = ins.cdr.car
+        return 2
+    if ins.car is bytecode_compiler.SYM_FEED_DEFUZZER_FAST_POP:
+        bcbuf[idx] = FEED_DEFUZZER_FAST_POP
+        bcbuf[idx + 1] = level_slots[(ins.cdr.car, ins.cdr.cdr.car)]
+        bcbuf[idx + 2] = ins.cdr.cdr.car
+        return 3
+    if ins.car is bytecode_compiler.SYM_MEMBERSHIP_OF_INPUT:
+        bcbuf[idx] = MEMBERSHIP_OF_INPUT
+        bcbuf[idx + 1] = ins.cdr.car
+        bcbuf[idx + 2] = slots[id(ins.cdr.cdr.car)]
+        return 3
+
+def encode(bytecode, member_functions, level_slots):
+    """Encode a list of indexed instructions into the array of integers run
+    by `interpret`. Member functions are encoded as their index in
+    `member_functions`, and the (output, x2) of a feed as its slot in
+    `level_slots` (followed by x2).
+    """
+    slots = {id(f): i for i, f in enumerate(member_functions)}
+    bcbuf = array('l', [0]) * bytecode_compiler.compute_buffer_length(
+        bytecode)
+    idx = 0
+    while bytecode is not None:
+        idx += _encode_instruction(bcbuf, idx, bytecode.car, slots,
+                                   level_slots)
+        bytecode = bytecode.cdr
+    return bcbuf
+
+def function_slots(bcbuf):
+    """The indices of the member functions called by `bcbuf`"""
+    result = set()
+    idx = 0
+    while idx < len(bcbuf):
+        if bcbuf[idx] == CALL_FUNCTION_BY_REF:
+            result.add(bcbuf[idx + 1])
+        elif bcbuf[idx] == MEMBERSHIP_OF_INPUT:
+            result.add(bcbuf[idx + 2])
+        idx += LENGTHS[bcbuf[idx]]
+    return result
+
+def interpret(bcbuf, inputs, functions, sums, stack, temporaries):
+    """Run the program `bcbuf` (see `encode`) once with the member functions
+    `functions` (in slot order), adding to `sums` (the sums of a
+    `fuzzy.DefuzzerBank`). `stack` and `temporaries` are lists of at least
+    `bytecode_compiler.max_stack_depth` and `count_temporaries` items.
+    """
+    sp = 0
+    idx = 0
+    while idx < len(bcbuf):
+        ins = bcbuf[idx]
+        if ins == POP:
+            sp -= 1
+        elif ins == MIN or ins == MAX:
+            sp -= 1
+            a = stack[sp]
+            b = stack[sp - 1]
+            stack[sp - 1] = (a if a < b else b) if ins == MIN else (
+                a if a > b else b)
+        elif ins == GET_INPUT_BY_INDEX:
+            stack[sp] = inputs[bcbuf[idx + 1]]
+            sp += 1
+        elif ins == CALL_FUNCTION_BY_REF:
+            stack[sp - 1] = functions[bcbuf[idx + 1]](stack[sp - 1])
+        elif ins == MEMBERSHIP_OF_INPUT:
+            # %get-input-by-index followed by %call-function-by-ref
+            stack[sp] = functions[bcbuf[idx + 2]](inputs[bcbuf[idx + 1]])
+            sp += 1
+        elif ins == FEED_DEFUZZER_FAST:
+            # do not take anything off the stack
+            sums[bcbuf[idx + 1]] += stack[sp - 1]
+        elif ins == FEED_DEFUZZER_FAST_POP:
+            sp -= 1
+            sums[bcbuf[idx + 1]] += stack[sp]
+        elif ins == STORE:
+            # copy the top of the stack into a temporary
+            temporaries[bcbuf[idx + 1]] = stack[sp - 1]
+        elif ins == LOAD:
+            stack[sp] = temporaries[bcbuf[idx + 1]]
+            sp += 1
+        elif ins == MIN_N or ins == MAX_N:
+            # replace the top n values of the stack with their min/max
+            bottom = sp - bcbuf[idx + 1]
+            values = stack[bottom:sp]
+            stack[bottom] = min(values) if ins == MIN_N else max(values)
+            sp = bottom + 1
+        else:
+            raise RuntimeError('Unknown instruction {}'.format(ins))
+        idx += LENGTHS[ins]
+
+def load_bytecode(rule_path, cache_dir=None):
+    """Compile `rule_path`, or load its bytecode from `cache_dir`"""
+    if cache_dir is not None:
+        return bytecode_cache.load_or_compile(rule_path, cache_dir)
+    with open(rule_path, 'rb') as fd:
+        forms = dsl_parser.SchemeParser().iter_parse(fd)
+        return bytecode_compiler.compile_stream_to_bytecode(forms)
+
 
 class VM(bytecode_compiler.Constants):
-    def __init__(self, inputs, outputs, rule_path):
-        sexp = None
-        with open(rule_path, 'rb') as fd:
-            sexp = dsl_parser.SchemeParser().parse(fd)
-        bytecode = bytecode_compiler.compile_to_bytecode(sexp)
-        super().__init__(inputs, outputs, bytecode)
-        self.bytecode = self.eliminate_map_lookup(bytecode)
-        self.defuzzers = [fuzzy.Defuzzer() for _ in range(len(outputs))]
-
-        buflen = bytecode_compiler.compute_buffer_length(self.bytecode)
-        self.bcbuf = [None] * buflen
-        self._encode()
-
-        self.stack = [None] * 16
-        self.sp = 0
-
-    def _encode_kernel(self, idx, ins):
-        if ins.car == '%pop':
-            self.bcbuf[idx] = POP
-            return 1
-        if ins.car == '%min':
-            self.bcbuf[idx] = MIN
-            return 1
-        if ins.car == '%max':
-            self.bcbuf[idx] = MAX
-            return 1
-        if ins.car == '%get-input-by-index':
-            self.bcbuf[idx] = GET_INPUT_BY_INDEX
-            self.bcbuf[idx + 1] = ins.cdr.car
-            return 2
-        if ins.car == '%call-function-by-ref':
-            self.bcbuf[idx] = CALL_FUNCTION_BY_REF
-            self.bcbuf[idx + 1] = ins.cdr.car
-            return 2
-        if ins.car == '%feed-defuzzer-fast':
-            self.bcbuf[idx] = FEED_DEFUZZER_FAST
-            self.bcbuf[idx + 1] = ins.cdr.car
-            self.bcbuf[idx + 2] = ins.cdr.cdr.car
-            return 3
-
-    def _encode(self):
-        idx = 0
-        current = self.bytecode
-        while idx < len(self.bcbuf):
-            idx += self._encode_kernel(idx, current.car)
-            current = current.cdr
+    # compile `rule_path` form by form with a `hot_reload.FormCache` even
+    # without `watch`, to know the form each instruction comes from
+    by_form = False
+
+    def __init__(self, inputs, outputs, rule_path, cache_dir=None,
+                 optimizations=optimizer.DEFAULT_PIPELINE, watch=False,
+                 poll_interval=1.0, engine='interpreter',
+                 defuzzification='weighted-average'):
+        """With `watch`, `run` polls `rule_path` every `poll_interval`
+        seconds and reloads the program when the file changes. It compiles
+        the file form by form (see `hot_reload.FormCache`), so `cache_dir`
+        is not used.
+
+        `engine` is 'interpreter' (run by `interpret`),
+        'codegen' (run a Python function generated from the program) or
+        'active' (the same, evaluating only the rules that can fire; see
+        `ActiveRuleGenerator`). 'active' generates its code from the rules
+        after the `optimizer.RULE_PASSES` of `optimizations`.
+        `defuzzification` is one of `fuzzy.DEFUZZIFICATIONS`.
+        """
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine {}'.format(engine))
+        self.engine = engine
+        self.defuzzification = defuzzification
+        self.input_functions = inputs
+        self.output_functions = outputs
+        self.rule_path = rule_path
+        self.optimizations = optimizations
+        self.watcher = None
+        self.form_cache = None
+        # text of a form: its indexed bytecode and the statements of its
+        # bytecode after the local passes (see `_optimize_forms`)
+        self.prepared = {}
+        self.reload_error = None
+
+        if watch:
+            self.watcher = hot_reload.RuleWatcher(rule_path, poll_interval)
+        if watch or self.by_form:
+            self.form_cache = hot_reload.FormCache()
+            bytecode = self._compile_rules()
+        else:
+            bytecode = load_bytecode(rule_path, cache_dir)
+        self._load(bytecode)
+
+    def _compile_rules(self):
+        with open(self.rule_path, 'rb') as fd:
+            return self.form_cache.compile(fd.read())
+
+    def _load(self, bytecode):
+        super().__init__(self.input_functions, self.output_functions,
+                         bytecode)
+        self.optimizer_stats = []
+        if self.form_cache is None:
+            # the program after `eliminate_map_lookup`, before `optimizations`
+            self.indexed = self.eliminate_map_lookup(bytecode)
+            self.bytecode = optimizer.optimize(
+                self.indexed,
+                self.optimizations,
+                self.optimizer_stats
+            )
+        else:
+            self.bytecode = self._optimize_forms()
+        self.temporaries = [None] * bytecode_compiler.count_temporaries(
+            self.bytecode)
+        self.stack = [None] * bytecode_compiler.max_stack_depth(
+            self.bytecode)
+        self.bank = fuzzy.DefuzzerBank(
+            len(self.output_functions), self.levels, self.defuzzification)
+
+        self.bcbuf = encode(self.bytecode, self.member_functions,
+                            self.level_slots)
+
+        self.generated = None
+        self.rule_index = None
+        if self.engine == 'codegen':
+            self.generated = CodeGenerator(
+                self.bcbuf, len(self.levels), self.member_functions
+            ).compile()
+        elif self.engine == 'active':
+            self.rule_index = active_rules.RuleIndex(
+                optimizer.optimize_rules(self.indexed, self.optimizations),
+                self.member_functions)
+            self.generated = ActiveRuleGenerator(
+                self.rule_index, self.level_slots, self.member_functions
+            ).compile()
+
+    def _optimize_forms(self):
+        """`optimizer.optimize` the program of `form_cache` with
+        `optimizations`. The passes at the start of `optimizations` that
+        only look inside a rule (see `optimizer.split_pipeline`) and
+        `bytecode_compiler.split_expressions` run on each form, and are
+        reused for the forms of the previous program; the other passes run
+        on the whole program.
+        """
+        local, rest = optimizer.split_pipeline(self.optimizations)
+        prepared = {}
+        indexed = dsl_parser.Accumulator()
+        statements = []
+        for form in self.form_cache.forms:
+            entry = prepared.get(form.source) or self.prepared.get(form.source)
+            if entry is None:
+                part = self.eliminate_map_lookup(form.bytecode)
+                entry = (part, bytecode_compiler.split_expressions(
+                    optimizer.optimize(part, local),
+                    bytecode_compiler.INDEXED_PURE_ARITY))
+            prepared[form.source] = entry
+            indexed.extend(entry[0])
+            statements.extend(entry[1])
+        # `reload` works on a copy of the VM, so `prepared` is replaced and
+        # never changed
+        self.prepared = prepared
+        self.indexed = indexed.to_list()
+        return optimizer.optimize_statements(statements, rest,
+                                             self.optimizer_stats)
+
+    def reload(self):
+        """Compile `rule_path` again, reusing the bytecode of the forms that
+        did not change, and switch to the new program. If that fails, the
+        old program is kept and the error is stored in `reload_error`.
+        """
+        candidate = copy.copy(self)
+        try:
+            candidate._load(candidate._compile_rules())
+        except Exception as error:
+            # keep running the old program while the file is being edited
+            self.reload_error = error
+            return False
+        candidate.inputs = self.inputs
+        candidate.reload_error = None
+        self.__dict__ = candidate.__dict__
+        return True
 
     def input(self, key, value):
         idx = self.input_to_index[key]
         self.inputs[idx] = value
 
-    def _pop(self):
-        self.sp -= 1
-        return self.stack[self.sp]
+    def run(self):
+        if self.watcher is not None and self.watcher.changed():
+            self.reload()
+        if self.generated is not None:
+            self.generated(self.inputs, self.bank.sums)
+            return
+        self.bank.reset()
+        interpret(self.bcbuf, self.inputs, self.member_functions,
+                  self.bank.sums, self.stack, self.temporaries)
+
+    def get_output(self, key):
+        return self.bank.defuzz(self.output_to_index[key])
 
-    def _push(self, value):
-        self.stack[self.sp] = value
-        self.sp += 1
 
-    def _interpret(self, idx, ins):
-        if ins == POP:
-            self.sp -= 1
-            return 1
-        if ins == MIN:
-            self._push(min(self._pop(), self._pop()))
-            return 1
-        if ins == MAX:
-            self._push(max(self._pop(), self._pop()))
-            return 1
-        if ins == GET_INPUT_BY_INDEX:
-            # push the input onto the stack
-            input_index = self.bcbuf[idx + 1]
-            self._push(self.inputs[input_index])
-            return 2
-        if ins == CALL_FUNCTION_BY_REF:
-            # take the input off the stack and call member function
-            # push the result onto the stack
-            result = self.bcbuf[idx + 1](self._pop())
-            self._push(result)
-            return 2
-        if ins == FEED_DEFUZZER_FAST:
-            # do not take anything off the stack
-            defuzzer = self.defuzzers[self.bcbuf[idx + 1]]
-            y2 = self.bcbuf[idx + 2]
-            defuzzer.feed(y2, self.stack[self.sp - 1])
-            return 3
+class Program(bytecode_compiler.Constants):
+    """A rule file compiled once and never changed afterwards, to be run by
+    any number of `VMInstance` objects:
+
+        program = Program(inputs, outputs, 'rule.scm')
+        machine = program.instance()
+        machine.input('dist', 100)
+        machine.run()
+        machine.get_output('dx')
+
+    %call-function-by-ref refers to a member function by its slot, an index
+    into `member_functions`, so each instance may bring its own functions
+    (see `bind`). Everything else in the program is shared. For the same
+    reason, the `optimizer.FUNCTION_PASSES` of `optimizations` are not run.
+    """
+    def __init__(self, inputs, outputs, rule_path, cache_dir=None,
+                 optimizations=optimizer.DEFAULT_PIPELINE,
+                 engine='interpreter', defuzzification='weighted-average'):
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine {}'.format(engine))
+        self.engine = engine
+        bytecode = load_bytecode(rule_path, cache_dir)
+        super().__init__(inputs, outputs, bytecode)
+        optimizations = [name for name in optimizations
+                         if name not in optimizer.FUNCTION_PASSES]
+        # only the tables of the bank are shared, each instance has its sums
+        self.bank = fuzzy.DefuzzerBank(len(outputs), self.levels,
+                                       defuzzification)
+        indexed = self.eliminate_map_lookup(bytecode)
+        self.bytecode = optimizer.optimize(indexed, optimizations)
+        self.temporary_count = bytecode_compiler.count_temporaries(
+            self.bytecode)
+        self.stack_depth = bytecode_compiler.max_stack_depth(self.bytecode)
+        self.bcbuf = encode(self.bytecode, self.member_functions,
+                            self.level_slots)
+        self.called_slots = function_slots(self.bcbuf)
+
+        self.generated = None
+        if engine == 'codegen':
+            self.generated = CodeGenerator(
+                self.bcbuf, len(self.levels), self.member_functions,
+                per_instance=True
+            ).compile()
+        elif engine == 'active':
+            rule_index = active_rules.RuleIndex(
+                optimizer.optimize_rules(indexed, optimizations),
+                self.member_functions)
+            self.generated = ActiveRuleGenerator(
+                rule_index, self.level_slots, self.member_functions,
+                per_instance=True
+            ).compile()
+
+    def bind(self, inputs):
+        """Return the member functions of `inputs` (a dictionary like the
+        one given to the constructor) in slot order
+        """
+        functions = list(self.member_functions)
+        for (name, level), slot in self.member_function_to_index.items():
+            if slot in self.called_slots:
+                functions[slot] = getattr(inputs[name], level)
+        return functions
+
+    def check_member_functions(self, functions):
+        if len(functions) != len(self.member_functions):
+            raise ValueError('Expected {} member functions, got {}'.format(
+                len(self.member_functions), len(functions)))
+        if self.generated is None:
+            return
+        for slot in self.called_slots:
+            default = self.member_functions[slot]
+            function = functions[slot]
+            if function is default:
+                continue
+            # the bounds of the tables are part of the generated code
+            if isinstance(default, fuzzy.TableTriangleFunction) and not (
+                    isinstance(function, fuzzy.TableTriangleFunction)
+                    and function.low == default.low
+                    and function.size == default.size):
+                raise ValueError('Member function {} does not match the '
+                                 'table of the program'.format(slot))
+
+    def instance(self, member_functions=None):
+        return VMInstance(self, member_functions)
+
+
+class VMInstance:
+    """The state of one controlled object running a shared `Program`: its
+    inputs, its stack and the sums of its defuzzers (see
+    `fuzzy.DefuzzerBank`)
+    """
+    __slots__ = ('program', 'member_functions', 'inputs', 'stack',
+                 'temporaries', 'sums')
+
+    def __init__(self, program, member_functions=None):
+        if member_functions is None:
+            member_functions = program.member_functions
+        else:
+            program.check_member_functions(member_functions)
+        self.program = program
+        self.member_functions = member_functions
+        self.inputs = [None] * len(program.input_to_index)
+        self.sums = array('q', program.bank.zeros)
+        self.stack = None
+        self.temporaries = None
+        if program.generated is None:
+            self.stack = [None] * program.stack_depth
+            self.temporaries = [None] * program.temporary_count
+
+    def input(self, key, value):
+        self.inputs[self.program.input_to_index[key]] = value
 
     def run(self):
-        for defuzzer in self.defuzzers:
-            defuzzer.reset()
-        idx = 0
-        while idx < len(self.bcbuf):
-            idx += self._interpret(idx, self.bcbuf[idx])
+        program = self.program
+        sums = self.sums
+        if program.generated is not None:
+            program.generated(self.inputs, self.member_functions, sums)
+            return
+        sums[:] = program.bank.zeros
+        interpret(program.bcbuf, self.inputs, self.member_functions, sums,
+                  self.stack, self.temporaries)
 
     def get_output(self, key):
-        idx = self.output_to_index[key]
-        return self.defuzzers[idx].defuzz()
+        program = self.program
+        return program.bank.defuzz(program.output_to_index[key], self.sums)
+
+
+class CodeGenerator:
+    """Generates the Python source of one function that does what `VM.run`
+    does for a program:
+
+        def run(inputs, sums): ...
+
+    The stack slots and the temporaries become local variables, member
+    functions are called directly, and the slots of the
+    `fuzzy.DefuzzerBank` are kept in local variables until the end.
+
+    With `per_instance`, the function is the one of a `Program`
+
+        def run(inputs, functions, sums): ...
+
+    which loads the member functions from `functions` on each call.
+    """
+    def __init__(self, bcbuf, level_count, member_functions,
+                 per_instance=False):
+        self.bcbuf = bcbuf
+        self.level_count = level_count
+        self.member_functions = member_functions
+        self.per_instance = per_instance
+        self.slots = set()
+        self.lines = []
+        self.namespace = {}
+        self.constant_names = {}
+
+    def _constant(self, value):
+        name = self.constant_names.get(id(value))
+        if name is None:
+            name = 'f%d' % len(self.constant_names)
+            self.constant_names[id(value)] = name
+            self.namespace[name] = value
+        return name
+
+    def _emit(self, line):
+        self.lines.append('    ' + line)
+
+    def _emit_call(self, variable, slot, argument):
+        function = self.member_functions[slot]
+        if self.per_instance:
+            self.slots.add(slot)
+            name = 'm%d' % slot
+            table = 'u%d' % slot
+        else:
+            name = self._constant(function)
+            if isinstance(function, fuzzy.TableTriangleFunction):
+                table = self._constant(function.table)
+        if not isinstance(function, fuzzy.TableTriangleFunction):
+            self._emit('%s = %s(%s)' % (variable, name, argument))
+            return
+        # look the membership up in the table without calling the function
+        low = function.low
+        offset = '%s - %d' % (argument, low) if low >= 0 else (
+            '%s + %d' % (argument, -low))
+        self._emit('%s = %s[%s] if %d <= %s < %d else %s(%s)' % (
+            variable, table, offset, low, argument, low + function.size,
+            name, argument))
+
+    def _emit_body(self):
+        bcbuf = self.bcbuf
+        sp = 0
+        inputs = set()
+        idx = 0
+        while idx < len(bcbuf):
+            ins = bcbuf[idx]
+            top = 's%d' % (sp - 1)
+            if ins == POP:
+                sp -= 1
+            elif ins == MIN or ins == MAX:
+                second = 's%d' % (sp - 2)
+                op = '<' if ins == MIN else '>'
+                self._emit('if %s %s %s: %s = %s' % (
+                    top, op, second, second, top))
+                sp -= 1
+            elif ins == GET_INPUT_BY_INDEX:
+                inputs.add(bcbuf[idx + 1])
+                self._emit('s%d = i%d' % (sp, bcbuf[idx + 1]))
+                sp += 1
+            elif ins == CALL_FUNCTION_BY_REF:
+                self._emit_call(top, bcbuf[idx + 1], top)
+            elif ins == MEMBERSHIP_OF_INPUT:
+                inputs.add(bcbuf[idx + 1])
+                self._emit_call('s%d' % sp, bcbuf[idx + 2],
+                                'i%d' % bcbuf[idx + 1])
+                sp += 1
+            elif ins == FEED_DEFUZZER_FAST or ins == FEED_DEFUZZER_FAST_POP:
+                self._emit('l%d += %s' % (bcbuf[idx + 1], top))
+                if ins == FEED_DEFUZZER_FAST_POP:
+                    sp -= 1
+            elif ins == STORE:
+                self._emit('t%d = %s' % (bcbuf[idx + 1], top))
+            elif ins == LOAD:
+                self._emit('s%d = t%d' % (sp, bcbuf[idx + 1]))
+                sp += 1
+            elif ins == MIN_N or ins == MAX_N:
+                n = bcbuf[idx + 1]
+                values = ', '.join('s%d' % i for i in range(sp - n, sp))
+                self._emit('s%d = %s(%s)' % (
+                    sp - n, 'min' if ins == MIN_N else 'max', values))
+                sp -= n - 1
+            else:
+                raise RuntimeError('Cannot generate code for {}'.format(ins))
+            idx += LENGTHS[ins]
+        return inputs
+
+    def compile(self):
+        if self.per_instance:
+            self.lines.append('def run(inputs, functions, sums):')
+        else:
+            self.lines.append('def run(inputs, sums):')
+        body = self.lines
+        self.lines = []
+        inputs = self._emit_body()
+        body, self.lines = self.lines, body
+
+        for i in sorted(inputs):
+            self._emit('i%d = inputs[%d]' % (i, i))
+        for slot in sorted(self.slots):
+            self._emit('m%d = functions[%d]' % (slot, slot))
+            function = self.member_functions[slot]
+            if isinstance(function, fuzzy.TableTriangleFunction):
+                self._emit('u%d = m%d.table' % (slot, slot))
+        for k in range(self.level_count):
+            self._emit('l%d = 0' % k)
+        self.lines.extend(body)
+        for k in range(self.level_count):
+            self._emit('sums[%d] = l%d' % (k, k))
+        if len(self.lines) == 1:
+            # a program without rules
+            self._emit('pass')
+
+        self.source = '\n'.join(self.lines) + '\n'
+        code = compile(self.source, '<rules>', 'exec')
+        exec(code, self.namespace)
+        return self.namespace['run']
+
+
+class ActiveRuleGenerator(CodeGenerator):
+    """Generates the `run` function of `CodeGenerator` from an
+    `active_rules.RuleIndex` instead of the bytecode. The function computes
+    every membership first, then evaluates the rules indexed under each
+    nonzero one:
+
+        v3 = f3(i0)
+        ...
+        if v3:
+            s = min(v3, v7)
+            if s:
+                l2 += s
+
+    so the time taken grows with the rules that can fire, not with all
+    the rules of the program.
+    """
+    def __init__(self, rule_index, level_slots, member_functions,
+                 per_instance=False):
+        super().__init__(None, len(level_slots), member_functions,
+                         per_instance)
+        self.rule_index = rule_index
+        self.level_slots = level_slots
+
+    def _condition(self, expression):
+        head = expression.instruction.car
+        if head is bytecode_compiler.SYM_CALL_FUNCTION_BY_REF:
+            return 'v%d' % self.rule_index.membership_slot(expression)
+        # (min a (min b c)) => min(a, b, c)
+        operands = []
+        pending = list(expression.operands)
+        while pending:
+            operand = pending.pop(0)
+            if operand.instruction.car is head:
+                pending[:0] = operand.operands
+            else:
+                operands.append(self._condition(operand))
+        name = 'min' if head is bytecode_compiler.SYM_MIN else 'max'
+        return '%s(%s)' % (name, ', '.join(operands))
+
+    def _emit_rule(self, rule, slot, indent):
+        condition = self._condition(rule.condition)
+        if condition != 'v%d' % slot:
+            self._emit(indent + 's = ' + condition)
+            self._emit(indent + 'if s:')
+            indent += '    '
+            condition = 's'
+        for feed in rule.feeds:
+            self._emit(indent + 'l%d += %s' % (self.level_slots[feed],
+                                                condition))
+
+    def _emit_body(self):
+        index = self.rule_index
+        inputs = set()
+        for slot in sorted(index.inputs):
+            i = index.inputs[slot]
+            inputs.add(i)
+            self._emit_call('v%d' % slot, slot, 'i%d' % i)
+        for slot in sorted(index.triggers):
+            self._emit('if v%d:' % slot)
+            for rule, earlier in index.triggers[slot]:
+                indent = '    '
+                if earlier:
+                    # already evaluated under a nonzero membership
+                    self._emit(indent + 'if not (%s):' % ' or '.join(
+                        'v%d' % s for s in earlier))
+                    indent += '    '
+                self._emit_rule(rule, slot, indent)
+        return inputs
+
+
+def check_outputs(inputs, outputs, rule_path, samples, optimizations):
+    """Run `rule_path` without optimizations and with `optimizations` on
+    every sample (a dictionary from input names to values), and raise
+    RuntimeError unless all outputs are identical
+    """
+    reference = VM(inputs, outputs, rule_path, optimizations=())
+    optimized = VM(inputs, outputs, rule_path, optimizations=optimizations)
+    for sample in samples:
+        results = []
+        for machine in (reference, optimized):
+            for key, value in sample.items():
+                machine.input(key, value)
+            machine.run()
+            results.append([machine.get_output(key) for key in outputs])
+        if results[0] != results[1]:
+            raise RuntimeError('Optimizations changed the outputs for {}: '
+                               '{} != {}'.format(sample, *results))